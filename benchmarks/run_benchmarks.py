@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Benchmarks
+
+Times the main stages of GaussQuality on synthetic phantom stacks of
+increasing size and reports parameter recovery error next to runtime, e.g.
+
+    python benchmarks/run_benchmarks.py --output benchmark.json
+    python benchmarks/run_benchmarks.py --baseline benchmark.json
+
+Results are saved as JSON. With `--baseline`, the fastest (or median) of the
+`--repeat` calls of each benchmark is compared to the stored result of the
+same name and size, and slowdowns beyond both `--tolerance` and
+`--min-difference` are reported.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gaussquality import gaussquality_io
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_visuals
+from gaussquality import gaussquality_phantom
+
+MU = [1000., 3000., 6000.]
+SIGMA = [100., 200., 300.]
+# MU and SIGMA are scaled down to fit in the range of bit depths below 16
+FULL_SCALE = 8000.
+PHI = [0.5, 0.3, 0.2]
+SIZES = {"small": (256, 256), "medium": (1024, 1024), "large": (2048, 2048)}
+
+
+def time_call(function, *args, repeat=3, **kwargs):
+    """
+    Times `repeat` calls of `function`.
+
+    Parameters
+    ----------
+    function : callable
+        Function to time.
+    *args, **kwargs
+        Arguments to `function`.
+    repeat : int, optional
+        Number of calls. The default is 3.
+
+    Returns
+    -------
+    times : list
+        Time of each call in s.
+    result : object
+        Returned by the last call.
+
+    """
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start_time)
+    return times, result
+
+
+def quiet(function):
+    # fitting prints progress, which would swamp the benchmark report
+    def quiet_function(*args, **kwargs):
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                return function(*args, **kwargs)
+            finally:
+                sys.stdout = stdout
+    return quiet_function
+
+
+def run_benchmarks(sizes, n_slices=20, n_runs=5, bit_depth=16, repeat=3):
+    """
+    Runs every benchmark on phantom stacks of each size.
+
+    Parameters
+    ----------
+    sizes : list
+        Names of sizes in `SIZES` to benchmark.
+    n_slices : int, optional
+        Number of slices in each phantom stack. The default is 20.
+    n_runs : int, optional
+        Number of slices fitted by `run_GMM_fit`. The default is 5.
+    bit_depth : int, optional
+        Bit depth of the phantom stacks. For 8 bits, `MU` and `SIGMA` are
+        scaled by 255 / `FULL_SCALE`. The default is 16.
+    repeat : int, optional
+        Number of calls of each benchmark. The default is 3.
+
+    Returns
+    -------
+    results : list
+        Dicts with the benchmark `name`, `size`, fastest call `seconds`,
+        `median_seconds` and, for fits, the relative recovery error of `mu`,
+        `sigma` and `phi`.
+
+    """
+    results = []
+    scale = min(1., (2.**bit_depth - 1) / FULL_SCALE)
+    mu = [value * scale for value in MU]
+    sigma = [value * scale for value in SIGMA]
+
+    def record(name, size, times, fitted=None):
+        seconds = min(times)
+        result = {"name": name, "size": size, "seconds": seconds,
+                  "median_seconds": float(np.median(times))}
+        if fitted is not None:
+            result["error"] = gaussquality_phantom.recovery_error(
+                fitted, mu, sigma, PHI)
+        results.append(result)
+        error = "" if fitted is None else \
+            "  mu {mu:.2e} sigma {sigma:.2e} phi {phi:.2e}".format(
+                **result["error"])
+        print("{:<28} {:<8} {:>9.4f} s{}".format(name, size, seconds, error))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            img_dir = gaussquality_phantom.write_phantom_stack(
+                os.path.join(tmp_dir, size), n_slices, SIZES[size], mu, sigma,
+                PHI, bit_depth=bit_depth)
+            img_filepath = gaussquality_io.get_img_list(img_dir)[0]
+
+            def stack_index():
+                # clear the stack index cache so the directory is listed
+                gaussquality_io._stack_index_cache.clear()
+                return gaussquality_io.get_stack_index(img_dir)
+            record("get_stack_index", size, time_call(stack_index,
+                                                      repeat=repeat)[0])
+            times, img = time_call(gaussquality_io.load_img, img_filepath,
+                                   repeat=repeat)
+            record("load_img", size, times)
+
+            fit = quiet(gaussquality_fitting.fit_GMM)
+            for name, kwargs in [("fit_GMM", {}),
+                                 ("fit_GMM histogram", {"histogram": True}),
+                                 ("fit_GMM n_samples=1e5",
+                                  {"n_samples": 100000})]:
+                times, fitted = time_call(fit, img, 3, repeat=repeat,
+                                          **kwargs)
+                record(name, size, times, fitted)
+
+            run_fit = quiet(gaussquality_fitting.run_GMM_fit)
+            for name, kwargs in [("run_GMM_fit histogram",
+                                  {"histogram": True}),
+                                 ("run_GMM_fit warm_start",
+                                  {"histogram": True, "warm_start": True})]:
+                times, (fitted, _) = time_call(run_fit, img_dir, 3,
+                                               n_runs=n_runs, repeat=repeat,
+                                               **kwargs)
+                record(name, size, times, fitted)
+
+            def plot():
+                gaussquality_visuals.plot_GMM(img, *fitted)
+                plt.close("all")
+            record("plot_GMM", size, time_call(quiet(plot),
+                                               repeat=repeat)[0])
+
+            def plot_img_and_histo():
+                gaussquality_visuals.plot_img_and_histo(img_filepath, 100.,
+                                                        fitted)
+                plt.close("all")
+            record("plot_img_and_histo", size,
+                   time_call(quiet(plot_img_and_histo), repeat=repeat)[0])
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, min_difference=0.01,
+                        statistic="min"):
+    """
+    Compares benchmark results to a stored baseline.
+
+    Parameters
+    ----------
+    results : list
+        Benchmark results, see `run_benchmarks`.
+    baseline : list
+        Benchmark results to compare against.
+    tolerance : float, optional
+        Fraction by which a benchmark may be slower than the baseline before
+        it is reported as a regression. The default is 0.2.
+    min_difference : float, optional
+        Slowdowns of less than `min_difference` s are not reported, however
+        large the fraction, as short benchmarks are dominated by timer noise.
+        The default is 0.01.
+    statistic : str, optional
+        Compare the fastest "min" or the "median" of the repeated calls.
+        Baselines without medians are compared by their fastest call.
+        The default is "min".
+
+    Returns
+    -------
+    regressions : list
+        Names and sizes of benchmarks slower than the baseline.
+
+    """
+    if statistic not in ("min", "median"):
+        raise ValueError("`statistic` must be \"min\" or \"median\"")
+    key = "seconds" if statistic == "min" else "median_seconds"
+    baseline = {(result["name"], result["size"]): result
+                for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["name"], result["size"]))
+        if previous is None:
+            continue
+        seconds = result.get(key, result["seconds"])
+        previous_seconds = previous.get(key, previous["seconds"])
+        difference = seconds - previous_seconds
+        ratio = seconds / previous_seconds if previous_seconds > 0 else \
+            (np.inf if seconds > 0 else 1.)
+        flag = ""
+        if difference > min_difference and ratio > 1 + tolerance:
+            regressions.append("{} {}".format(result["name"], result["size"]))
+            flag = "  SLOWER"
+        print("{:<28} {:<8} {:>9.4f} s vs {:>9.4f} s ({:.2f}x){}".format(
+            result["name"], result["size"], seconds, previous_seconds, ratio,
+            flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark GaussQuality on synthetic phantom stacks.")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"],
+                        choices=list(SIZES), help="image sizes to benchmark")
+    parser.add_argument("--n-slices", type=int, default=20,
+                        help="number of slices in each phantom stack")
+    parser.add_argument("--n-runs", type=int, default=5,
+                        help="number of slices fitted by run_GMM_fit")
+    parser.add_argument("--bit-depth", type=int, default=16,
+                        choices=sorted(gaussquality_phantom.BIT_DEPTHS),
+                        help="bit depth of the phantom stacks")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of calls of each benchmark")
+    parser.add_argument("--output", default=None,
+                        help="JSON file to save the results")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON file of results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline")
+    parser.add_argument("--min-difference", type=float, default=0.01,
+                        help="slowdowns in s below which nothing is reported")
+    parser.add_argument("--statistic", default="min",
+                        choices=["min", "median"],
+                        help="statistic of the repeated calls to compare")
+    args = parser.parse_args(argv)
+
+    # read the baseline first, in case it is also the output file
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as infile:
+            baseline = json.load(infile)["results"]
+
+    results = run_benchmarks(args.sizes, n_slices=args.n_slices,
+                             n_runs=args.n_runs, bit_depth=args.bit_depth,
+                             repeat=args.repeat)
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump({"python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "results": results}, outfile, indent=4)
+        print("Results saved as {}".format(args.output))
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, args.tolerance,
+                                          args.min_difference, args.statistic)
+        if len(regressions) > 0:
+            print("Slower than baseline: {}".format(", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
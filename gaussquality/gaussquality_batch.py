@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Batch processing
+
+Headless command-line runner which fits many image stacks listed in a
+manifest, e.g.
+
+    python -m gaussquality.gaussquality_batch manifest.json --save-dir results --n-workers 8
+
+The manifest is a JSON list of stacks, a JSON dict {"defaults": {...},
+"stacks": [...]}, or a CSV file with one stack per row. Each stack needs
+`img_dir` and `n_components`, and can set any other argument of
+`gaussquality_fitting.run_GMM_fit` except `executor`, `callback`, `profiler`
+and `return_diagnostics`, as well as `prefix`, `save_dir`,
+`output_format` ("csv" or "npz"), `profile` (if true, per-slice timings are
+saved as `<prefix>_profile.csv`) and `snr_cnr`, a list of
+[background, feature] material number pairs. Unknown keys raise a
+`ValueError`. In CSV
+manifests, thresholds are given as `lower_threshold`/`upper_threshold`
+columns and SNR/CNR pairs as `background`/`feature` columns.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import inspect
+import argparse
+import contextlib
+import concurrent.futures
+import numpy as np
+
+from gaussquality import gaussquality_io
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_calc
+from gaussquality import gaussquality_profile
+
+# arguments of `run_GMM_fit` which can be set in a manifest, all but those
+# taking Python objects or changing what it returns
+RUN_ARGS = [name for name in
+            inspect.signature(gaussquality_fitting.run_GMM_fit).parameters
+            if name not in ("img_dir", "n_components", "executor", "callback",
+                            "profiler", "return_diagnostics")]
+STACK_KEYS = ["img_dir", "n_components", "prefix", "save_dir",
+              "output_format", "profile", "snr_cnr"] + RUN_ARGS
+
+
+def read_manifest(manifest_filepath):
+    """
+    Reads a manifest of image stacks and their parameters.
+
+    Parameters
+    ----------
+    manifest_filepath : str, path-like
+        Filepath to a .json or .csv manifest.
+
+    Returns
+    -------
+    stacks : list
+        List of dicts of parameters for each stack, with defaults applied.
+
+    """
+    if str(manifest_filepath).lower().endswith(".csv"):
+        with open(manifest_filepath, newline="") as infile:
+            rows = [{key: value for key, value in row.items() if value != ""}
+                    for row in csv.DictReader(infile)]
+        # row 1 is the header
+        stacks = [_parse_csv_row(row, row_number)
+                  for row_number, row in enumerate(rows, start=2)]
+    else:
+        with open(manifest_filepath, "r") as infile:
+            manifest = json.load(infile)
+        if isinstance(manifest, dict):
+            defaults = manifest.get("defaults", {})
+            stacks = [dict(defaults, **stack) for stack in manifest["stacks"]]
+        else:
+            stacks = manifest
+    for stack in stacks:
+        if "img_dir" not in stack or "n_components" not in stack:
+            raise ValueError("Each stack in the manifest needs `img_dir` and "
+                             "`n_components`: {}".format(stack))
+        unknown = [key for key in stack if key not in STACK_KEYS]
+        if len(unknown) > 0:
+            raise ValueError("Unknown manifest keys {} in stack {}".format(
+                unknown, stack))
+        stack.setdefault("prefix", os.path.basename(
+            os.path.normpath(stack["img_dir"])))
+    return stacks
+
+
+def _parse_bool(value):
+    # CSV booleans, e.g. "true", "1" or "yes"
+    return value.strip().lower() in ("1", "true", "yes")
+
+
+def _parse_number(value):
+    # int if the value is whole, e.g. "70", otherwise float, e.g. "62.5"
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _parse_list(parse):
+    # comma-separated list, e.g. "2,3,4"; a single value is not a list
+    def parse_list(value):
+        values = [parse(item) for item in value.split(",")]
+        return values if len(values) > 1 else values[0]
+    return parse_list
+
+
+# parsers of CSV columns whose type cannot be told from the default value
+# of the `run_GMM_fit` argument
+CSV_PARSERS = {"img_dir": str, "prefix": str, "save_dir": str,
+               "output_format": str, "cache": str, "profile": _parse_bool,
+               "n_components": _parse_list(int), "mu_init": _parse_list(float),
+               "precision": float, "n_samples": int, "target_se": float,
+               "tolerance": float, "lower_threshold": float,
+               "upper_threshold": float, "background": int, "feature": int}
+
+
+def _csv_parser(key):
+    """
+    Gets the parser of a CSV manifest column from its name, or from the type
+    of the default value of the `run_GMM_fit` argument of the same name.
+
+    Parameters
+    ----------
+    key : str
+        Column name.
+
+    Returns
+    -------
+    callable or None
+        Function converting a string value, or None if `key` is not a known
+        column.
+
+    """
+    if key in CSV_PARSERS:
+        return CSV_PARSERS[key]
+    if key not in RUN_ARGS:
+        return None
+    default = inspect.signature(
+        gaussquality_fitting.run_GMM_fit).parameters[key].default
+    if isinstance(default, bool):
+        return _parse_bool
+    if isinstance(default, (int, float)):
+        return _parse_number
+    if isinstance(default, str):
+        return str
+    return None
+
+
+def _parse_csv_row(row, row_number=None):
+    """
+    Converts a CSV manifest row of strings to stack parameters.
+
+    Parameters
+    ----------
+    row : dict
+        CSV row, keys = column names.
+    row_number : int, optional
+        Row number, used in error messages. The default is None.
+
+    Returns
+    -------
+    dict
+        Parameters for the stack.
+
+    """
+    stack = {}
+    for key, value in row.items():
+        parse = _csv_parser(key)
+        if parse is None:
+            raise ValueError("Unknown column {!r} in manifest row {}".format(
+                key, row_number))
+        try:
+            stack[key] = parse(value)
+        except ValueError:
+            raise ValueError("Cannot parse {}={!r} in manifest row {}".format(
+                key, value, row_number))
+    if "lower_threshold" in stack or "upper_threshold" in stack:
+        # a missing bound does not limit the grey values
+        stack["threshold"] = (stack.pop("lower_threshold", -np.inf),
+                              stack.pop("upper_threshold", np.inf))
+    if "background" in stack or "feature" in stack:
+        if "background" not in stack or "feature" not in stack:
+            raise ValueError("Manifest row {} needs both `background` and "
+                             "`feature`".format(row_number))
+        stack["snr_cnr"] = [[stack.pop("background"), stack.pop("feature")]]
+    return stack
+
+
+def results_filepath(stack, save_dir):
+    """
+    Gets the filepath of the stack results, which is written last and marks a
+    stack as finished.
+
+    Parameters
+    ----------
+    stack : dict
+        Parameters for the stack.
+    save_dir : str, path-like
+        Default directory to save results.
+
+    Returns
+    -------
+    str, path-like
+        Filepath of the `_GMM_results.json` file, or the `_GMM_results.npz`
+        file if `output_format` is "npz".
+
+    """
+    extension = ".npz" if stack.get("output_format") == "npz" else ".json"
+    return os.path.join(stack.get("save_dir", save_dir),
+                        stack["prefix"] + "_GMM_results" + extension)
+
+
+def process_stack(stack, save_dir):
+    """
+    Fits a single image stack and saves its results in the same files as the
+    GUI: input arguments, stack results, slice results and SNR/CNR. If
+    `output_format` is "npz", everything is saved in a single
+    `<prefix>_GMM_results.npz` file instead, see
+    `gaussquality_io.save_GMM_results_npz`.
+
+    Fitting output is written to `<prefix>_log.txt` in the save directory.
+
+    Parameters
+    ----------
+    stack : dict
+        Parameters for the stack, see `read_manifest`.
+    save_dir : str, path-like
+        Default directory to save results.
+
+    Returns
+    -------
+    n_slices : int
+        Number of slices fitted.
+
+    """
+    save_dir = stack.get("save_dir", save_dir)
+    prefix = stack["prefix"]
+    os.makedirs(save_dir, exist_ok=True)
+    run_args = {arg: stack[arg] for arg in RUN_ARGS if arg in stack}
+    if stack.get("profile"):
+        run_args["profiler"] = gaussquality_profile.Profiler()
+
+    log_filepath = os.path.join(save_dir, prefix + "_log.txt")
+    with open(log_filepath, "w") as log_file, \
+            contextlib.redirect_stdout(log_file):
+        if stack.get("output_format") != "npz":
+            gaussquality_io.save_input_args(stack, save_dir, prefix)
+        stack_results, slice_results = gaussquality_fitting.run_GMM_fit(
+            stack["img_dir"], stack["n_components"], **run_args)
+        if "profiler" in run_args:
+            run_args["profiler"].to_csv(os.path.join(
+                save_dir, prefix + "_profile.csv"))
+        if stack.get("output_format") == "npz":
+            gaussquality_io.save_GMM_results_npz(
+                slice_results, results_filepath(stack, save_dir),
+                fitted_results=stack_results, input_args=stack)
+            return slice_results.n_slices
+        gaussquality_io.save_GMM_slice_results(slice_results, save_dir,
+                                               prefix)
+        for background, feature in stack.get("snr_cnr", []):
+            snr = gaussquality_calc.calc_snr_stack(slice_results,
+                                                   background, feature)
+            cnr = gaussquality_calc.calc_cnr_stack(slice_results,
+                                                   background, feature)
+            gaussquality_io.save_SNR_CNR_slice_results(
+                snr, cnr, save_dir, prefix, background, feature)
+        # stack results are saved last, so they mark the stack as finished
+        gaussquality_io.save_GMM_single_results(stack_results, save_dir,
+                                                prefix)
+    return len(slice_results[0])
+
+
+def run_batch(stacks, save_dir, n_workers=1, force=False):
+    """
+    Fits many image stacks in parallel, skipping stacks which are finished.
+
+    Parameters
+    ----------
+    stacks : list
+        List of dicts of parameters for each stack, see `read_manifest`.
+    save_dir : str, path-like
+        Default directory to save results.
+    n_workers : int, optional
+        Number of stacks to fit at once, each in its own process. -1 or None
+        uses all CPUs. The default is 1.
+    force : bool, optional
+        If True, refit stacks which already have results. The default is False.
+
+    Returns
+    -------
+    summary : dict
+        Number of stacks `finished`, `skipped` and `failed`, the number of
+        slices fitted `n_slices`, the elapsed time in s `elapsed`, and the
+        throughput `stacks_per_hour` and `slices_per_s`.
+
+    """
+    start_time = time.time()
+    todo = [stack for stack in stacks
+            if force or not os.path.exists(results_filepath(stack, save_dir))]
+    summary = {"finished": 0,
+               "skipped": len(stacks) - len(todo),
+               "failed": 0,
+               "n_slices": 0}
+    print("{} stacks to fit, {} already finished".format(len(todo),
+                                                         summary["skipped"]))
+
+    max_workers = os.cpu_count() if n_workers in (None, -1) else n_workers
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=gaussquality_fitting._limit_worker_threads) as pool:
+        futures = {pool.submit(process_stack, stack, save_dir): stack
+                   for stack in todo}
+        for future in concurrent.futures.as_completed(futures):
+            stack = futures[future]
+            try:
+                summary["n_slices"] += future.result()
+                summary["finished"] += 1
+                print("Finished {} ({}/{})".format(stack["prefix"],
+                                                   summary["finished"],
+                                                   len(todo)))
+            except Exception as error:
+                summary["failed"] += 1
+                print("Failed {}: {!r}".format(stack["prefix"], error))
+
+    summary["elapsed"] = time.time() - start_time
+    summary["stacks_per_hour"] = summary["finished"] / summary["elapsed"] * 3600
+    summary["slices_per_s"] = summary["n_slices"] / summary["elapsed"]
+    print("{finished} stacks finished, {skipped} skipped, {failed} failed in "
+          "{elapsed:.1f} s: {stacks_per_hour:.1f} stacks/hour, "
+          "{slices_per_s:.2f} slices/s".format(**summary))
+    return summary
+
+
+def main(argv=None):
+    """
+    Command-line entry point, see `python -m gaussquality.gaussquality_batch
+    --help`.
+
+    Parameters
+    ----------
+    argv : list, optional
+        Command-line arguments. The default is None, which uses `sys.argv`.
+
+    Returns
+    -------
+    int
+        Exit status, 1 if any stack failed.
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Fit Gaussian mixture models to many image stacks.")
+    parser.add_argument("manifest",
+                        help=".json or .csv manifest of stacks to fit")
+    parser.add_argument("--save-dir", default=".",
+                        help="directory to save results, unless set per stack")
+    parser.add_argument("--n-workers", type=int, default=1,
+                        help="number of stacks to fit at once, -1 for all CPUs")
+    parser.add_argument("--force", action="store_true",
+                        help="refit stacks which already have results")
+    parser.add_argument("--format", choices=["csv", "npz"], default="csv",
+                        help="save results as CSV/JSON files or a single .npz "
+                             "file per stack, unless set per stack")
+    args = parser.parse_args(argv)
+
+    stacks = read_manifest(args.manifest)
+    for stack in stacks:
+        stack.setdefault("output_format", args.format)
+    summary = run_batch(stacks, args.save_dir, n_workers=args.n_workers,
+                        force=args.force)
+    return 1 if summary["failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
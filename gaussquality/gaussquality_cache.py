@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Result cache
+
+Persistent on-disk cache of fitted Gaussian properties for single slices, so
+that interrupted or repeated runs only fit the slices which are missing.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+def _to_builtin(value):
+    """
+    Converts NumPy arrays and scalars to built-in types for JSON, and
+    functions to their importable name.
+
+    Parameters
+    ----------
+    value : object
+        Value which cannot be serialised by `json` directly.
+
+    Returns
+    -------
+    object
+        `value` as a list, int, float, bool or str.
+
+    """
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    if isinstance(value, (tuple, set)):
+        return list(value)
+    # lambdas and nested functions have no unique name
+    qualname = getattr(value, "__qualname__", "<")
+    if callable(value) and "<" not in qualname:
+        return "{}.{}".format(getattr(value, "__module__", None), qualname)
+    raise TypeError("Cannot serialise {!r}".format(value))
+
+
+def make_key(identity, params):
+    """
+    Calculates a key identifying the results of fitting data with `params`.
+
+    Parameters
+    ----------
+    identity : object
+        Identity of the data, e.g. of a slice, see
+        `gaussquality_io.VolumeSource.slice_identity`.
+    params : dict
+        Every parameter which affects the fit. Functions are identified by
+        their module and name. A TypeError is raised for parameters which
+        cannot be identified, e.g. lambdas.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the results.
+
+    """
+    key_json = json.dumps({"slice": identity, "params": params},
+                          sort_keys=True, default=_to_builtin)
+    return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Content-addressed cache of per-slice fit results stored as JSON files in
+    `cache_dir`.
+
+    Each result is keyed by the identity of the slice (see
+    `gaussquality_io.VolumeSource.slice_identity`) and every parameter which
+    affects the fit. Floats are stored with full precision, so cached results
+    are identical to freshly fitted ones. When the cache grows beyond
+    `max_bytes`, the least recently used results are deleted.
+
+    Parameters
+    ----------
+    cache_dir : str, path-like
+        Directory to store results in. Created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of the cached results in bytes.
+        The default is 100 MB.
+    hash_content : bool, optional
+        If True, identify slices by a hash of their content instead of their
+        file size and modification time. The default is False.
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=100 * 2**20, hash_content=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size
+                                for entry in self._entries())
+
+    def __repr__(self):
+        return "ResultCache({!r}, {} of {} bytes)".format(
+            self.cache_dir, self._total_bytes, self.max_bytes)
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(".json")]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def key(self, source, index, params):
+        """
+        Calculates the cache key for a slice fitted with `params`.
+
+        Parameters
+        ----------
+        source : gaussquality_io.VolumeSource
+            Volume containing the slice.
+        index : int
+            Index of the slice in `source`.
+        params : dict
+            Every parameter which affects the fit, e.g. `n_components`,
+            `mask_percentage` and `threshold`, see `make_key`.
+
+        Returns
+        -------
+        str
+            Hex digest identifying the result.
+
+        """
+        return make_key(source.slice_identity(
+            index, hash_content=self.hash_content), params)
+
+    def get(self, key):
+        """
+        Gets a cached result.
+
+        Parameters
+        ----------
+        key : str
+            Cache key, see `key`.
+
+        Returns
+        -------
+        tuple or None
+            Fitted `mu`, `sigma`, `phi` and diagnostics dict, as returned by
+            `gaussquality_fitting.fit_GMM` with `return_diagnostics`, or None
+            if the result is not cached.
+
+        """
+        try:
+            with open(self._path(key), "r") as infile:
+                entry = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(self._path(key))
+        diagnostics = {name: np.array(value) if isinstance(value, list)
+                       else value
+                       for name, value in entry["diagnostics"].items()}
+        return (np.array(entry["mu"]), np.array(entry["sigma"]),
+                np.array(entry["phi"]), diagnostics)
+
+    def put(self, key, result):
+        """
+        Stores a result, then evicts the least recently used results if the
+        cache is larger than `max_bytes`.
+
+        Parameters
+        ----------
+        key : str
+            Cache key, see `key`.
+        result : tuple
+            Fitted `mu`, `sigma`, `phi` and diagnostics dict.
+
+        Returns
+        -------
+        None.
+
+        """
+        mu, sigma, phi, diagnostics = result
+        entry_json = json.dumps({"mu": mu, "sigma": sigma, "phi": phi,
+                                 "diagnostics": diagnostics},
+                                default=_to_builtin)
+        # write to a temporary file first so interrupted writes are not read
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(entry_json)
+        if os.path.exists(self._path(key)):
+            self._total_bytes -= os.path.getsize(self._path(key))
+        os.replace(tmp_path, self._path(key))
+        self._total_bytes += len(entry_json)
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used results until the cache is no larger
+        than `max_bytes`.
+
+        Returns
+        -------
+        None.
+
+        """
+        entries = sorted(self._entries(),
+                         key=lambda entry: entry.stat().st_mtime_ns)
+        self._total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def clear(self):
+        """
+        Deletes every cached result.
+
+        Returns
+        -------
+        None.
+
+        """
+        for entry in self._entries():
+            os.remove(entry.path)
+        self._total_bytes = 0
@@ -8,6 +8,8 @@ Created on Mon Jan 25 15:50:29 2021
 
 import numpy as np
 
+from gaussquality import gaussquality_results
+
 
 def calc_snr(mu, sigma):
     """
@@ -65,6 +67,85 @@ def calc_cnr(mu_a, mu_b, sigma_b):
         return np.abs(mu_a - mu_b) / sigma_b
 
 
+def stack_iter_results(iter_results):
+    """
+    Stacks fitted Gaussian properties of each slice into arrays.
+
+    Parameters
+    ----------
+    iter_results : list or gaussquality_results.SliceResults
+        List of fitted `mu`, `sigma` and `phi` Gaussian properties, as dicts
+        with keys = slice number.
+
+    Returns
+    -------
+    slice_numbers : list
+        Slice numbers, in the order of the array rows.
+    mus : np.ndarray
+        Fitted means, shape (slices, components).
+    sigmas : np.ndarray
+        Fitted standard deviations, shape (slices, components).
+
+    """
+    iter_results = gaussquality_results.SliceResults.from_iter_results(
+        iter_results)
+    return iter_results.slices.tolist(), iter_results.mu, iter_results.sigma
+
+
+def calc_snr_matrix(mus, sigmas):
+    """
+    Calculate SNR for every pair of background and feature materials at once.
+
+    Parameters
+    ----------
+    mus : array-like
+        Fitted means, shape (..., components), e.g. (slices, components).
+    sigmas : array-like
+        Fitted standard deviations, same shape as `mus`.
+
+    Returns
+    -------
+    snrs : np.ndarray
+        SNRs, shape (..., background, feature). NaN where the background
+        standard deviation is 0.
+
+    """
+    mus = np.asarray(mus, dtype=float)
+    sigmas = np.asarray(sigmas, dtype=float)
+    sigma_b = sigmas[..., :, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        snrs = mus[..., np.newaxis, :] / sigma_b
+    snrs[np.broadcast_to(sigma_b == 0, snrs.shape)] = np.nan
+    return snrs
+
+
+def calc_cnr_matrix(mus, sigmas):
+    """
+    Calculate CNR for every pair of background and feature materials at once.
+
+    Parameters
+    ----------
+    mus : array-like
+        Fitted means, shape (..., components), e.g. (slices, components).
+    sigmas : array-like
+        Fitted standard deviations, same shape as `mus`.
+
+    Returns
+    -------
+    cnrs : np.ndarray
+        CNRs, shape (..., background, feature). NaN where the background
+        standard deviation is 0.
+
+    """
+    mus = np.asarray(mus, dtype=float)
+    sigmas = np.asarray(sigmas, dtype=float)
+    sigma_b = sigmas[..., :, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cnrs = np.abs(mus[..., np.newaxis, :] - mus[..., :, np.newaxis]) / sigma_b
+    cnrs[np.broadcast_to(sigma_b == 0, cnrs.shape)] = np.nan
+    return cnrs
+
+
 def calc_snr_stack(iter_results, background_number,
                    feature_number):
     """
@@ -88,13 +169,9 @@ def calc_snr_stack(iter_results, background_number,
         Dict of SNRs. Keys = slice number, values = SNR.
 
     """
-    mus, sigmas, phis = iter_results
-    snrs = {}
-    for slice_number in list(mus.keys()):
-        mu = mus[slice_number][feature_number]
-        sigma = sigmas[slice_number][background_number]
-        snrs[slice_number] = calc_snr(mu, sigma)
-    return snrs
+    slice_numbers, mus, sigmas = stack_iter_results(iter_results)
+    snrs = calc_snr_matrix(mus, sigmas)[:, background_number, feature_number]
+    return dict(zip(slice_numbers, snrs.tolist()))
 
 
 def calc_cnr_stack(iter_results, background_number,
@@ -120,11 +197,6 @@ def calc_cnr_stack(iter_results, background_number,
         Dict of CNRs. Keys = slice number, values = CNR.
 
     """
-    mus, sigmas, phis = iter_results
-    cnrs = {}
-    for slice_number in list(mus.keys()):
-        mu_a = mus[slice_number][feature_number]
-        mu_b = mus[slice_number][background_number]
-        sigma_b = sigmas[slice_number][background_number]
-        cnrs[slice_number] = calc_cnr(mu_a, mu_b, sigma_b)
-    return cnrs
+    slice_numbers, mus, sigmas = stack_iter_results(iter_results)
+    cnrs = calc_cnr_matrix(mus, sigmas)[:, background_number, feature_number]
+    return dict(zip(slice_numbers, cnrs.tolist()))
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: 1-D EM engine
+
+Expectation-maximisation for 1-D Gaussian mixtures of grey values, with
+closed-form E and M steps, optional sample weights (e.g. histogram counts)
+and E-steps over chunks of the grey values so that memory use is bounded.
+Follows the conventions of `sklearn.mixture.GaussianMixture`: k-means
+initialisation, convergence on the change in mean log-likelihood and
+covariance regularisation. Only NumPy is used; k-means is solved in 1-D with
+Lloyd's algorithm over the sorted grey values.
+"""
+
+import numpy as np
+
+
+class GaussianMixture1D(object):
+    """
+    1-D Gaussian mixture model fitted with expectation-maximisation.
+
+    Parameters are named as in `sklearn.mixture.GaussianMixture`, so the two
+    can be used interchangeably by `gaussquality_fitting.fit_GMM`.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of Gaussian components.
+    tol : float, optional
+        Convergence threshold on the mean log-likelihood. The default is 1e-3.
+    reg_covar : float, optional
+        Non-negative regularisation added to the variances.
+        The default is 1e-6.
+    max_iter : int, optional
+        Maximum number of EM iterations. The default is 100.
+    means_init : array-like, optional
+        Initial means, shape (n_components,) or (n_components, 1).
+        The default is None.
+    weights_init : array-like, optional
+        Initial weights, shape (n_components,). The default is None.
+    precisions_init : array-like, optional
+        Initial inverse variances, shape (n_components,) or
+        (n_components, 1, 1). If `means_init`, `weights_init` and
+        `precisions_init` are all given, k-means initialisation is skipped.
+        The default is None.
+    random_state : int, optional
+        Ignored, as the k-means initialisation starts from quantiles and is
+        deterministic. For compatibility with scikit-learn.
+        The default is None.
+    dtype : np.dtype, optional
+        Precision of the E-step, np.float32 or np.float64. Sums over grey
+        values are always accumulated in float64. The default is np.float64.
+    chunk_size : int, optional
+        Number of grey values per E-step chunk. Memory use is about
+        4 * `chunk_size` * `n_components` values. The default is 2**16.
+
+    Attributes
+    ----------
+    means_ : np.ndarray
+        Fitted means, shape (n_components, 1).
+    covariances_ : np.ndarray
+        Fitted variances, shape (n_components, 1, 1).
+    weights_ : np.ndarray
+        Fitted weights, shape (n_components,).
+    n_iter_ : int
+        Number of EM iterations.
+    converged_ : bool
+        Whether EM converged within `max_iter` iterations.
+    lower_bound_ : float
+        Mean log-likelihood at the last E-step.
+
+    """
+
+    def __init__(self, n_components, tol=1e-3, reg_covar=1e-6, max_iter=100,
+                 means_init=None, weights_init=None, precisions_init=None,
+                 random_state=None, dtype=np.float64, chunk_size=2**16):
+        self.n_components = n_components
+        self.tol = tol
+        self.reg_covar = reg_covar
+        self.max_iter = max_iter
+        self.means_init = means_init
+        self.weights_init = weights_init
+        self.precisions_init = precisions_init
+        self.random_state = random_state
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return "GaussianMixture1D(n_components={}, dtype={})".format(
+            self.n_components, self.dtype.name)
+
+    def _chunks(self, *arrays):
+        # views of `chunk_size` elements of each array, or None
+        for start in range(0, len(arrays[0]), self.chunk_size):
+            stop = start + self.chunk_size
+            yield tuple(None if array is None else array[start:stop]
+                        for array in arrays)
+
+    def _log_prob(self, diff, variances, weights):
+        # weighted log-probability of each grey value in each component, from
+        # the differences `diff` between grey values and component means
+        variances = variances.astype(self.dtype)
+        return (-0.5 * (np.log(2 * np.pi * variances) + diff**2 / variances)
+                + np.log(weights).astype(self.dtype))
+
+    def _m_step(self, sums, means):
+        # parameters from the sums of r, r (x - means) and r (x - means)^2
+        eps = 10 * np.finfo(np.float64).eps
+        nk = sums[0] + eps
+        shift = sums[1] / nk
+        variances = np.maximum(sums[2] / nk - shift**2, 0) + self.reg_covar
+        return nk / nk.sum(), means + shift, variances
+
+    def _e_step(self, x, w, means, variances, weights):
+        # sums of responsibilities for the M-step, taken about the current
+        # means to avoid cancellation in float32, and the log-likelihood
+        sums = np.zeros((3, self.n_components))
+        log_likelihood = 0.
+        for x_chunk, w_chunk in self._chunks(x, w):
+            diff = x_chunk.astype(self.dtype)[:, np.newaxis] - \
+                means.astype(self.dtype)
+            log_prob = self._log_prob(diff, variances, weights)
+            log_norm = np.logaddexp.reduce(log_prob, axis=1)
+            resp = np.exp(log_prob - log_norm[:, np.newaxis])
+            if w_chunk is not None:
+                resp *= w_chunk[:, np.newaxis].astype(self.dtype)
+                log_likelihood += np.dot(w_chunk, log_norm.astype(np.float64))
+            else:
+                log_likelihood += np.sum(log_norm, dtype=np.float64)
+            sums[0] += resp.sum(axis=0, dtype=np.float64)
+            resp *= diff
+            sums[1] += resp.sum(axis=0, dtype=np.float64)
+            resp *= diff
+            sums[2] += resp.sum(axis=0, dtype=np.float64)
+        return sums, log_likelihood
+
+    def _kmeans_boundaries(self, x, w):
+        # weighted 1-D k-means with Lloyd's algorithm, started from the
+        # quantiles of the grey values. In 1-D every cluster is a run of the
+        # sorted grey values, so each iteration only needs the cumulative
+        # weights and weighted sums at the boundaries between clusters
+        cum_x = np.zeros(len(x) + 1)
+        if w is None:
+            x_sorted = np.sort(x)
+            np.cumsum(x_sorted, dtype=np.float64, out=cum_x[1:])
+        else:
+            order = np.argsort(x)
+            x_sorted = x[order]
+            w = w[order]
+            np.cumsum(w * x_sorted, out=cum_x[1:])
+            cum_w = np.concatenate([[0.], np.cumsum(w)])
+        total_weight = len(x_sorted) if w is None else cum_w[-1]
+        quantiles = (np.arange(self.n_components) + 0.5) / \
+            self.n_components * total_weight
+        quantile_ind = quantiles.astype(np.intp) if w is None else \
+            np.searchsorted(cum_w, quantiles, side="right") - 1
+        means = x_sorted[np.minimum(quantile_ind,
+                                    len(x_sorted) - 1)].astype(np.float64)
+        splits = None
+        for _ in range(self.max_iter):
+            boundaries = (means[1:] + means[:-1]) / 2
+            new_splits = np.concatenate([[0], np.searchsorted(
+                x_sorted, boundaries, side="right"), [len(x_sorted)]])
+            if splits is not None and np.array_equal(splits, new_splits):
+                break
+            splits = new_splits
+            cluster_w = np.diff(splits) if w is None else \
+                np.diff(cum_w[splits])
+            occupied = cluster_w > 0
+            means[occupied] = np.diff(cum_x[splits])[occupied] / \
+                cluster_w[occupied]
+            means = np.sort(means)
+        return (means[1:] + means[:-1]) / 2
+
+    def _initial_sums(self, x, w, centre):
+        # sums of one-hot responsibilities from weighted k-means, about
+        # `centre` to keep the sums of x^2 accurate
+        boundaries = self._kmeans_boundaries(x, w)
+        sums = np.zeros((3, self.n_components))
+        for x_chunk, w_chunk in self._chunks(x, w):
+            labels_chunk = np.searchsorted(boundaries, x_chunk, side="right")
+            diff = x_chunk - centre
+            w_chunk = np.ones(len(diff)) if w_chunk is None else w_chunk
+            for power in range(3):
+                sums[power] += np.bincount(labels_chunk,
+                                           weights=w_chunk * diff**power,
+                                           minlength=self.n_components)
+        return sums
+
+    def fit(self, X, y=None, sample_weight=None):
+        """
+        Fits the mixture to grey values.
+
+        Parameters
+        ----------
+        X : array-like
+            Grey values, shape (n,) or (n, 1).
+        y : None
+            Ignored, for compatibility with scikit-learn.
+        sample_weight : array-like, optional
+            Weight of each grey value, e.g. histogram counts.
+            The default is None, which weights every grey value equally.
+
+        Returns
+        -------
+        self
+
+        """
+        x = np.ravel(X)
+        if not np.issubdtype(x.dtype, np.floating):
+            x = x.astype(self.dtype)
+        w = None if sample_weight is None else \
+            np.asarray(sample_weight, dtype=np.float64).ravel()
+        total_weight = len(x) if w is None else np.sum(w)
+
+        if (self.means_init is not None and self.weights_init is not None
+                and self.precisions_init is not None):
+            weights = np.ravel(self.weights_init).astype(np.float64)
+            means = np.ravel(self.means_init).astype(np.float64)
+            variances = 1 / np.ravel(self.precisions_init).astype(np.float64)
+        else:
+            centre = np.average(x, weights=w)
+            weights, means, variances = self._m_step(
+                self._initial_sums(x, w, centre),
+                np.full(self.n_components, centre))
+            if self.means_init is not None:
+                means = np.ravel(self.means_init).astype(np.float64)
+            if self.weights_init is not None:
+                weights = np.ravel(self.weights_init).astype(np.float64)
+
+        lower_bound = -np.inf
+        self.converged_ = False
+        for n_iter in range(1, self.max_iter + 1):
+            prev_lower_bound = lower_bound
+            sums, log_likelihood = self._e_step(x, w, means, variances,
+                                                weights)
+            weights, means, variances = self._m_step(sums, means)
+            lower_bound = log_likelihood / total_weight
+            if abs(lower_bound - prev_lower_bound) < self.tol:
+                self.converged_ = True
+                break
+
+        self.n_iter_ = n_iter
+        self.lower_bound_ = lower_bound
+        self.weights_ = weights
+        self.means_ = means.reshape(-1, 1)
+        self.covariances_ = variances.reshape(-1, 1, 1)
+        return self
+
+    def score(self, X, sample_weight=None):
+        """
+        Calculates the mean log-likelihood of grey values.
+
+        Parameters
+        ----------
+        X : array-like
+            Grey values, shape (n,) or (n, 1).
+        sample_weight : array-like, optional
+            Weight of each grey value. The default is None.
+
+        Returns
+        -------
+        float
+            Mean log-likelihood, weighted by `sample_weight`.
+
+        """
+        x = np.ravel(X)
+        w = None if sample_weight is None else \
+            np.asarray(sample_weight, dtype=np.float64).ravel()
+        log_likelihood = 0.
+        for x_chunk, w_chunk in self._chunks(x, w):
+            diff = x_chunk.astype(self.dtype)[:, np.newaxis] - \
+                self.means_.ravel().astype(self.dtype)
+            log_norm = np.logaddexp.reduce(self._log_prob(
+                diff, self.covariances_.ravel(), self.weights_),
+                axis=1).astype(np.float64)
+            log_likelihood += np.sum(log_norm) if w_chunk is None else \
+                np.dot(w_chunk, log_norm)
+        return log_likelihood / (len(x) if w is None else np.sum(w))
@@ -7,89 +7,898 @@ Created on Mon Jan 25 15:36:11 2021
 """
 
 import os
+import json
 import time
+import functools
+import collections
+import contextlib
+import concurrent.futures
 import numpy as np
-import sklearn.mixture
 
 from gaussquality import gaussquality_io
+from gaussquality import gaussquality_em
+from gaussquality import gaussquality_cache
+from gaussquality import gaussquality_results
+from gaussquality import gaussquality_profile
 
 
-def fit_GMM(img, n_components, mu_init=None, threshold=None):
+def threshold_pixels(img, threshold=None):
+    """
+    Flattens `img` to the grey values within `threshold`, in their native
+    dtype. Without a threshold, contiguous images are flattened to a view
+    without copying. With a threshold, a single boolean mask is applied.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D array containing image grey values.
+    threshold : tuple, optional
+        (Min, Max) grey value to consider. The default is None.
+
+    Returns
+    -------
+    pixels : array-like
+        1-D array of grey values.
+
+    """
+    img = np.asarray(img).ravel()
+    if threshold is None:
+        return img
+    mask = img >= threshold[0]
+    mask &= img <= threshold[1]
+    return img[mask]
+
+
+def float_pixels(pixels, allow_float32=False):
+    """
+    Converts grey values to floats once for fitting. Float grey values are
+    returned without copying, integers are converted to float64, or to
+    float32 if `allow_float32` is True and this is exact, i.e. for integers
+    of up to 16 bits.
+
+    Parameters
+    ----------
+    pixels : array-like
+        Grey values.
+    allow_float32 : bool, optional
+        If True, store integers of up to 16 bits as float32. Only use this if
+        the fit does its arithmetic in its own precision, as the NumPy
+        engines do, since scikit-learn computes in the precision of its
+        input. The default is False.
+
+    Returns
+    -------
+    array-like
+        Grey values as floats.
+
+    """
+    pixels = np.asarray(pixels)
+    if np.issubdtype(pixels.dtype, np.floating):
+        return pixels
+    if allow_float32 and pixels.dtype.itemsize <= 2:
+        return pixels.astype(np.float32)
+    return pixels.astype(np.float64)
+
+
+def img_histogram(img, threshold=None, precision=None):
+    """
+    Calculates the grey value histogram of `img` as occupied bin centres and
+    pixel counts, which can be fitted instead of the individual pixels.
+
+    Integer images are binned with `np.bincount`, one bin per grey value, so
+    no information is lost. Float images are binned adaptively into bins of
+    width `precision`.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D array containing image grey values.
+    threshold : tuple, optional
+        (Min, Max) grey value to consider. The default is None.
+    precision : float, optional
+        Bin width used for float images. The default is None, which splits the
+        grey value range of the image into 2**16 bins. Ignored for integer
+        images.
+
+    Returns
+    -------
+    grey_values : array-like
+        Centres of the occupied histogram bins, in ascending order.
+    counts : array-like
+        Number of pixels in each bin of `grey_values`.
+
+    """
+    img = threshold_pixels(img, threshold)
+    if img.size == 0:
+        raise ValueError("No grey values to bin, check `threshold`")
+    img_min, img_max = img.min(), img.max()
+
+    if (np.issubdtype(img.dtype, np.integer)
+            and int(img_max) - int(img_min) < 2**24):
+        # one bin per grey value, offset so that the lowest grey value is 0
+        offset_type = np.dtype("u{}".format(img.dtype.itemsize))
+        offset_img = np.subtract(img, img_min, dtype=offset_type,
+                                 casting="unsafe")
+        counts = np.bincount(offset_img)
+        grey_values = int(img_min) + np.flatnonzero(counts)
+    else:
+        if precision is None:
+            precision = (float(img_max) - float(img_min)) / 2**16
+        if precision <= 0:
+            # single grey value
+            return np.array([float(img_min)]), np.array([img.size])
+        bin_index = ((img - img_min) / precision).astype(np.intp)
+        counts = np.bincount(bin_index)
+        grey_values = float(img_min) + \
+            (np.flatnonzero(counts) + 0.5) * precision
+    counts = counts[counts > 0]
+    return grey_values.astype(np.float64), counts
+
+
+def merge_histograms(histograms):
+    """
+    Merges grey value histograms, e.g. of the tiles of an image, into one.
+
+    Parameters
+    ----------
+    histograms : list
+        Histograms `(grey_values, counts)`, see `img_histogram`.
+
+    Returns
+    -------
+    grey_values : array-like
+        Grey values of every histogram, in ascending order.
+    counts : array-like
+        Total number of pixels at each of `grey_values`.
+
+    """
+    grey_values, inverse = np.unique(
+        np.concatenate([histogram[0] for histogram in histograms]),
+        return_inverse=True)
+    counts = np.bincount(
+        inverse, weights=np.concatenate([histogram[1]
+                                         for histogram in histograms]))
+    return grey_values, counts.astype(np.int64)
+
+
+def _sklearn_GMM(n_components, **params):
+    # scikit-learn is only imported when its engine is used
+    import sklearn.mixture
+    return sklearn.mixture.GaussianMixture(n_components, **params)
+
+
+# EM engines selectable with `engine`, see `fit_GMM`
+ENGINES = {
+    "sklearn": _sklearn_GMM,
+    "numpy": gaussquality_em.GaussianMixture1D,
+    "numpy32": functools.partial(gaussquality_em.GaussianMixture1D,
+                                 dtype=np.float32),
+}
+
+
+def make_GMM(n_components, engine="sklearn", means_init=None,
+             weights_init=None, variances_init=None, weighted=False):
+    """
+    Creates an unfitted Gaussian mixture model with an EM engine.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of Gaussian components to fit.
+    engine : str, optional
+        "sklearn" for `sklearn.mixture.GaussianMixture`, or "numpy" or
+        "numpy32" for `gaussquality_em.GaussianMixture1D` with float64 or
+        float32 E-steps. The default is "sklearn".
+    means_init : array-like, optional
+        Initial means of the components. The default is None.
+    weights_init : array-like, optional
+        Initial weights of the components. The default is None.
+    variances_init : array-like, optional
+        Initial variances of the components. If `means_init`, `weights_init`
+        and `variances_init` are all given, the k-means initialisation is
+        skipped. The default is None.
+    weighted : bool, optional
+        If True, the model is fitted with sample weights, e.g. to a
+        histogram, which only the NumPy engines support, so "sklearn" is
+        replaced by "numpy". The default is False.
+
+    Returns
+    -------
+    model
+        Gaussian mixture model with `fit` and `score` methods and fitted
+        `means_`, `covariances_` and `weights_` attributes.
+
+    """
+    if engine not in ENGINES:
+        raise ValueError("`engine` must be one of {}".format(list(ENGINES)))
+    if weighted and engine == "sklearn":
+        engine = "numpy"
+    params = {"random_state": 3}
+    if means_init is not None:
+        params["means_init"] = np.reshape(means_init, (n_components, 1))
+    if weights_init is not None:
+        params["weights_init"] = np.asarray(weights_init)
+    if variances_init is not None:
+        params["precisions_init"] = \
+            (1 / np.asarray(variances_init)).reshape((n_components, 1, 1))
+        if engine == "sklearn" and means_init is not None \
+                and weights_init is not None:
+            # all parameters are given, so the cheap random initialisation
+            # of responsibilities is only a placeholder
+            params["init_params"] = "random"
+    return ENGINES[engine](n_components, **params)
+
+
+def track_components(fitted, reference):
+    """
+    Orders fitted Gaussian components to match the components of a reference
+    fit, e.g. the neighbouring slice, by minimising the total distance
+    between their parameters.
+
+    The distance between a fitted and a reference component is
+    |delta mu| / sigma_ref + |log(sigma / sigma_ref)| + |delta phi| / phi_ref.
+
+    Parameters
+    ----------
+    fitted : tuple
+        Fitted `mu`, `sigma` and `phi` to reorder.
+    reference : tuple
+        Reference `mu`, `sigma` and `phi`.
+
+    Returns
+    -------
+    order : array-like, len=n_components
+        Indices which reorder `fitted` to match `reference`, i.e. fitted
+        component `order[i]` matches reference component `i`.
+
+    """
+    mu, sigma, phi = (np.asarray(param, dtype=np.float64) for param in fitted)
+    mu_ref, sigma_ref, phi_ref = (np.asarray(param, dtype=np.float64)
+                                  for param in reference)
+    tiny = np.finfo(np.float64).tiny
+    sigma_ref = np.maximum(sigma_ref, tiny)
+    distance = (np.abs(mu_ref[:, np.newaxis] - mu) / sigma_ref[:, np.newaxis]
+                + np.abs(np.log(np.maximum(sigma, tiny)
+                                / sigma_ref[:, np.newaxis]))
+                + np.abs(phi_ref[:, np.newaxis] - phi)
+                / np.maximum(phi_ref, tiny)[:, np.newaxis])
+    import scipy.optimize
+    return scipy.optimize.linear_sum_assignment(distance)[1]
+
+
+def sample_pixels(img, n_samples, sampling="random", random_state=3):
+    """
+    Draws a reproducible sample of pixels from `img`.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D array containing image grey values, or 1-D array of grey values,
+        e.g. after thresholding.
+    n_samples : int
+        Number of pixels to sample. If it is at least the number of pixels in
+        `img`, every pixel is returned.
+    sampling : str, optional
+        "random" draws pixels uniformly without replacement. "stratified"
+        splits the image into a grid of about `n_samples` cells, or 1-D grey
+        values into `n_samples` contiguous blocks, and draws one random pixel
+        from each, so the sample covers the whole image evenly.
+        The default is "random".
+    random_state : int, optional
+        Seed of the random number generator. The default is 3.
+
+    Returns
+    -------
+    samples : array-like
+        1-D array of sampled grey values.
+
+    """
+    img = np.asarray(img)
+    if n_samples >= img.size:
+        return img.ravel()
+    rng = np.random.default_rng(random_state)
+    if sampling == "random":
+        sample_ind = np.sort(rng.choice(img.size, size=n_samples,
+                                        replace=False))
+        return img.ravel()[sample_ind]
+    if sampling == "stratified" and img.ndim == 1:
+        sample_ind = ((np.arange(n_samples) + rng.random(n_samples))
+                      * img.size / n_samples).astype(np.intp)
+        return img[sample_ind]
+    if sampling == "stratified":
+        img = img.reshape(img.shape[0], -1)
+        cell_size = np.sqrt(img.size / n_samples)
+        n_cells = (max(int(round(img.shape[0] / cell_size)), 1),
+                   max(int(round(img.shape[1] / cell_size)), 1))
+        cells_x, cells_y = np.meshgrid(np.arange(n_cells[0]),
+                                       np.arange(n_cells[1]), indexing="ij")
+        sample_x = ((cells_x + rng.random(cells_x.shape))
+                    * img.shape[0] / n_cells[0]).astype(np.intp)
+        sample_y = ((cells_y + rng.random(cells_y.shape))
+                    * img.shape[1] / n_cells[1]).astype(np.intp)
+        return img[sample_x.ravel(), sample_y.ravel()]
+    raise ValueError("`sampling` must be 'random' or 'stratified'")
+
+
+def calc_standard_errors(mu, sigma, phi, n_samples):
+    """
+    Estimates the standard errors of fitted Gaussian properties from the
+    number of pixels fitted, assuming well-separated components.
+
+    SE(mu) = sigma / sqrt(n phi), SE(sigma) = sigma / sqrt(2 n phi) and
+    SE(phi) = sqrt(phi (1 - phi) / n). Overlapping components have larger
+    errors than these.
+
+    Parameters
+    ----------
+    mu : array-like, len=n_components
+        Fitted mean of Gaussian components.
+    sigma : array-like, len=n_components
+        Fitted standard deviation of Gaussian components.
+    phi : array-like, len=n_components
+        Fitted weights of Gaussian components.
+    n_samples : int
+        Number of pixels fitted.
+
+    Returns
+    -------
+    se_mu : array-like, len=n_components
+        Standard error of `mu`.
+    se_sigma : array-like, len=n_components
+        Standard error of `sigma`.
+    se_phi : array-like, len=n_components
+        Standard error of `phi`.
+
+    """
+    sigma = np.asarray(sigma, dtype=np.float64)
+    phi = np.asarray(phi, dtype=np.float64)
+    se_mu = sigma / np.sqrt(n_samples * phi)
+    se_sigma = sigma / np.sqrt(2 * n_samples * phi)
+    se_phi = np.sqrt(phi * (1 - phi) / n_samples)
+    return se_mu, se_sigma, se_phi
+
+
+def calc_required_samples(mu, sigma, phi, target_se, max_samples=None):
+    """
+    Calculates the number of pixels needed for the relative standard errors
+    of `mu`, `sigma` and `phi` to fall below `target_se`, see
+    `calc_standard_errors`. Relative standard errors which no sample size can
+    reduce, of `mu` = 0, e.g. a zero-padded or air background, or of
+    components with `phi` = 0, are skipped.
+
+    Parameters
+    ----------
+    mu : array-like, len=n_components
+        Estimated mean of Gaussian components.
+    sigma : array-like, len=n_components
+        Estimated standard deviation of Gaussian components.
+    phi : array-like, len=n_components
+        Estimated weights of Gaussian components.
+    target_se : float
+        Target standard error relative to the value of each property, e.g.
+        0.001 for 0.1%.
+    max_samples : int, optional
+        Maximum number of pixels, e.g. the number of pixels in the image.
+        Also returned if no standard error can be reduced.
+        The default is None.
+
+    Returns
+    -------
+    int
+        Number of pixels needed.
+
+    """
+    mu = np.abs(np.asarray(mu, dtype=np.float64))
+    sigma = np.asarray(sigma, dtype=np.float64)
+    phi = np.asarray(phi, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_mu = (sigma / (mu * target_se))**2 / phi
+        n_sigma = 1 / (2 * phi * target_se**2)
+        n_phi = (1 - phi) / (phi * target_se**2)
+    n_required = np.concatenate([n_mu, n_sigma, n_phi])
+    n_required = n_required[np.isfinite(n_required)]
+    if len(n_required) == 0:
+        if max_samples is None:
+            raise ValueError("No standard error can be reduced by sampling")
+        return int(max_samples)
+    n_required = np.max(n_required)
+    if max_samples is not None:
+        n_required = min(n_required, max_samples)
+    return int(np.ceil(n_required))
+
+
+def calc_log_likelihood(values, weights, mu, sigma, phi):
+    """
+    Calculates the log-likelihood of a 1-D Gaussian mixture model.
+
+    Parameters
+    ----------
+    values : array-like
+        1-D array of grey values, e.g. histogram bin centres.
+    weights : array-like
+        1-D array of weights for each of `values`, e.g. pixel counts.
+    mu : array-like, len=n_components
+        Mean of Gaussian components.
+    sigma : array-like, len=n_components
+        Standard deviation of Gaussian components.
+    phi : array-like, len=n_components
+        Weights of Gaussian components.
+
+    Returns
+    -------
+    float
+        Total log-likelihood of `values`, weighted by `weights`.
+
+    """
+    x = np.asarray(values, dtype=np.float64)[:, np.newaxis]
+    variances = np.asarray(sigma, dtype=np.float64)**2
+    log_prob = (-0.5 * (np.log(2 * np.pi * variances)
+                        + (x - np.asarray(mu, dtype=np.float64))**2 / variances)
+                + np.log(np.asarray(phi, dtype=np.float64)))
+    return float(np.sum(np.asarray(weights, dtype=np.float64)
+                        * np.logaddexp.reduce(log_prob, axis=1)))
+
+
+def calc_information_criterion(log_likelihood, n_components, n_pixels,
+                               criterion="bic"):
+    """
+    Scores a fitted 1-D Gaussian mixture model, lower is better.
+
+    BIC = -2 log L + p ln(n) and AIC = -2 log L + 2p, where a mixture of k
+    components has p = 3k - 1 free parameters.
+
+    Parameters
+    ----------
+    log_likelihood : float
+        Total log-likelihood of the fitted pixels.
+    n_components : int
+        Number of Gaussian components.
+    n_pixels : int
+        Number of pixels fitted.
+    criterion : str or callable, optional
+        "bic", "aic", or a function of (`log_likelihood`, number of free
+        parameters, `n_pixels`) returning a score. The default is "bic".
+
+    Returns
+    -------
+    float
+        Score.
+
+    """
+    n_parameters = 3 * n_components - 1
+    if callable(criterion):
+        return criterion(log_likelihood, n_parameters, n_pixels)
+    if criterion == "bic":
+        return -2 * log_likelihood + n_parameters * np.log(n_pixels)
+    if criterion == "aic":
+        return -2 * log_likelihood + 2 * n_parameters
+    raise ValueError("`criterion` must be 'bic', 'aic' or callable")
+
+
+def select_n_components(fits, n_components):
+    """
+    Chooses one number of components for every slice, the candidate with the
+    lowest total score over the slices.
+
+    Parameters
+    ----------
+    fits : list
+        Results of `fit_GMM` with several `n_components` and
+        `return_diagnostics` for each slice.
+    n_components : list
+        Candidate numbers of components, as passed to `fit_GMM`.
+
+    Returns
+    -------
+    fits : list
+        `mu`, `sigma`, `phi` of the chosen candidate and the diagnostics for
+        each slice.
+    int
+        Chosen number of components.
+
+    """
+    total_scores = np.sum([fit[3]["scores"] for fit in fits], axis=0)
+    best = int(np.argmin(total_scores))
+    n = n_components[best]
+    print("\nChose {} components, total scores {}".format(
+        n, dict(zip(n_components, total_scores.tolist()))))
+    return [tuple(fit[3]["candidate_" + name][best, :n]
+                  for name in ("mu", "sigma", "phi")) + (fit[3],)
+            for fit in fits], n
+
+
+def fit_GMM(img, n_components, mu_init=None, threshold=None,
+            histogram=False, precision=None, warm_start=None,
+            n_samples=None, target_se=None, sampling="random",
+            criterion="bic", engine="sklearn", return_diagnostics=False,
+            timings=None):
     """
     Fits Gaussian mixture model to `img` grey values, and return fitted
     Gaussian properties.
 
+    Grey values are thresholded in their native dtype and converted to float
+    once, to float32 for images of up to 16 bits with the NumPy engines, see
+    `float_pixels`. The fitted properties are always float64. Peak memory,
+    measured with `tracemalloc` while fitting 2 components to a 1000 x 1000
+    uint16 slice, is about 5 times the slice with `histogram` and about 12
+    times with the NumPy engines, mostly to sort the grey values for the
+    k-means initialisation. Only these reduce peak memory: the default
+    "sklearn" `engine` uses about 70 times the slice, as scikit-learn keeps
+    several float64 arrays of the size of the image.
+
     Parameters
     ----------
     img : array-like
         2-D array containing image grey values.
-    n_components : int
+    n_components : int or list
         Number of Gaussian components to fit to grey value distribution.
         Usually `n_components` = number of materials in the specimen image.
+        If a list or range, every candidate number is fitted in parallel to
+        the same grey values and the one with the lowest `criterion` score
+        is returned.
     mu_init : list, optional
-        List of initial mean values to use. The default is None.
+        List of initial mean values to use, only for candidates with
+        len(`mu_init`) components. The default is None.
     threshold : tuple, optional
         (Min, Max) grey value to consider. The default is None.
+    histogram : bool or tuple, optional
+        If True, fit the grey value histogram of `img` with weighted EM instead
+        of every pixel. This is much faster and uses much less memory for large
+        images. For integer images the fitted properties agree with the
+        pixel-level fit to within the EM convergence tolerance, typically
+        <1% relative difference. Can also be a histogram `(grey_values,
+        counts)` already calculated with `img_histogram`, which is fitted
+        instead of `img`. If there are fewer grey values than components,
+        every pixel of `img` is fitted instead, or a ValueError is raised for
+        a precalculated histogram. The default is False.
+    precision : float, optional
+        Histogram bin width for float images, see `img_histogram`.
+        The default is None.
+    warm_start : tuple, optional
+        Fitted `mu`, `sigma` and `phi` of a similar image, e.g. the
+        neighbouring slice, used to initialise EM instead of k-means. The
+        fitted components are returned in the same order as `warm_start`,
+        matched with `track_components`, instead of in ascending order of
+        `mu`. Overrides `mu_init`. The default is None.
+    n_samples : int, optional
+        Fit a sample of `n_samples` pixels instead of the whole image, see
+        `sample_pixels`. If `target_se` is also given, the maximum number of
+        pixels to sample. The default is None.
+    target_se : float, optional
+        Fit a sample just large enough for the relative standard errors of
+        `mu`, `sigma` and `phi` to fall below `target_se`, e.g. 0.001 for
+        0.1%. The sample size is estimated from a pilot fit to 10000 pixels,
+        see `calc_required_samples`. The default is None.
+    sampling : str, optional
+        How pixels are sampled, "random" or "stratified", see
+        `sample_pixels`. The default is "random".
+    criterion : str or callable, optional
+        Criterion to choose between candidate `n_components`, "bic" or
+        "aic", see `calc_information_criterion`. The default is "bic".
+    engine : str, optional
+        EM engine, see `make_GMM`. "sklearn" uses
+        `sklearn.mixture.GaussianMixture`. "numpy" and "numpy32" use the
+        specialised 1-D engine `gaussquality_em.GaussianMixture1D` in float64
+        or float32, which is faster and uses less memory for large images.
+        Histograms are always fitted with the 1-D engine, in float32 for
+        "numpy32". The default is "sklearn".
+    return_diagnostics : bool, optional
+        If True, also return fit diagnostics. The default is False.
+    timings : dict, optional
+        If given, the time in s spent thresholding, sampling or binning the
+        grey values `threshold_time` and fitting `em_time` is added to it,
+        see `gaussquality_profile.stage`. The default is None.
 
     Returns
     -------
     mu_fitted : array-like, len=n_components
-        Fitted mean of Gaussian components.
+        Fitted mean of Gaussian components, float64.
     sigma_fitted : array-like, len=n_components
-        Fitted standard deviation of Gaussian components.
+        Fitted standard deviation of Gaussian components, float64.
     phi_fitted : array-like, len=n_components
-        Fitted weights of Gaussian components.
+        Fitted weights of Gaussian components, float64.
+    diagnostics : dict
+        Only returned if `return_diagnostics` is True. Number of EM iterations
+        `n_iter`, whether EM `converged`, the final mean log-likelihood
+        `lower_bound` and the number of pixels fitted `n_pixels`. If pixels
+        were sampled, also the estimated standard errors `se_mu`, `se_sigma`
+        and `se_phi`, see `calc_standard_errors`. If several `n_components`
+        were fitted, also the chosen `n_components`, the `scores` of every
+        candidate, and the fitted properties of every candidate
+        `candidate_mu`, `candidate_sigma` and `candidate_phi`, padded with
+        NaN to the largest candidate. `n_iter`, `converged` and
+        `lower_bound` are of the chosen candidate.
 
     """
     start_time = time.time()
 
-    # Create an instance of GaussianMixture
-    GMM_model = sklearn.mixture.GaussianMixture(n_components, random_state=3)
-
-    # Optional initialisation
-    if mu_init is not None:
-        means_init = np.array(mu_init).reshape((n_components, 1))
-        GMM_model.set_params(means_init=means_init)
-
-    # Apply a threshold to ignore values outside this (min, max)
-    if threshold is not None:
-        img = np.array(list(filter(lambda x: x >= threshold[0], img.flatten())))
-        img = np.array(list(filter(lambda x: x <= threshold[1], img)))
-    print("Image grey value range = {}-{}".format(
-        min(img.flatten()), max(img.flatten())))
-    # Fit 1D array of image grey values
-    GMM_model.fit(img.reshape(-1, 1))
-
-    # Unpack results
-    mu_fitted = GMM_model.means_.flatten()                       # means
-    sigma_fitted = np.sqrt(GMM_model.covariances_).flatten()     # stdev
-    phi_fitted = GMM_model.weights_.flatten()                    # weights
-
-    # Sort in ascending order of means
-    sort_ind = np.argsort(mu_fitted)
-    mu_fitted = mu_fitted[sort_ind]
-    sigma_fitted = sigma_fitted[sort_ind]
-    phi_fitted = phi_fitted[sort_ind]
+    sampled = n_samples is not None or target_se is not None
+    if target_se is not None:
+        # estimate the sample size needed from a pilot fit
+        pilot_img = sample_pixels(img, 10000, sampling)
+        pilot_results = fit_GMM(pilot_img, n_components, mu_init=mu_init,
+                                threshold=threshold, histogram=histogram,
+                                precision=precision, warm_start=warm_start,
+                                criterion=criterion, engine=engine,
+                                return_diagnostics=True)
+        n_required = calc_required_samples(*pilot_results[:3], target_se,
+                                           max_samples=np.size(img))
+        # scale up for pixels which will be removed by the threshold
+        n_required = min(int(np.ceil(n_required * pilot_img.size
+                                     / pilot_results[3]["n_pixels"])),
+                         np.size(img))
+        n_samples = n_required if n_samples is None else \
+            min(n_samples, n_required)
+        print("Sampling {} pixels for standard error {}".format(n_samples,
+                                                                target_se))
+    if sampled:
+        with gaussquality_profile.stage(timings, "threshold"):
+            img = sample_pixels(img, n_samples, sampling)
+
+    if warm_start is not None:
+        warm_mu = np.asarray(warm_start[0], dtype=np.float64)
+        warm_var = np.asarray(warm_start[1], dtype=np.float64)**2 + 1e-6
+        warm_phi = np.asarray(warm_start[2], dtype=np.float64)
+        warm_phi = warm_phi / np.sum(warm_phi)
+
+    # candidate numbers of components, all fitted to the same grey values
+    candidates = [int(n) for n in np.atleast_1d(n_components)]
+
+    if histogram is True or isinstance(histogram, tuple):
+        if histogram is True:
+            with gaussquality_profile.stage(timings, "threshold"):
+                grey_values, counts = img_histogram(img, threshold=threshold,
+                                                    precision=precision)
+        else:
+            grey_values, counts = histogram
+        # each grey value is one weighted sample, which k-means cannot split
+        # between more components
+        if len(grey_values) < max(candidates):
+            if histogram is not True:
+                raise ValueError(
+                    "The histogram has {} grey values, fewer than the {} "
+                    "components to fit".format(len(grey_values),
+                                               max(candidates)))
+            print("Only {} grey values, fitting every pixel instead of the "
+                  "histogram".format(len(grey_values)))
+            histogram = False
+        else:
+            histogram = True
+            print("Image grey value range = {}-{}".format(
+                grey_values[0], grey_values[-1]))
+            n_pixels = int(np.sum(counts))
+    if histogram is not True:
+        # Apply a threshold to ignore values outside this (min, max), then
+        # convert the remaining pixels to floats once
+        with gaussquality_profile.stage(timings, "threshold"):
+            img = threshold_pixels(img, threshold)
+            img_range = (np.min(img), np.max(img))
+            img = float_pixels(img, allow_float32=engine != "sklearn")
+        print("Image grey value range = {}-{}".format(*img_range))
+        n_pixels = img.size
+
+    def fit_candidate(n):
+        # warm_start and mu_init only apply to candidates of the same size
+        warm = warm_start is not None and len(warm_mu) == n
+        means_init = None
+        if warm:
+            means_init = warm_mu
+        elif mu_init is not None and len(mu_init) == n:
+            means_init = np.array(mu_init, dtype=np.float64)
+
+        if warm:
+            GMM_model = make_GMM(n, engine, means_init=warm_mu,
+                                 weights_init=warm_phi,
+                                 variances_init=warm_var, weighted=histogram)
+        else:
+            GMM_model = make_GMM(n, engine, means_init=means_init,
+                                 weighted=histogram)
+
+        # Fit 1D array of image grey values, or histogram bins weighted by
+        # their counts
+        if histogram is True:
+            GMM_model.fit(grey_values.reshape(-1, 1), sample_weight=counts)
+        else:
+            GMM_model.fit(img.reshape(-1, 1))
+
+        # Unpack results
+        mu_fitted = GMM_model.means_.flatten().astype(np.float64)    # means
+        sigma_fitted = np.sqrt(GMM_model.covariances_).flatten().astype(
+            np.float64)                                              # stdev
+        phi_fitted = GMM_model.weights_.flatten().astype(np.float64) # weights
+        diagnostics = {"n_iter": GMM_model.n_iter_,
+                       "converged": GMM_model.converged_,
+                       "lower_bound": GMM_model.lower_bound_}
+        log_likelihood = None
+        if len(candidates) > 1:
+            if histogram is True:
+                log_likelihood = calc_log_likelihood(
+                    grey_values, counts, mu_fitted, sigma_fitted, phi_fitted)
+            else:
+                log_likelihood = GMM_model.score(img.reshape(-1, 1)) * n_pixels
+
+        if warm:
+            # Keep components in the same order as the previous fit
+            sort_ind = track_components((mu_fitted, sigma_fitted, phi_fitted),
+                                        warm_start)
+        else:
+            # Sort in ascending order of means
+            sort_ind = np.argsort(mu_fitted)
+        return (mu_fitted[sort_ind], sigma_fitted[sort_ind],
+                phi_fitted[sort_ind], diagnostics, log_likelihood)
+
+    with gaussquality_profile.stage(timings, "em"):
+        if len(candidates) == 1:
+            candidate_fits = [fit_candidate(candidates[0])]
+        else:
+            # fit candidates in threads, sharing the grey values in memory
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(candidates)) as pool:
+                candidate_fits = list(pool.map(fit_candidate, candidates))
+
+    best = 0
+    if len(candidates) > 1:
+        scores = np.array([calc_information_criterion(
+            fit[4], n, n_pixels, criterion)
+            for n, fit in zip(candidates, candidate_fits)])
+        best = int(np.argmin(scores))
+        for n, score in zip(candidates, scores):
+            print("n_components = {}: {} = {}".format(n, criterion, score))
+    mu_fitted, sigma_fitted, phi_fitted, diagnostics = candidate_fits[best][:4]
+    diagnostics["n_pixels"] = n_pixels
+    if len(candidates) > 1:
+        diagnostics["n_components"] = candidates[best]
+        diagnostics["scores"] = scores
+        # every candidate, padded with NaN to the largest, see
+        # `select_n_components`
+        for parameter, name in enumerate(("mu", "sigma", "phi")):
+            padded = np.full((len(candidates), max(candidates)), np.nan)
+            for i, fit in enumerate(candidate_fits):
+                padded[i, :candidates[i]] = fit[parameter]
+            diagnostics["candidate_" + name] = padded
+
+    if sampled:
+        diagnostics["se_mu"], diagnostics["se_sigma"], diagnostics["se_phi"] = \
+            calc_standard_errors(mu_fitted, sigma_fitted, phi_fitted,
+                                 diagnostics["n_pixels"])
 
     print("Time elapsed in s: {}".format(time.time()-start_time))
     print("Means = {}, Stdev = {}, Weights = {}".format(mu_fitted,
                                                         sigma_fitted,
                                                         phi_fitted))
+    if return_diagnostics is True:
+        return mu_fitted, sigma_fitted, phi_fitted, diagnostics
     return mu_fitted, sigma_fitted, phi_fitted
 
 
+def coarse_to_fine_order(n):
+    """
+    Orders `n` evenly spaced slices from coarse to fine: the centre, then the
+    two ends, then the midpoints of every gap in turn, so that the slices
+    fitted so far are always spread over the whole stack.
+
+    Parameters
+    ----------
+    n : int
+        Number of slices.
+
+    Returns
+    -------
+    order : list
+        Positions 0 to `n`-1 in the order to visit them.
+
+    """
+    if n < 1:
+        return []
+    centre = (n - 1) // 2
+    order = [centre] + [end for end in (0, n - 1) if end != centre]
+    gaps = collections.deque([(0, centre), (centre, n - 1)])
+    while len(gaps) > 0:
+        low, high = gaps.popleft()
+        if high - low < 2:
+            continue
+        middle = (low + high) // 2
+        order.append(middle)
+        gaps.extend([(low, middle), (middle, high)])
+    return order
+
+
+def _limit_worker_threads(n_threads=1):
+    """
+    Limits BLAS/OpenMP threads in a worker process so that parallel workers
+    do not oversubscribe the CPUs.
+
+    Parameters
+    ----------
+    n_threads : int, optional
+        Number of threads per worker. The default is 1.
+
+    Returns
+    -------
+    None.
+
+    """
+    for env_var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                    "NUMEXPR_NUM_THREADS"):
+        os.environ[env_var] = str(n_threads)
+    import threadpoolctl
+    threadpoolctl.threadpool_limits(n_threads)
+
+
+def _load_and_fit_GMM(index, banner, source, n_components, mask_percentage,
+                      img=None, profile=False, **kwargs):
+    """
+    Loads a single slice and fits a Gaussian mixture model to it. Used as the
+    unit of work for parallel fitting in `run_GMM_fit`.
+
+    Parameters
+    ----------
+    index : int
+        Index of the slice to fit in `source`.
+    banner : str
+        Message printed before the image is loaded.
+    source : gaussquality_io.VolumeSource
+        Volume to load the slice from.
+    n_components : int
+        Number of Gaussian components to fit to grey value distribution.
+    mask_percentage : float
+        Percentage of the image to consider, as a rectangle centred on `img`.
+    img : array-like, optional
+        The slice, if it has already been loaded. The default is None.
+    profile : bool or dict, optional
+        If True, time each stage and record the peak memory, returned as
+        `timings` in the diagnostics. Can also be a dict of timings already
+        recorded, e.g. the time to decode `img`. The default is False.
+    **kwargs
+        Keyword arguments passed to `fit_GMM`.
+
+    Returns
+    -------
+    tuple
+        Fitted `mu`, `sigma` and `phi`, see `fit_GMM`.
+
+    """
+    timings = None
+    if profile is True:
+        timings = {}
+    elif profile is not False:
+        timings = profile
+    print(banner)
+    with gaussquality_profile.peak_memory(timings):
+        if img is None:
+            with gaussquality_profile.stage(timings, "decode"):
+                img = source.read_slice(index, mask_percentage)
+        fitted = fit_GMM(img, n_components, timings=timings, **kwargs)
+    if timings is not None:
+        fitted[3]["timings"] = timings
+    return fitted
+
+
 def run_GMM_fit(img_dir, n_components, z_percentage=70,
-                n_runs=30, mask_percentage=70, threshold=None, mu_init=None):
+                n_runs=30, mask_percentage=70, threshold=None, mu_init=None,
+                histogram=False, precision=None, n_jobs=1, executor=None,
+                warm_start=False, n_samples=None, target_se=None,
+                sampling="random", criterion="bic", engine="sklearn",
+                tolerance=None,
+                confidence=0.95, min_runs=3, cache=None, prefetch=0,
+                callback=None, profiler=None, return_diagnostics=False):
     """
     Fit Gaussian mixture models to 2-D images in a 3-D image sequence.
 
     Parameters
     ----------
-    img_dir : str, path-like
-        Directory to image.
-    n_components : int
+    img_dir : str, path-like or VolumeSource
+        Directory to image, or a volume file or source, see
+        `gaussquality_io.open_volume`.
+    n_components : int or list
         Number of Gaussian components to fit to grey value distribution.
         Usually `n_components` = number of materials in the specimen image.
+        If a list or range, every candidate is fitted to each slice, see
+        `fit_GMM`, and the candidate with the lowest total `criterion` score
+        over the slices is returned for every slice, see
+        `select_n_components`. The choice for each slice alone is given by
+        the `n_components` diagnostic.
     z_percentage : float, optional
         Percentage of stack to consider in the z-direction
         Images will be taken evenly over this `z_percentage` centred in the
@@ -104,20 +913,115 @@ def run_GMM_fit(img_dir, n_components, z_percentage=70,
         (Min, Max) grey value to consider. The default is None.
     mu_init : list, optional
         List of initial mean values to use. The default is None.
+    histogram : bool, optional
+        If True, fit the grey value histogram of each image instead of every
+        pixel, see `fit_GMM`. The default is False.
+    precision : float, optional
+        Histogram bin width for float images, see `img_histogram`.
+        The default is None.
+    n_jobs : int, optional
+        Number of worker processes used to load and fit slices in parallel.
+        -1 or None uses all CPUs. BLAS/OpenMP threads are limited to one per
+        worker. The default is 1, which fits slices one at a time in this
+        process.
+    executor : concurrent.futures.Executor, optional
+        Executor to distribute slices over instead of creating a process pool,
+        `n_jobs` is ignored if given. The executor is not shut down.
+        The default is None.
+    warm_start : bool, optional
+        If True, initialise EM for each slice with the fitted parameters of
+        the previous slice, so that fits converge in fewer iterations.
+        Components are tracked from slice to slice with `track_components`,
+        so their order is set by the first slice. Slices are fitted in order,
+        so `n_jobs` must be 1 and `executor` None. The default is False.
+    n_samples : int, optional
+        Fit a sample of `n_samples` pixels from each slice, see `fit_GMM`.
+        The default is None.
+    target_se : float, optional
+        Fit a sample of pixels from each slice just large enough for the
+        relative standard errors to fall below `target_se`, see `fit_GMM`.
+        The default is None.
+    sampling : str, optional
+        How pixels are sampled, "random" or "stratified", see
+        `sample_pixels`. The default is "random".
+    criterion : str or callable, optional
+        Criterion to choose between candidate `n_components`, see
+        `calc_information_criterion`. The default is "bic".
+    engine : str, optional
+        EM engine, "sklearn", "numpy" or "numpy32", see `fit_GMM`.
+        The default is "sklearn".
+    tolerance : float, optional
+        If given, fit slices adaptively: the `n_runs` slices are visited from
+        coarse to fine, see `coarse_to_fine_order`, and fitting stops once
+        the `confidence` interval of the stack mean of every `mu`, `sigma`
+        and `phi` is narrower than +/- `tolerance` relative to the mean, e.g.
+        0.01 for 1%, or when all `n_runs` slices are fitted. Results are in
+        the order the slices were visited. Slices are fitted ahead of the
+        stopping check when `n_jobs` is not 1. Cannot be combined with
+        several `n_components`. The default is None, which fits every slice.
+    confidence : float, optional
+        Confidence level of the interval used with `tolerance`.
+        The default is 0.95.
+    min_runs : int, optional
+        Minimum number of slices to fit before stopping with `tolerance`.
+        The default is 3.
+    cache : gaussquality_cache.ResultCache or str, path-like, optional
+        Cache of per-slice results, or a directory to create one in. Slices
+        already fitted with the same data and parameters are read from the
+        cache instead of being fitted again, and new results are added as
+        each slice finishes, so interrupted runs can be resumed.
+        The default is None.
+    prefetch : int, optional
+        When slices are fitted in this process, the number of slices to read
+        ahead in a background thread while the current slice is fitted, see
+        `gaussquality_io.iter_slices`. The default is 0, which reads each
+        slice just before it is fitted.
+    callback : callable, optional
+        Called as `callback(run, n_runs, slice_number)` after each slice is
+        fitted, e.g. to report progress. If it returns True, fitting stops
+        and the results of the slices fitted so far are returned.
+        The default is None.
+    profiler : gaussquality_profile.Profiler, optional
+        Records the time of each stage and the fit diagnostics of every
+        slice, see `gaussquality_profile.Profiler`. The default is None,
+        which times nothing.
+    return_diagnostics : bool, optional
+        If True, also return fit diagnostics for each slice, including the
+        standard errors of sampled fits. The default is False.
 
     Returns
     -------
     fitted_results : list
         List containing fitted Gaussian properties `mu`, `sigma` and `phi`
         averaged across the stack.
-    iter_results : list
-        List containing dicts of fitted Gaussian properties for each 2-D image
-        considered.
+    iter_results : gaussquality_results.SliceResults
+        Fitted Gaussian properties and diagnostics for each 2-D image
+        considered. Unpacks to dicts of `mu`, `sigma` and `phi` keyed by
+        slice number.
+    diagnostics : dict
+        Only returned if `return_diagnostics` is True. Dict of diagnostics
+        returned by `fit_GMM`, e.g. `n_iter` or `se_mu`, each a dict keyed by
+        slice number. With `tolerance`, also `ci_width`, the largest relative
+        confidence interval half-width after each slice, and
+        `stopping_reason`, one of "converged", "budget" or "callback".
 
     """
+    if warm_start is True and (n_jobs != 1 or executor is not None):
+        raise ValueError("`warm_start` fits slices in order, so requires "
+                         "`n_jobs`=1 and no `executor`")
+    if tolerance is not None and np.ndim(n_components) > 0:
+        raise ValueError("`tolerance` requires a single `n_components`")
+
+    start_time = time.perf_counter()
+
+    if np.ndim(n_components) > 0:
+        n_components = [int(n) for n in n_components]
 
     # get number of slices
-    nslices = gaussquality_io.get_nslices(img_dir)
+    source = gaussquality_io.open_volume(img_dir)
+    nslices = source.nslices
+    if profiler is not None:
+        profiler.stack["list_time"] = time.perf_counter() - start_time
 
     # generate slice numbers to load, starting from centre and moving outwards
     central_slice = int(nslices/2)
@@ -125,48 +1029,324 @@ def run_GMM_fit(img_dir, n_components, z_percentage=70,
     min_z = int(central_slice - (z_range/2))
     max_z = int(central_slice + (z_range/2))
     run_slices = np.linspace(min_z, max_z, num=n_runs, dtype=int)
+    if tolerance is not None:
+        run_slices = run_slices[coarse_to_fine_order(n_runs)]
+    stopping_reason = "budget"
 
-    # Initialise empty dict to hold intermediate values of mu, sigma and phi
-    mus = {}
-    sigmas = {}
-    phis = {}
+    # Initialise empty list to hold the results of each slice
+    fits = []
 
     # Fit GMMs to slices in run_slices
-    for run in range(n_runs):
-        print("\nRun {}, Slice {}".format(run+1, run_slices[run]))
-        # load single slice of image
-        img_filepath = gaussquality_io.get_img_filepath(img_dir, run_slices[run] - 1)
-        img = gaussquality_io.load_img(img_filepath, mask_percentage=mask_percentage)
-
-        # fit GMM and get fitted parameters (mu, sigma, phi)
-        if threshold is not None:
-            mu_fitted, sigma_fitted, phi_fitted = fit_GMM(img,
-                                                          n_components,
-                                                          threshold=threshold,
-                                                          mu_init=mu_init)
+    indices = [run_slice - 1 for run_slice in run_slices]
+    banners = ["\nRun {}, Slice {}".format(run+1, run_slices[run])
+               for run in range(n_runs)]
+    fit_params = {"n_components": n_components,
+                  "mask_percentage": mask_percentage,
+                  "threshold": threshold,
+                  "mu_init": mu_init,
+                  "histogram": histogram,
+                  "precision": precision,
+                  "n_samples": n_samples,
+                  "target_se": target_se,
+                  "sampling": sampling,
+                  "criterion": criterion,
+                  "engine": engine}
+    fit_slice = functools.partial(_load_and_fit_GMM, source=source,
+                                  return_diagnostics=True,
+                                  profile=profiler is not None, **fit_params)
+    if cache is not None and \
+            not isinstance(cache, gaussquality_cache.ResultCache):
+        cache = gaussquality_cache.ResultCache(cache)
+
+    def cached_fit(run, params):
+        # look up a slice in the cache, returns the key and cached result
+        nonlocal cache
+        if cache is None:
+            return None, None
+        try:
+            key = cache.key(source, indices[run], params)
+        except TypeError as error:
+            print("Not caching results, the fit parameters cannot be "
+                  "identified: {}".format(error))
+            cache = None
+            return None, None
+        fitted = cache.get(key)
+        if fitted is not None:
+            print(banners[run] + " (cached)")
+        return key, fitted
+
+    def profiled(run, fitted, cached=False):
+        # timings are not cached, so remove them before caching the result
+        timings = fitted[3].pop("timings", None)
+        if profiler is not None:
+            profiler.add(run_slices[run], timings, fitted[3], cached=cached)
+
+    def decode_timed(images):
+        # time reading each slice in this process, including waiting for
+        # prefetched slices
+        images = iter(images)
+        while True:
+            timings = {} if profiler is not None else None
+            with gaussquality_profile.stage(timings, "decode"):
+                img = next(images, None)
+            if img is None:
+                return
+            yield img, False if timings is None else timings
+
+    def warm_started_fits(images):
+        previous = None
+        for run, (img, timings) in zip(range(n_runs), decode_timed(images)):
+            key, fitted = cached_fit(run, dict(fit_params,
+                                               warm_start=previous))
+            if fitted is None:
+                fitted = fit_slice(indices[run], banners[run], img=img,
+                                   warm_start=previous, profile=timings)
+                profiled(run, fitted)
+                if cache is not None:
+                    cache.put(key, fitted)
+            else:
+                profiled(run, fitted, cached=True)
+            previous = fitted[:3]
+            yield fitted
+
+    def merged_fits(cached, computed):
+        # merge cached and newly computed results in order of run_slices
+        for run, (key, fitted) in enumerate(cached):
+            if fitted is None:
+                fitted = next(computed)
+                profiled(run, fitted)
+                if cache is not None:
+                    cache.put(key, fitted)
+            else:
+                profiled(run, fitted, cached=True)
+            yield fitted
+
+    with contextlib.ExitStack() as stack:
+        if profiler is not None:
+            stack.enter_context(profiler.tracing())
+        if warm_start is True:
+            # the cache key depends on the previous fit, so read every slice
+            images = stack.enter_context(contextlib.closing(
+                gaussquality_io.iter_slices(source, indices, mask_percentage,
+                                            prefetch)))
+            slice_results = warm_started_fits(images)
         else:
-            mu_fitted, sigma_fitted, phi_fitted = fit_GMM(img, n_components, mu_init=mu_init)
-
-        mus[run_slices[run]] = mu_fitted
-        sigmas[run_slices[run]] = sigma_fitted
-        phis[run_slices[run]] = phi_fitted
-
-        if run == n_runs-1:
-            # calculate mean values across stack
-            mu_mean = []
-            sigma_mean = []
-            phi_mean = []
-            for material in range(len(mu_fitted)):
-                temp_mu = []
-                temp_sigma = []
-                temp_phi = []
-                for run in range(len(mus)):
-                    temp_mu.append(mus[run_slices[run]][material])
-                    temp_sigma.append(sigmas[run_slices[run]][material])
-                    temp_phi.append(phis[run_slices[run]][material])
-                mu_mean.append(np.mean(temp_mu))
-                sigma_mean.append(np.mean(temp_sigma))
-                phi_mean.append(np.mean(temp_phi))
-
-            # return mean values when n_runs is reached
-            return [mu_mean, sigma_mean, phi_mean], [mus, sigmas, phis]
+            cached = [cached_fit(run, fit_params) for run in range(n_runs)]
+            missing = [run for run in range(n_runs) if cached[run][1] is None]
+            if executor is None and n_jobs != 1 and len(missing) > 0:
+                max_workers = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=_limit_worker_threads)
+                # drop queued slices if fitting is stopped by `callback`
+                stack.callback(executor.shutdown, wait=True,
+                               cancel_futures=True)
+            if executor is not None:
+                computed = executor.map(fit_slice,
+                                        [indices[run] for run in missing],
+                                        [banners[run] for run in missing])
+            else:
+                images = stack.enter_context(contextlib.closing(
+                    gaussquality_io.iter_slices(
+                        source, [indices[run] for run in missing],
+                        mask_percentage, prefetch)))
+                computed = (fit_slice(indices[run], banners[run], img=img,
+                                      profile=timings)
+                            for run, (img, timings) in zip(
+                                missing, decode_timed(images)))
+            slice_results = merged_fits(cached, iter(computed))
+
+        for run, fitted in enumerate(slice_results):
+            fits.append(fitted)
+            if tolerance is not None:
+                # running confidence interval of the stack means
+                running = gaussquality_results.SliceResults.from_fits(
+                    run_slices[:run + 1], [fit[:3] for fit in fits])
+                fitted[3]["ci_width"] = float(np.max([
+                    half_width / np.abs(mean) for half_width, mean in zip(
+                        running.confidence_interval(confidence),
+                        running.mean())]))
+                print("Relative confidence interval +/- {}".format(
+                    fitted[3]["ci_width"]))
+            if callback is not None and callback(run + 1, n_runs,
+                                                 run_slices[run]):
+                stopping_reason = "callback"
+                print("\nStopped after {} of {} runs".format(run + 1, n_runs))
+                break
+            if tolerance is not None and run + 1 >= min_runs and \
+                    fitted[3]["ci_width"] < tolerance:
+                stopping_reason = "converged"
+                print("\nConverged to +/- {} after {} of {} runs".format(
+                    tolerance, run + 1, n_runs))
+                break
+
+    if np.ndim(n_components) > 0 and len(fits) > 0:
+        fits, n_selected = select_n_components(fits, n_components)
+
+    # calculate mean values across stack
+    iter_results = gaussquality_results.SliceResults.from_fits(
+        run_slices[:len(fits)], fits)
+    fitted_results = [parameter.tolist() for parameter in iter_results.mean()]
+    if profiler is not None:
+        profiler.stack["total_time"] = time.perf_counter() - start_time
+
+    if return_diagnostics is True:
+        diagnostics = iter_results.diagnostics_dicts()
+        if tolerance is not None:
+            diagnostics["stopping_reason"] = stopping_reason
+        return fitted_results, iter_results, diagnostics
+    return fitted_results, iter_results
+
+
+def run_full_stack_fit(img_dir, n_components, save_filepath,
+                       mask_percentage=70, prefetch=2, n_jobs=1,
+                       max_in_flight=None, callback=None, **kwargs):
+    """
+    Fits a Gaussian mixture model to every slice of a 3-D image sequence,
+    e.g. to find reconstruction artefacts, streaming through the slices in
+    order.
+
+    Slices are read ahead sequentially, see `gaussquality_io.iter_slices`,
+    and at most `max_in_flight` slices are held in memory while they are
+    fitted, so memory use does not depend on the number of slices. Results
+    are written to a preallocated memory-mapped .npy file as each slice
+    finishes. Slices not yet fitted are NaN, and if `save_filepath` already
+    holds results for the same stack and fit arguments, only those slices
+    are fitted, so an interrupted run can be resumed with the same
+    arguments. The stack and arguments are identified by a key saved next to
+    the results, `<save_filepath without .npy>_key.json`, see
+    `gaussquality_cache.make_key`. Results of a different stack or
+    arguments are overwritten.
+
+    Parameters
+    ----------
+    img_dir : str, path-like or VolumeSource
+        Directory to image, or a volume file or source, see
+        `gaussquality_io.open_volume`.
+    n_components : int
+        Number of Gaussian components to fit to grey value distribution.
+    save_filepath : str, path-like
+        .npy file to save the results to.
+    mask_percentage : float, optional
+        Percentage of each slice to consider, as a rectangle centred in the
+        x-y plane. The default is 70.
+    prefetch : int, optional
+        Number of slices to read ahead while fitting. The default is 2.
+    n_jobs : int, optional
+        Number of worker processes used to fit slices in parallel. -1 or None
+        uses all CPUs. The default is 1, which fits slices one at a time in
+        this process.
+    max_in_flight : int, optional
+        Maximum number of slices sent to worker processes and not yet
+        written. The default is None, which is 2 * `n_jobs`.
+    callback : callable, optional
+        Called as `callback(n_fitted, nslices, slice_number)` after each slice
+        is written. If it returns True, fitting stops, keeping the slices
+        written so far. The default is None.
+    **kwargs
+        Keyword arguments passed to `fit_GMM`, e.g. `threshold`, `histogram`
+        or `engine`.
+
+    Returns
+    -------
+    results : np.memmap
+        Fitted `mu`, `sigma` and `phi` of every slice, shape
+        (slices, 3, n_components). Row i is slice number i + 1.
+
+    """
+    source = gaussquality_io.open_volume(img_dir)
+    nslices = source.nslices
+    shape = (nslices, 3, n_components)
+
+    # identify the stack and fit arguments the results belong to
+    try:
+        fit_key = gaussquality_cache.make_key(
+            [source.slice_identity(index) for index in range(nslices)],
+            dict(kwargs, n_components=n_components,
+                 mask_percentage=mask_percentage))
+    except TypeError as error:
+        print("Cannot resume, the fit arguments cannot be identified: "
+              "{}".format(error))
+        fit_key = None
+    key_filepath = os.path.splitext(save_filepath)[0] + "_key.json"
+    saved_key = None
+    if os.path.exists(save_filepath) and os.path.exists(key_filepath):
+        with open(key_filepath, "r") as infile:
+            saved_key = json.load(infile).get("key")
+
+    if fit_key is not None and saved_key == fit_key:
+        results = np.load(save_filepath, mmap_mode="r+")
+    else:
+        if os.path.exists(save_filepath):
+            print("{} holds results of a different stack or fit, fitting "
+                  "every slice".format(save_filepath))
+        results = np.lib.format.open_memmap(save_filepath, mode="w+",
+                                            dtype=np.float64, shape=shape)
+        results[:] = np.nan
+        results.flush()
+        with open(key_filepath, "w") as outfile:
+            json.dump({"key": fit_key}, outfile)
+    indices = np.flatnonzero(np.isnan(results[:, 0, 0])).tolist()
+    print("Fitting {} of {} slices".format(len(indices), nslices))
+    n_fitted = nslices - len(indices)
+
+    fit_slice = functools.partial(fit_GMM, n_components=n_components,
+                                  **kwargs)
+    with contextlib.ExitStack() as stack:
+        images = stack.enter_context(contextlib.closing(
+            gaussquality_io.iter_slices(source, indices, mask_percentage,
+                                        prefetch)))
+        if n_jobs == 1:
+            fitted_slices = (fit_slice(img) for img in images)
+        else:
+            max_workers = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+            if max_in_flight is None:
+                max_in_flight = 2 * max_workers
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_limit_worker_threads)
+            stack.callback(executor.shutdown, wait=True, cancel_futures=True)
+            fitted_slices = _bounded_map(executor, fit_slice, images,
+                                         max_in_flight)
+
+        for index, fitted in zip(indices, fitted_slices):
+            results[index] = fitted[:3]
+            results.flush()
+            n_fitted += 1
+            if callback is not None and callback(n_fitted, nslices,
+                                                 index + 1):
+                print("\nStopped after {} of {} slices".format(n_fitted,
+                                                              nslices))
+                break
+    return results
+
+
+def _bounded_map(executor, fn, iterable, max_in_flight):
+    """
+    Maps `fn` over `iterable` with `executor` in order, like
+    `executor.map`, but takes items from `iterable` only while fewer than
+    `max_in_flight` results are pending.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        Executor to run `fn` with.
+    fn : callable
+        Function to call with each item.
+    iterable : iterable
+        Items to call `fn` with, e.g. slices read ahead.
+    max_in_flight : int
+        Maximum number of pending results.
+
+    Yields
+    ------
+    result
+        Result of `fn` for each item, in order.
+
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
@@ -1,20 +1,21 @@
 import os
-import sys
-import json
 import datetime
+import queue
+import threading
+import traceback
 import tkinter as tk
 from tkinter import filedialog
+from tkinter import messagebox
 from tkinter import ttk
-from ttkthemes import ThemedTk
 from tkinter import font
-import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
 
 from gaussquality import gaussquality_io
 from gaussquality import gaussquality_fitting
 from gaussquality import gaussquality_calc
-from gaussquality import gaussquality_visuals
+from gaussquality import gaussquality_log
+
+LOGO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo")
+
 
 class gaussquality_gui(tk.Frame):
 
@@ -28,11 +29,17 @@ class gaussquality_gui(tk.Frame):
         self.thresholds = None
         self.snr_cnr_bg = None
         self.snr_cnr_feature = None
+        self.img_dir = None
+        self.volume = None
+        self.save_dir = None
+        self.fit_queue = queue.Queue()
+        self.cancel_event = threading.Event()
     
     def create_widgets(self):
         
         # Headers
-        self.logo = tk.PhotoImage(file="logo/gaussquality_logo_greybg_50x50.pnm")
+        self.logo = tk.PhotoImage(
+            file=os.path.join(LOGO_DIR, "gaussquality_logo_greybg_50x50.pnm"))
         ttk.Label(self.root, image=self.logo).grid(row=0, column=0, rowspan=2)
         ttk.Label(self.root, 
                   text="GaussQuality: Image quality evaluation with Gaussian Mixture Models",
@@ -53,6 +60,11 @@ class gaussquality_gui(tk.Frame):
                    command=self.get_img_dir,
                    style="TButton"
                    ).grid(row=3, column=0, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
+        ttk.Button(self.root,
+                   text="Load a volume file",
+                   command=self.get_volume_file,
+                   style="TButton"
+                   ).grid(row=3, column=4, sticky="NWES", ipadx=10, ipady=5)
         ttk.Button(self.root,
                    text="Set save directory", 
                    command=self.set_save_dir,
@@ -163,32 +175,43 @@ class gaussquality_gui(tk.Frame):
                    ).grid(row=13, column=4, sticky="NWS")
 
         # Run GaussQuality
-        ttk.Button(self.root,
-                   text="Run GaussQuality (this could take a while)",
-                   command=self.run_gaussquality,
-                   style="TButton"
-                   ).grid(row=14, column=0, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
+        self.run_button = ttk.Button(self.root,
+                                     text="Run GaussQuality",
+                                     command=self.run_gaussquality,
+                                     style="TButton")
+        self.run_button.grid(row=14, column=0, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
+        self.cancel_button = ttk.Button(self.root,
+                                        text="Cancel",
+                                        command=self.cancel_gaussquality,
+                                        style="TButton",
+                                        state="disabled")
+        self.cancel_button.grid(row=14, column=2, sticky="NWES", ipadx=10, ipady=5)
+        self.progress = ttk.Progressbar(self.root, mode="determinate")
+        self.progress.grid(row=14, column=3, columnspan=2, sticky="WE")
 
         # Plot results
         ttk.Label(self.root,
                   text="Step 3: Plotting",
                   font=("Helvetica", 12, "bold")
                   ).grid(row=15, column=0, columnspan=3, sticky="NWES", ipadx=10, ipady=5)
-        ttk.Button(self.root,
+        self.results_buttons = []
+        self.results_buttons.append(ttk.Button(self.root,
                    text="Plot central image and histogram",
                    command=self.plot_image_and_histo,
-                   style="TButton"
-                   ).grid(row=16, column=0, columnspan=2, sticky="NWS", ipadx=10, ipady=5)
-        # self.img_histo_icon = tk.PhotoImage(file="logo/img_and_histo_200x100.pnm")
+                   style="TButton",
+                   state="disabled"))
+        self.results_buttons[-1].grid(row=16, column=0, columnspan=2, sticky="NWS", ipadx=10, ipady=5)
+        # self.img_histo_icon = tk.PhotoImage(file=os.path.join(LOGO_DIR, "img_and_histo_200x100.pnm"))
         # ttk.Label(self.root,
         #           image=self.img_histo_icon
         #          ).grid(row=17, column=0, columnspan=2)
-        ttk.Button(self.root,
+        self.results_buttons.append(ttk.Button(self.root,
                    text="Plot slice variation",
                    command=self.plot_slice_variation,
-                   style="TButton"
-                   ).grid(row=16, column=2, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
-        # self.slice_var_icon = tk.PhotoImage(file="logo/slice_var_200x100.pnm")
+                   style="TButton",
+                   state="disabled"))
+        self.results_buttons[-1].grid(row=16, column=2, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
+        # self.slice_var_icon = tk.PhotoImage(file=os.path.join(LOGO_DIR, "slice_var_200x100.pnm"))
         # ttk.Label(self.root,
         #           image=self.slice_var_icon
         #           ).grid(row=17, column=2, columnspan=2)
@@ -223,40 +246,62 @@ class gaussquality_gui(tk.Frame):
                    command=self.update_materials,
                    style="TButton"
                    ).grid(row=20, column=4, sticky="NWS")
-        ttk.Button(self.root,
+        self.results_buttons.append(ttk.Button(self.root,
                    text="Calculate SNR and CNR",
                    command=self.calc_snr_cnr,
-                   style="TButton"
-                   ).grid(row=21, column=0, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
+                   style="TButton",
+                   state="disabled"))
+        self.results_buttons[-1].grid(row=21, column=0, columnspan=2, sticky="NWES", ipadx=10, ipady=5)
         
 
     def get_img_dir(self):
-        self.img_dir = filedialog.askdirectory()
-        print("{} loaded".format(self.img_dir))
+        img_dir = filedialog.askdirectory()
+        if not img_dir:
+            return
+        self.img_dir = img_dir
+        self.volume = gaussquality_io.open_volume(self.img_dir)
+        print("{} loaded, {} slices".format(self.img_dir,
+                                            self.volume.nslices))
+
+    def get_volume_file(self):
+        img_dir = filedialog.askopenfilename(
+            filetypes=[("Volumes", "*.tif *.tiff *.h5 *.hdf5 *.hdf"),
+                       ("All files", "*.*")])
+        if not img_dir:
+            return
+        self.img_dir = img_dir
+        self.volume = gaussquality_io.open_volume(self.img_dir)
+        print("{} loaded, {} slices".format(self.img_dir,
+                                            self.volume.nslices))
     
     def set_save_dir(self):
         self.save_dir = filedialog.askdirectory()
+        if self.save_dir:
+            gaussquality_log.set_log_dir(self.save_dir)
         print("Save directory is {}".format(self.save_dir))
 
     
     def preview(self):
+        if self.volume is None:
+            messagebox.showerror("GaussQuality", "No image sequence selected")
+            return
+        import matplotlib.pyplot as plt
+        from gaussquality import gaussquality_visuals
         print("Loading preview")
-        central_slice = int(0.5*gaussquality_io.get_nslices(self.img_dir))
-        self.central_img_filepath = gaussquality_io.get_img_filepath(self.img_dir, central_slice)
+        central_slice = int(0.5*gaussquality_io.get_nslices(self.volume))
         plt.figure()
         plt.subplot(121)
-        img = gaussquality_io.load_img(self.central_img_filepath,
+        img = gaussquality_io.load_img(self.volume,
                                        show_image=True,
-                                       mask_percentage=self.mask_percentage.get())
+                                       mask_percentage=self.mask_percentage.get(),
+                                       index=central_slice)
         plt.title("Slice {}\nMask percentage {}".format(
             central_slice, self.mask_percentage.get()))
         plt.axis('off')
         plt.subplot(122)
-        plt.hist(img.flatten(),
-                 bins=int(0.45*len(img.flatten())**0.5),
-                 density=True,
-                 histtype="stepfilled",
-                 alpha=0.5)
+        density, bin_edges = gaussquality_visuals.histogram_density(img,
+                                                                    c_bin=0.45)
+        plt.stairs(density, bin_edges, fill=True, alpha=0.5)
         plt.xlabel("Grey values")
         plt.ylabel("Probability density")
         plt.tight_layout()
@@ -268,10 +313,12 @@ class gaussquality_gui(tk.Frame):
     
     
     def run_gaussquality(self):
-        if self.img_dir is None:
-            raise ValueError("No image sequence selected")
-        if self.save_dir is None:
-            raise ValueError("No save directory set")
+        if self.volume is None:
+            messagebox.showerror("GaussQuality", "No image sequence selected")
+            return
+        if not self.save_dir:
+            messagebox.showerror("GaussQuality", "No save directory set")
+            return
         print("Running Gaussquality with...")
         print("Image directory: {}".format(self.img_dir))
         print("Number of components: {}".format(self.n_components.get()))
@@ -279,14 +326,67 @@ class gaussquality_gui(tk.Frame):
         print("Percentage of stack in z: {}".format(self.z_percentage.get()))
         print("Percentage of image to use in xy: {}".format(self.mask_percentage.get()))
         print("Threshold: {}".format(self.thresholds))
-        self.stack_results, self.slice_results = gaussquality_fitting.run_GMM_fit(
-                                            self.img_dir, 
-                                            self.n_components.get(),
-                                            self.z_percentage.get(),
-                                            self.n_runs.get(),
-                                            self.mask_percentage.get(),
-                                            self.thresholds)
+
+        # fit in a background thread so the window stays responsive
+        self.run_button.state(["disabled"])
+        self.cancel_button.state(["!disabled"])
+        for button in self.results_buttons:
+            button.state(["disabled"])
+        self.progress.configure(maximum=self.n_runs.get(), value=0)
+        self.cancel_event.clear()
+        fit_args = (self.volume,
+                    self.n_components.get(),
+                    self.z_percentage.get(),
+                    self.n_runs.get(),
+                    self.mask_percentage.get(),
+                    self.thresholds)
+        threading.Thread(target=self.fit_worker, args=fit_args, daemon=True).start()
+        self.root.after(100, self.poll_fit_queue)
+
+    def fit_worker(self, *fit_args):
+        # runs in the background thread, only communicates through the queue
+        def report_progress(run, n_runs, slice_number):
+            self.fit_queue.put(("progress", run))
+            return self.cancel_event.is_set()
+        try:
+            results = gaussquality_fitting.run_GMM_fit(*fit_args, callback=report_progress)
+            self.fit_queue.put(("done", results))
+        except Exception as error:
+            self.fit_queue.put(("error", error))
+
+    def poll_fit_queue(self):
+        while True:
+            try:
+                message, value = self.fit_queue.get_nowait()
+            except queue.Empty:
+                self.root.after(100, self.poll_fit_queue)
+                return
+            if message == "progress":
+                self.progress.configure(value=value)
+            else:
+                break
+        self.run_button.state(["!disabled"])
+        self.cancel_button.state(["disabled"])
+        if message == "error":
+            # the exception keeps its traceback from the background thread
+            gaussquality_log.get_logger().error(
+                "GaussQuality failed:\n" + "".join(traceback.format_exception(
+                    type(value), value, value.__traceback__)).rstrip())
+            messagebox.showerror("GaussQuality failed", "{}: {}".format(
+                type(value).__name__, value))
+            return
+        self.stack_results, self.slice_results = value
+        if self.cancel_event.is_set():
+            print("Cancelled, keeping results of {} slices".format(
+                len(self.slice_results[0])))
         self.save_results()
+        for button in self.results_buttons:
+            button.state(["!disabled"])
+
+    def cancel_gaussquality(self):
+        self.cancel_event.set()
+        self.cancel_button.state(["disabled"])
+        print("Cancelling after the current slice...")
 
     def save_results(self):
         # save input args
@@ -296,13 +396,11 @@ class gaussquality_gui(tk.Frame):
                 "z_percentage": self.z_percentage.get(),
                 "mask_percentage": self.mask_percentage.get(),
                 "threshold": self.thresholds}
-        args_outfile = os.path.join(self.save_dir,
-                                    "{}_{}_input.json".format(
-                                        self.prefix.get(),
-                                        datetime.datetime.now().strftime("%Y%m%d_%H%M")
-                                    ))
-        with open(args_outfile, "w") as outfile:
-            json.dump(args, outfile, indent=4)
+        args_outfile = gaussquality_io.save_input_args(
+            args,
+            self.save_dir,
+            "{}_{}".format(self.prefix.get(),
+                           datetime.datetime.now().strftime("%Y%m%d_%H%M")))
         print("Input arguments saved to {}".format(args_outfile))
 
         # save stack results
@@ -329,18 +427,22 @@ class gaussquality_gui(tk.Frame):
             self.time_prefix))
 
     def plot_image_and_histo(self):
-        central_slice = int(0.5*gaussquality_io.get_nslices(self.img_dir))
-        self.central_img_filepath = gaussquality_io.get_img_filepath(self.img_dir, central_slice)
+        import matplotlib.pyplot as plt
+        from gaussquality import gaussquality_visuals
+        central_slice = int(0.5*gaussquality_io.get_nslices(self.volume))
         gaussquality_visuals.plot_img_and_histo(
-            self.central_img_filepath,
+            self.volume,
             self.mask_percentage.get(),
             self.stack_results,
             self.thresholds,
-            self.material_names
+            self.material_names,
+            index=central_slice
         )
         plt.show()
 
     def plot_slice_variation(self):
+        import matplotlib.pyplot as plt
+        from gaussquality import gaussquality_visuals
         gaussquality_visuals.plot_slice_variation(
             self.stack_results,
             self.slice_results,
@@ -365,49 +467,50 @@ class gaussquality_gui(tk.Frame):
         self.cnr = gaussquality_calc.calc_cnr_stack(self.slice_results, 
                                                     self.snr_cnr_bg, 
                                                     self.snr_cnr_feature)
-        snr_cnr_array = np.zeros((len(self.snr), 3))
-        snr_cnr_array[:,0] = list(self.snr.keys())
-        snr_cnr_array[:,1] = list(self.snr.values())
-        snr_cnr_array[:,2] = list(self.cnr.values())
-        snr_cnr_df = pd.DataFrame(snr_cnr_array,
-                                  columns=["Slice", "SNR", "CNR"])
         # save snr and cnr
-        snr_cnr_outfile = os.path.join(self.save_dir,
-                                       "{}_BG{}-F{}_snr_cnr.csv".format(
-                                       self.time_prefix,
-                                       self.snr_cnr_bg,
-                                       self.snr_cnr_feature 
-                                       ))
-        pd.DataFrame(snr_cnr_df).to_csv(snr_cnr_outfile, index=False)
+        snr_cnr_outfile = gaussquality_io.save_SNR_CNR_slice_results(
+            self.snr,
+            self.cnr,
+            self.save_dir,
+            self.time_prefix,
+            self.snr_cnr_bg,
+            self.snr_cnr_feature)
         print("Slice-by-slice SNR and CNR saved to {}".format(
             snr_cnr_outfile))
 
-class StdoutRedirector(object):
-    def __init__(self, text_area):
-        self.text_area = text_area
-    def write(self, str):
-        self.text_area.insert("end", str)
-    def flush(self):
-        pass
-
-
 def redirector(inputStr=""):
     root = tk.Toplevel()
     root.configure(background="#424242")
     T = tk.Text(root)
-    sys.stdout = StdoutRedirector(T)
-    sys.stderr = StdoutRedirector(T)
     T.pack()
     T.insert("end", "------- GaussQuality Log --------\n")
     T.insert("end", inputStr)
+    # printed output is logged, and shown in batches from the main loop
+    gaussquality_log.redirect_output()
+    return gaussquality_log.TextLogSink(T)
+
+
+def main():
+    """
+    Starts the GaussQuality GUI and runs until its window is closed.
+
+    Returns
+    -------
+    None.
+
+    """
+    from ttkthemes import ThemedTk
+    root = ThemedTk(theme="black")
+    style = ttk.Style()
+    font_label = font.Font(size=11)
+    style.configure("TLabel", background="#555555", font=font_label)
+    font_button = font.Font(size=12)
+    style.configure("TButton", font=font_button)
+    gaussquality_gui(root)
+    r = redirector()
+    root.configure(background="#555555")
+    root.mainloop()
+
 
-root = ThemedTk(theme="black")
-style = ttk.Style()
-font_label = font.Font(size=11)
-style.configure("TLabel", background="#555555", font=font_label)
-font_button = font.Font(size=12)
-style.configure("TButton", font=font_button)
-gaussquality_gui(root)
-r = redirector()
-root.configure(background="#555555")
-root.mainloop()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
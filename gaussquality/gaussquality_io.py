@@ -9,27 +9,239 @@ Created on Mon Jan 25 14:50:04 2021
 
 import os
 import json
-import pandas as pd
-import matplotlib.pyplot as plt
-import skimage.io
+import hashlib
+import struct
+import zipfile
+import tempfile
+import queue
+import threading
+import numpy as np
 import datetime
 
+from gaussquality import gaussquality_results
 
-def get_img_list(img_dir):
+
+class VolumeSource(object):
     """
-    Gets list of .tiff images in an image sequence folder.
+    Base class for a 3-D image which is read one z-slice at a time.
+
+    Subclasses set `path`, `nslices`, `shape` and `dtype` and implement
+    `read_slice`. Use `open_volume` to get the source for a path.
+
+    Attributes
+    ----------
+    path : str, path-like
+        Path to the image sequence folder or volume file.
+    nslices : int
+        Number of z-slices in the volume.
+    shape : tuple
+        Shape of each 2-D slice.
+    dtype : numpy.dtype
+        dtype of the image grey values.
+
+    """
+
+    def __repr__(self):
+        return "{}({!r}, nslices={})".format(type(self).__name__, self.path,
+                                             self.nslices)
+
+    def read_slice(self, index, mask_percentage=100.):
+        """
+        Reads the central `mask_percentage` of a single z-slice.
+
+        Parameters
+        ----------
+        index : int
+            Index of the z-slice, from 0.
+        mask_percentage : float, optional
+            Percentage of the slice to read, as a rectangle centred in the x-y
+            plane. The default is 100.
+
+        Returns
+        -------
+        masked_img : array-like
+            2-D array identical to masking the whole slice with `mask_img`.
+
+        """
+        raise NotImplementedError
+
+    def slice_identity(self, index, hash_content=False):
+        """
+        Identifies the data of a single z-slice, e.g. for caching results.
+
+        Parameters
+        ----------
+        index : int
+            Index of the z-slice, from 0.
+        hash_content : bool, optional
+            If True, include a SHA-256 hash of the slice grey values, which
+            detects changes that do not alter the file size or modification
+            time. The default is False.
+
+        Returns
+        -------
+        dict
+            Path, dataset, index, size and modification time of the file
+            containing the slice, and optionally its content hash.
+
+        """
+        file_stat = os.stat(self.path)
+        identity = {"path": os.path.abspath(self.path),
+                    "dataset": getattr(self, "dataset", None),
+                    "index": int(index),
+                    "size": file_stat.st_size,
+                    "mtime_ns": file_stat.st_mtime_ns}
+        if hash_content is True:
+            img = np.ascontiguousarray(self.read_slice(index))
+            identity["sha256"] = hashlib.sha256(img).hexdigest()
+        return identity
+
+
+class StackIndex(VolumeSource):
+    """
+    Index of an image sequence folder, built once so that the folder does not
+    have to be listed again for every slice.
+
+    Holds the sorted list of .tiff images, the size and modification time of
+    each image and the image shape and dtype, which are read from the header of
+    the first image when first needed. Use `get_stack_index` to get a cached
+    index which is rebuilt when the folder's modification time changes.
 
     Parameters
     ----------
     img_dir : str, path-like
         Path to folder containing single images.
 
+    Attributes
+    ----------
+    img_dir : str, path-like
+        Path to folder containing single images.
+    img_list : list
+        List of image filenames in the folder in ascending order.
+    sizes : list
+        Size in bytes of each image in `img_list`.
+    mtimes : list
+        Modification time in ns of each image in `img_list`.
+    dir_mtime : int
+        Modification time in ns of `img_dir` when the index was built.
+
+    """
+
+    def __init__(self, img_dir):
+        self.img_dir = img_dir
+        self.dir_mtime = os.stat(img_dir).st_mtime_ns
+        entries = sorted((entry.path, entry) for entry in os.scandir(img_dir)
+                         if entry.name.lower().endswith((".tif", ".tiff")))
+        self.img_list = [path for path, entry in entries]
+        stats = [entry.stat() for path, entry in entries]
+        self.sizes = [stat.st_size for stat in stats]
+        self.mtimes = [stat.st_mtime_ns for stat in stats]
+        self._shape = None
+        self._dtype = None
+
+    @property
+    def path(self):
+        """str, path-like: Path to the image sequence folder."""
+        return self.img_dir
+
+    @property
+    def nslices(self):
+        """int: Number of images in the sequence."""
+        return len(self.img_list)
+
+    @property
+    def shape(self):
+        """tuple: Shape of the images, read from the first image header."""
+        if self._shape is None:
+            self._read_header()
+        return self._shape
+
+    @property
+    def dtype(self):
+        """numpy.dtype: dtype of the images, read from the first image header."""
+        if self._dtype is None:
+            self._read_header()
+        return self._dtype
+
+    def _read_header(self):
+        import tifffile
+        with tifffile.TiffFile(self.img_list[0]) as tif:
+            self._shape = tif.pages[0].shape
+            self._dtype = tif.pages[0].dtype
+
+    def is_stale(self):
+        """
+        Checks whether the folder has changed since the index was built.
+
+        Returns
+        -------
+        bool
+            True if the modification time of `img_dir` has changed.
+
+        """
+        return os.stat(self.img_dir).st_mtime_ns != self.dir_mtime
+
+    def read_slice(self, index, mask_percentage=100.):
+        return load_img(self.img_list[index], mask_percentage=mask_percentage)
+
+    def slice_identity(self, index, hash_content=False):
+        identity = {"path": os.path.abspath(self.img_list[index]),
+                    "size": self.sizes[index],
+                    "mtime_ns": self.mtimes[index]}
+        if hash_content is True:
+            with open(self.img_list[index], "rb") as img_file:
+                identity["sha256"] = hashlib.sha256(img_file.read()).hexdigest()
+        return identity
+
+
+_stack_index_cache = {}
+
+
+def get_stack_index(img_dir):
+    """
+    Gets a cached `StackIndex` for an image sequence folder. The index is
+    rebuilt if the folder's modification time has changed since it was built.
+
+    Parameters
+    ----------
+    img_dir : str, path-like or StackIndex
+        Path to folder containing single images, or an existing index.
+
+    Returns
+    -------
+    StackIndex
+        Index of the image sequence folder.
+
+    """
+    if isinstance(img_dir, StackIndex):
+        stack_index = img_dir
+        img_dir = stack_index.img_dir
+    else:
+        stack_index = _stack_index_cache.get(os.path.abspath(img_dir))
+    if stack_index is None or stack_index.is_stale():
+        stack_index = StackIndex(img_dir)
+    _stack_index_cache[os.path.abspath(img_dir)] = stack_index
+    return stack_index
+
+
+def get_img_list(img_dir):
+    """
+    Gets list of .tiff images in an image sequence folder.
+
+    Parameters
+    ----------
+    img_dir : str, path-like or StackIndex
+        Path to folder containing single images. If a `StackIndex` is given,
+        its cached list is returned instead of listing the folder again.
+
     Returns
     -------
     list
         List of image filenames in the folder in ascending order. Only works on .tiff images.
 
     """
+    if isinstance(img_dir, StackIndex):
+        return get_stack_index(img_dir).img_list
     img_list_unsorted = []
     for f in os.listdir(img_dir):
         if f.lower().endswith((".tif", ".tiff")):
@@ -42,8 +254,8 @@ def get_img_filepath(img_dir, index):
 
     Parameters
     ----------
-    img_dir : str, path-like
-        Path to folder containing single images.
+    img_dir : str, path-like or StackIndex
+        Path to folder containing single images, or its index.
     index : int
         Index of image
 
@@ -53,18 +265,18 @@ def get_img_filepath(img_dir, index):
         Image filepath for index image in sequence
 
     """
-    img_list = get_img_list(img_dir)
-    return img_list[index]
+    return get_stack_index(img_dir).img_list[index]
 
 
 def get_nslices(img_dir):
     """
-    Gets number of slices in an image sequence folder.
+    Gets number of slices in an image sequence folder or volume.
 
     Parameters
     ----------
-    img_dir : str, path-like
-        Path to folder containing single images.
+    img_dir : str, path-like or VolumeSource
+        Path to folder containing single images, or a volume, see
+        `open_volume`.
 
     Returns
     -------
@@ -73,7 +285,39 @@ def get_nslices(img_dir):
         exist in the folder besides the images.
 
     """
-    return len(get_img_list(img_dir))
+    return open_volume(img_dir).nslices
+
+
+def mask_bounds(shape, mask_percentage):
+    """
+    Calculates the bounds of the central `mask_percentage` rectangle of an
+    image, as used by `mask_img`.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2-D image.
+    mask_percentage : float
+        Percentage of the image to consider, as a rectangle centred on the
+        image. Ranges from 0-100.
+
+    Returns
+    -------
+    x_bounds : tuple
+        (Start, stop) index of the rectangle along the first axis.
+    y_bounds : tuple
+        (Start, stop) index of the rectangle along the second axis.
+
+    """
+    if mask_percentage < 0 or mask_percentage > 100:
+        raise ValueError("`mask_percentage` must be a percentage between \
+                         0 and 100")
+    mask_width = int(shape[0] * mask_percentage/100)
+    mask_height = int(shape[1] * mask_percentage/100)
+    centre_x, centre_y = (int(shape[0]/2), int(shape[1]/2))
+    x_bounds = (int(centre_x - mask_width/2), int(centre_x + mask_width/2))
+    y_bounds = (int(centre_y - mask_height/2), int(centre_y + mask_height/2))
+    return x_bounds, y_bounds
 
 
 def mask_img(img, mask_percentage):
@@ -95,27 +339,384 @@ def mask_img(img, mask_percentage):
         Central `mask-percentage` of the 2D image `img`
 
     """
-    if mask_percentage < 0 or mask_percentage > 100:
-        raise ValueError("`mask_percentage` must be a percentage between \
-                         0 and 100")
-    mask_width = int(img.shape[0] * mask_percentage/100)
-    mask_height = int(img.shape[1] * mask_percentage/100)
-    centre_x, centre_y = (int(img.shape[0]/2), int(img.shape[1]/2))
-    x_bounds = (int(centre_x - mask_width/2), int(centre_x + mask_width/2))
-    y_bounds = (int(centre_y - mask_height/2), int(centre_y + mask_height/2))
+    x_bounds, y_bounds = mask_bounds(img.shape, mask_percentage)
     masked_img = img[x_bounds[0]:x_bounds[1], y_bounds[0]:y_bounds[1]]
     return masked_img
 
 
-def load_img(img_filepath, show_image=False, mask_percentage=100., vmin=None, vmax=None):
+def read_img_roi(img_filepath, mask_percentage=100.):
     """
-    Loads image from `img_filepath` and applies a mask with percentage
-    `mask_percentage`.
+    Reads only the central `mask_percentage` of a single image .tiff file.
+
+    The region of interest is calculated from the TIFF header, and only the
+    strips or tiles which overlap it are read and decoded. Uncompressed,
+    contiguous images are memory-mapped instead. Files which are not simple
+    single-page greyscale TIFFs are read whole and masked with `mask_img`.
 
     Parameters
     ----------
     img_filepath : str, path-like
         Filepath to the image to import.
+    mask_percentage : float, optional
+        Percentage of the image to import, as a rectangle centred in the x-y
+        plane. The default is 100.
+
+    Returns
+    -------
+    masked_img : array-like
+        2-D array identical to `mask_img(skimage.io.imread(img_filepath),
+        mask_percentage)`.
+
+    """
+    import tifffile
+    with tifffile.TiffFile(img_filepath) as tif:
+        page = tif.pages[0]
+        if (len(tif.pages) != 1 or len(page.shape) != 2
+                or page.samplesperpixel != 1 or page.imagedepth != 1):
+            import skimage.io
+            return mask_img(skimage.io.imread(img_filepath), mask_percentage)
+        return _read_page_roi(tif, page, mask_percentage)
+
+
+def _read_page_roi(tif, page, mask_percentage):
+    """
+    Reads the central `mask_percentage` of a 2-D greyscale TIFF page, see
+    `read_img_roi`.
+
+    Parameters
+    ----------
+    tif : tifffile.TiffFile
+        Open TIFF file containing `page`.
+    page : tifffile.TiffPage
+        Page to read.
+    mask_percentage : float
+        Percentage of the page to read, as a rectangle centred in the x-y
+        plane.
+
+    Returns
+    -------
+    masked_img : array-like
+        2-D array of the masked page.
+
+    """
+    x_bounds, y_bounds = mask_bounds(page.shape, mask_percentage)
+    roi_shape = (x_bounds[1] - x_bounds[0], y_bounds[1] - y_bounds[0])
+
+    if page.is_memmappable:
+        img = np.memmap(tif.filehandle.path,
+                        dtype=page.dtype.newbyteorder(tif.byteorder),
+                        mode="r",
+                        offset=page.dataoffsets[0],
+                        shape=page.shape)
+        return mask_img(img, mask_percentage).astype(page.dtype)
+
+    masked_img = np.empty(roi_shape, dtype=page.dtype)
+    if page.is_tiled:
+        segment_shape = (page.tilelength, page.tilewidth)
+    else:
+        segment_shape = (page.rowsperstrip, page.shape[1])
+    segments_across = -(-page.shape[1] // segment_shape[1])
+    for index, (offset, bytecount) in enumerate(zip(page.dataoffsets,
+                                                    page.databytecounts)):
+        # position of this strip or tile in the image
+        x_start = (index // segments_across) * segment_shape[0]
+        y_start = (index % segments_across) * segment_shape[1]
+        x_overlap = (max(x_bounds[0], x_start),
+                     min(x_bounds[1], x_start + segment_shape[0]))
+        y_overlap = (max(y_bounds[0], y_start),
+                     min(y_bounds[1], y_start + segment_shape[1]))
+        if x_overlap[0] >= x_overlap[1] or y_overlap[0] >= y_overlap[1]:
+            continue
+        tif.filehandle.seek(offset)
+        segment = page.decode(tif.filehandle.read(bytecount), index,
+                              jpegtables=page.jpegtables)[0]
+        segment = segment.reshape(segment.shape[-3], segment.shape[-2])
+        masked_img[x_overlap[0] - x_bounds[0]:x_overlap[1] - x_bounds[0],
+                   y_overlap[0] - y_bounds[0]:y_overlap[1] - y_bounds[0]] = \
+            segment[x_overlap[0] - x_start:x_overlap[1] - x_start,
+                    y_overlap[0] - y_start:y_overlap[1] - y_start]
+    return masked_img
+
+
+class TiffVolume(VolumeSource):
+    """
+    Multi-page (Big)TIFF volume with one z-slice per page. Only the pages and
+    strips or tiles overlapping the requested region are read, see
+    `read_img_roi`. Contiguous volumes are memory-mapped.
+
+    Parameters
+    ----------
+    path : str, path-like
+        Filepath to the .tiff volume.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tif = None
+        series = self.tif.series[0]
+        if len(series.shape) != 3:
+            raise ValueError("{} is not a 3-D greyscale volume, shape {}".format(
+                path, series.shape))
+        self.nslices = series.shape[0]
+        self.shape = tuple(series.shape[1:])
+        self.dtype = series.dtype
+
+    def __getstate__(self):
+        # file handles are reopened after unpickling, e.g. in worker processes
+        state = self.__dict__.copy()
+        state["_tif"] = None
+        return state
+
+    @property
+    def tif(self):
+        """tifffile.TiffFile: Open handle to the volume file."""
+        if self._tif is None:
+            import tifffile
+            self._tif = tifffile.TiffFile(self.path)
+        return self._tif
+
+    def read_slice(self, index, mask_percentage=100.):
+        index = range(self.nslices)[index]
+        if len(self.tif.pages) == self.nslices:
+            return _read_page_roi(self.tif, self.tif.pages[index],
+                                  mask_percentage)
+        # single IFD describing contiguous data, e.g. ImageJ hyperstacks
+        series = self.tif.series[0]
+        volume = np.memmap(self.path,
+                           dtype=series.dtype.newbyteorder(self.tif.byteorder),
+                           mode="r",
+                           offset=series.dataoffset,
+                           shape=series.shape)
+        return mask_img(volume[index], mask_percentage).astype(self.dtype)
+
+
+class HDF5Volume(VolumeSource):
+    """
+    3-D dataset in an HDF5 file, indexed (z, x, y). Only the chunks
+    overlapping the requested region are read. Requires `h5py`.
+
+    Parameters
+    ----------
+    path : str, path-like
+        Filepath to the HDF5 file.
+    dataset : str, optional
+        Name of the dataset in the file. The default is None, which uses the
+        first 3-D dataset found.
+
+    """
+
+    def __init__(self, path, dataset=None):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("Reading HDF5 volumes requires h5py, "
+                              "install it with `pip install h5py`")
+        self.path = path
+        self._file = None
+        if dataset is None:
+            found = []
+            self.file.visititems(
+                lambda name, obj: found.append(name)
+                if isinstance(obj, h5py.Dataset) and obj.ndim == 3 else None)
+            if len(found) == 0:
+                raise ValueError("No 3-D dataset found in {}".format(path))
+            dataset = found[0]
+        self.dataset = dataset
+        self.nslices = self.file[dataset].shape[0]
+        self.shape = tuple(self.file[dataset].shape[1:])
+        self.dtype = self.file[dataset].dtype
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    @property
+    def file(self):
+        """h5py.File: Open handle to the HDF5 file."""
+        if self._file is None:
+            import h5py
+            self._file = h5py.File(self.path, "r")
+        return self._file
+
+    def read_slice(self, index, mask_percentage=100.):
+        x_bounds, y_bounds = mask_bounds(self.shape, mask_percentage)
+        return self.file[self.dataset][index,
+                                       x_bounds[0]:x_bounds[1],
+                                       y_bounds[0]:y_bounds[1]]
+
+
+class ZarrVolume(VolumeSource):
+    """
+    3-D Zarr array, indexed (z, x, y). Only the chunks overlapping the
+    requested region are read. Requires `zarr`.
+
+    Parameters
+    ----------
+    path : str, path-like
+        Path to the Zarr array or group.
+    dataset : str, optional
+        Name of the array in a Zarr group. The default is None, which uses the
+        first 3-D array in the group.
+
+    """
+
+    def __init__(self, path, dataset=None):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("Reading Zarr volumes requires zarr, "
+                              "install it with `pip install zarr`")
+        self.path = path
+        self.dataset = dataset
+        self._array = None
+        self.nslices = self.array.shape[0]
+        self.shape = tuple(self.array.shape[1:])
+        self.dtype = self.array.dtype
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    @property
+    def array(self):
+        """zarr.Array: The opened 3-D array."""
+        if self._array is None:
+            import zarr
+            node = zarr.open(self.path, mode="r")
+            if self.dataset is not None:
+                node = node[self.dataset]
+            elif not hasattr(node, "shape"):
+                arrays = [array for name, array in node.arrays()
+                          if array.ndim == 3]
+                if len(arrays) == 0:
+                    raise ValueError("No 3-D array found in {}".format(
+                        self.path))
+                node = arrays[0]
+            if node.ndim != 3:
+                raise ValueError("{} is not a 3-D array, shape {}".format(
+                    self.path, node.shape))
+            self._array = node
+        return self._array
+
+    def read_slice(self, index, mask_percentage=100.):
+        x_bounds, y_bounds = mask_bounds(self.shape, mask_percentage)
+        return self.array[index,
+                          x_bounds[0]:x_bounds[1],
+                          y_bounds[0]:y_bounds[1]]
+
+
+def open_volume(path, dataset=None):
+    """
+    Opens a 3-D image for reading one z-slice at a time.
+
+    Parameters
+    ----------
+    path : str, path-like or VolumeSource
+        Path to an image sequence folder, a multi-page .tiff, an HDF5 file
+        (.h5, .hdf5, .hdf) or a Zarr store (.zarr). A `VolumeSource` is
+        returned unchanged.
+    dataset : str, optional
+        Name of the dataset in an HDF5 file or Zarr group. The default is None,
+        which uses the first 3-D dataset.
+
+    Returns
+    -------
+    VolumeSource
+        Source to read slices from. Image sequence folders give a cached
+        `StackIndex`.
+
+    """
+    if isinstance(path, StackIndex):
+        return get_stack_index(path)
+    if isinstance(path, VolumeSource):
+        return path
+    path_lower = str(path).lower().rstrip("/\\")
+    if path_lower.endswith(".zarr"):
+        return ZarrVolume(path, dataset)
+    if os.path.isdir(path):
+        return get_stack_index(path)
+    if path_lower.endswith((".h5", ".hdf5", ".hdf")):
+        return HDF5Volume(path, dataset)
+    if path_lower.endswith((".tif", ".tiff")):
+        return TiffVolume(path)
+    raise ValueError("Unsupported volume format: {}".format(path))
+
+
+def iter_slices(img_dir, indices, mask_percentage=100., prefetch=0):
+    """
+    Reads slices from a volume one after another, optionally reading ahead in
+    a background thread so that reading overlaps with processing.
+
+    Parameters
+    ----------
+    img_dir : str, path-like or VolumeSource
+        Directory to image, or a volume, see `open_volume`.
+    indices : list
+        Indices of the slices to read, in order.
+    mask_percentage : float, optional
+        Percentage of each slice to read, as a rectangle centred in the x-y
+        plane. The default is 100.
+    prefetch : int, optional
+        Number of slices to read ahead. At most `prefetch` slices are held in
+        memory in addition to the slice being processed. The default is 0,
+        which reads each slice when it is requested.
+
+    Yields
+    ------
+    img : array-like
+        2-D array of each masked slice, in the order of `indices`.
+
+    """
+    source = open_volume(img_dir)
+    if prefetch <= 0:
+        for index in indices:
+            yield source.read_slice(index, mask_percentage)
+        return
+
+    free_slots = threading.Semaphore(prefetch)
+    loaded = queue.Queue()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for index in indices:
+                free_slots.acquire()
+                if stop.is_set():
+                    return
+                loaded.put((source.read_slice(index, mask_percentage), None))
+        except Exception as error:
+            loaded.put((None, error))
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        for index in indices:
+            img, error = loaded.get()
+            if error is not None:
+                raise error
+            free_slots.release()
+            yield img
+    finally:
+        # unblock the reader if slices are no longer wanted
+        stop.set()
+        free_slots.release()
+
+
+def load_img(img_filepath, show_image=False, mask_percentage=100., vmin=None, vmax=None,
+             index=None):
+    """
+    Loads image from `img_filepath` and applies a mask with percentage
+    `mask_percentage`. For .tiff images only the masked region is read, see
+    `read_img_roi`.
+
+    Parameters
+    ----------
+    img_filepath : str, path-like or VolumeSource
+        Filepath to the image to import. If `index` is given, a volume to
+        import slice `index` from, see `open_volume`.
     show_image : bool, optional
         If True, display the image. The default is False.
     mask_percentage : float, optional
@@ -125,6 +726,9 @@ def load_img(img_filepath, show_image=False, mask_percentage=100., vmin=None, vm
         Minimum grey value to plot
     v_max : float, optional, default None
         Maximum grey value to plot
+    index : int, optional
+        Index of the z-slice to import from the volume `img_filepath`.
+        The default is None, for a single image file.
 
     Returns
     -------
@@ -132,12 +736,23 @@ def load_img(img_filepath, show_image=False, mask_percentage=100., vmin=None, vm
         2-D array representing masked image.
 
     """
-    img = skimage.io.imread(img_filepath)
-    masked_img = mask_img(img, mask_percentage)
+    if index is not None:
+        source = open_volume(img_filepath)
+        masked_img = source.read_slice(index, mask_percentage)
+        img_name = "{} slice {}".format(
+            os.path.basename(os.path.normpath(source.path)), index)
+    elif str(img_filepath).lower().endswith((".tif", ".tiff")):
+        masked_img = read_img_roi(img_filepath, mask_percentage)
+        img_name = os.path.split(img_filepath)[-1]
+    else:
+        import skimage.io
+        img = skimage.io.imread(img_filepath)
+        masked_img = mask_img(img, mask_percentage)
+        img_name = os.path.split(img_filepath)[-1]
     if show_image is True:
+        import matplotlib.pyplot as plt
         plt.imshow(masked_img, cmap="gray", vmin=vmin, vmax=vmax)
-        plt.title("{}\n{}".format(os.path.split(img_filepath)[-1],
-                                  masked_img.shape))
+        plt.title("{}\n{}".format(img_name, masked_img.shape))
     return masked_img
 
 
@@ -193,7 +808,7 @@ def save_GMM_slice_results(iter_results, save_dir, prefix):
 
     Parameters
     ----------
-    iter_results : list
+    iter_results : list or gaussquality_results.SliceResults
         List of fitted `mu`, `sigma` and `phi` Gaussian properties.
     save_dir : str, path-like
         Directory to save results.
@@ -205,13 +820,77 @@ def save_GMM_slice_results(iter_results, save_dir, prefix):
     None.
 
     """
-    parameters = ["mu", "sigma", "phi"]
-    for parameter in range(len(parameters)):
+    iter_results = gaussquality_results.SliceResults.from_iter_results(
+        iter_results)
+    for parameter in gaussquality_results.PARAMETERS:
         save_filename = os.path.join(save_dir,
                                      "{}_{}_GMM_slice_results.csv".format(prefix,
-                                     parameters[parameter]))
-        # pd.DataFrame(iter_results[parameter]).to_json(save_filename, indent=4)
-        pd.DataFrame(iter_results[parameter]).transpose().to_csv(save_filename)
+                                     parameter))
+        iter_results.to_pandas(parameter).to_csv(save_filename)
+
+
+def save_input_args(args, save_dir, prefix):
+    """
+    Saves the input arguments of a run.
+
+    Parameters
+    ----------
+    args : dict
+        Input arguments, e.g. `img_dir`, `n_components` and `threshold`.
+    save_dir : str, path-like
+        Directory to save arguments.
+    prefix : str
+        Prefix to filename.
+
+    Returns
+    -------
+    str, path-like
+        Filepath of the saved arguments.
+
+    """
+    args_outfile = os.path.join(save_dir, "{}_input.json".format(prefix))
+    with open(args_outfile, "w") as outfile:
+        json.dump(args, outfile, indent=4)
+    return args_outfile
+
+
+def save_SNR_CNR_slice_results(SNRs, CNRs, save_dir, prefix,
+                               background_number, feature_number):
+    """
+    Saves SNR and CNR for each 2-D image considered from a 3-D image sequence.
+
+    Parameters
+    ----------
+    SNRs : dict
+        Dict of SNRs. Keys = slice number, values = SNR.
+    CNRs : dict
+        Dict of CNRs. Keys = slice number, values = CNR.
+    save_dir : str, path-like
+        Directory to save results.
+    prefix : str
+        Prefix to save results filename.
+    background_number : int
+        Material number of background material.
+    feature_number : int
+        Material number of feature material.
+
+    Returns
+    -------
+    str, path-like
+        Filepath of the saved results.
+
+    """
+    import pandas as pd
+    snr_cnr_df = pd.DataFrame({"Slice": np.array(list(SNRs.keys()), dtype=float),
+                               "SNR": list(SNRs.values()),
+                               "CNR": list(CNRs.values())})
+    snr_cnr_outfile = os.path.join(save_dir,
+                                   "{}_BG{}-F{}_snr_cnr.csv".format(
+                                       prefix,
+                                       background_number,
+                                       feature_number))
+    snr_cnr_df.to_csv(snr_cnr_outfile, index=False)
+    return snr_cnr_outfile
 
 
 def save_SNR_CNR_stack(SNRs, CNRs, save_dir, prefix):
@@ -223,3 +902,206 @@ def save_SNR_CNR_stack(SNRs, CNRs, save_dir, prefix):
     with open(snr_cnr_outfile, "w") as outfile:
         json.dump(dict_to_write, outfile, indent=4)
     print("SNR and CNR saved as {}".format(snr_cnr_outfile))
+
+
+def _npz_member_name(name, part):
+    # the first part keeps plain names, so single-part files match np.savez
+    if part == 0:
+        return name + ".npy"
+    return "{}.{}.npy".format(name, part)
+
+
+def _parse_npz_member_name(member_name):
+    name = member_name[:-len(".npy")]
+    base, _, part = name.rpartition(".")
+    if base != "" and part.isdigit():
+        return base, int(part)
+    return name, 0
+
+
+def save_GMM_results_npz(iter_results, save_filepath, fitted_results=None,
+                         input_args=None, append=False):
+    """
+    Saves fitted Gaussian properties, SNR/CNR and input arguments of a run
+    as a single uncompressed .npz file.
+
+    The file holds `slices`, per-slice `mu`, `sigma` and `phi` of shape
+    (slices, components), diagnostics as `diag_<name>`, stack means
+    `mu_mean`, `sigma_mean` and `phi_mean`, SNR and CNR for every pair of
+    materials `snr` and `cnr` of shape (slices, background, feature), see
+    `gaussquality_calc.calc_snr_matrix`, and the JSON-encoded `input_args`.
+    Members are stored uncompressed so they can be memory-mapped by
+    `load_GMM_results_npz`. Without `append`, the file can also be read with
+    `np.load`.
+
+    Parameters
+    ----------
+    iter_results : list or gaussquality_results.SliceResults
+        Fitted Gaussian properties for each 2-D image considered.
+    save_filepath : str, path-like
+        Filepath to save results, should end with .npz.
+    fitted_results : list, optional
+        Fitted `mu`, `sigma` and `phi` averaged across the stack.
+        The default is None, which averages `iter_results`.
+    input_args : dict, optional
+        Input arguments of the run. The default is None.
+    append : bool, optional
+        If True and `save_filepath` exists, add the slices to it as a new
+        part without rewriting the existing parts. The default is False,
+        which overwrites the file.
+
+    Returns
+    -------
+    str, path-like
+        `save_filepath`.
+
+    """
+    # imported here as gaussquality_calc is not needed for the other formats
+    from gaussquality import gaussquality_calc
+
+    iter_results = gaussquality_results.SliceResults.from_iter_results(
+        iter_results)
+    if fitted_results is None:
+        fitted_results = iter_results.mean()
+    arrays = {"slices": iter_results.slices,
+              "mu": iter_results.mu,
+              "sigma": iter_results.sigma,
+              "phi": iter_results.phi,
+              "snr": gaussquality_calc.calc_snr_matrix(iter_results.mu,
+                                                       iter_results.sigma),
+              "cnr": gaussquality_calc.calc_cnr_matrix(iter_results.mu,
+                                                       iter_results.sigma)}
+    for name, values in iter_results.diagnostics.items():
+        arrays["diag_" + name] = values
+    for name, values in zip(("mu_mean", "sigma_mean", "phi_mean"),
+                            fitted_results):
+        arrays[name] = np.asarray(values, dtype=float)
+    if input_args is not None:
+        arrays["input_args"] = np.array(json.dumps(input_args))
+
+    if append is True and os.path.exists(save_filepath):
+        with zipfile.ZipFile(save_filepath, "r") as zip_file:
+            part = sum(_parse_npz_member_name(member_name)[0] == "slices"
+                       for member_name in zip_file.namelist())
+        write_filepath, mode = save_filepath, "a"
+    else:
+        # write to a temporary file first so interrupted writes are not read
+        fd, write_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(save_filepath)),
+            suffix=".tmp")
+        os.close(fd)
+        part, mode = 0, "w"
+    with zipfile.ZipFile(write_filepath, mode,
+                         compression=zipfile.ZIP_STORED) as zip_file:
+        for name, values in arrays.items():
+            with zip_file.open(_npz_member_name(name, part), "w",
+                               force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asarray(values),
+                                          allow_pickle=False)
+    if write_filepath != save_filepath:
+        os.replace(write_filepath, save_filepath)
+    return save_filepath
+
+
+def _read_npz_member(zip_file, member_name, mmap_mode=None):
+    """
+    Reads an array from an .npz file, memory-mapped if it is uncompressed.
+
+    Parameters
+    ----------
+    zip_file : zipfile.ZipFile
+        Opened .npz file.
+    member_name : str
+        Name of the .npy member.
+    mmap_mode : str, optional
+        Memory-map mode, see `np.memmap`. The default is None, which reads
+        the array into memory.
+
+    Returns
+    -------
+    np.ndarray or np.memmap
+        Array stored in the member.
+
+    """
+    info = zip_file.getinfo(member_name)
+    if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+        with zip_file.open(member_name) as member:
+            return np.lib.format.read_array(member, allow_pickle=False)
+    fileobj = zip_file.fp
+    # skip the local file header to the start of the .npy data
+    fileobj.seek(info.header_offset)
+    local_header = fileobj.read(30)
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    fileobj.seek(info.header_offset + 30 + name_length + extra_length)
+    version = np.lib.format.read_magic(fileobj)
+    if version == (1, 0):
+        shape, fortran_order, dtype = \
+            np.lib.format.read_array_header_1_0(fileobj)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = \
+            np.lib.format.read_array_header_2_0(fileobj)
+    else:
+        return _read_npz_member(zip_file, member_name)
+    if dtype.hasobject or np.prod(shape) == 0:
+        return _read_npz_member(zip_file, member_name)
+    return np.memmap(zip_file.filename, dtype=dtype, mode=mmap_mode,
+                     offset=fileobj.tell(), shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+def load_GMM_results_npz(load_filepath, mmap_mode="r"):
+    """
+    Loads results saved by `save_GMM_results_npz`.
+
+    Parameters
+    ----------
+    load_filepath : str, path-like
+        Filepath to .npz results.
+    mmap_mode : str, optional
+        Memory-map mode for the arrays, see `np.memmap`. Arrays of files
+        written in several parts with `append` are concatenated into memory.
+        The default is "r", None reads every array into memory.
+
+    Returns
+    -------
+    iter_results : gaussquality_results.SliceResults
+        Fitted Gaussian properties and diagnostics for each 2-D image.
+    fitted_results : list
+        Fitted `mu`, `sigma` and `phi` averaged across the stack. Averaged
+        over every part if the file was appended to.
+    snr_cnr : list
+        SNR and CNR for every pair of materials, each of shape
+        (slices, background, feature).
+    input_args : dict or None
+        Input arguments of the last part saved with them.
+
+    """
+    parts = {}
+    with zipfile.ZipFile(load_filepath, "r") as zip_file:
+        for member_name in zip_file.namelist():
+            name, part = _parse_npz_member_name(member_name)
+            parts.setdefault(name, {})[part] = _read_npz_member(
+                zip_file, member_name, mmap_mode)
+    arrays = {name: [name_parts[part] for part in sorted(name_parts)]
+              for name, name_parts in parts.items()}
+
+    def concatenated(name):
+        if len(arrays[name]) == 1:
+            return arrays[name][0]
+        return np.concatenate(arrays[name])
+
+    iter_results = gaussquality_results.SliceResults(
+        concatenated("slices"), concatenated("mu"), concatenated("sigma"),
+        concatenated("phi"),
+        diagnostics={name[len("diag_"):]: concatenated(name)
+                     for name in arrays if name.startswith("diag_")})
+    if len(arrays["slices"]) == 1:
+        fitted_results = [arrays[name][0]
+                          for name in ("mu_mean", "sigma_mean", "phi_mean")]
+    else:
+        fitted_results = iter_results.mean()
+    input_args = None
+    if "input_args" in arrays:
+        input_args = json.loads(str(arrays["input_args"][-1][()]))
+    return (iter_results, fitted_results,
+            [concatenated("snr"), concatenated("cnr")], input_args)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Logging
+
+Routes printed output to the `gaussquality` logger, and from there to a
+Tk `Text` widget, flushed in batches on a timer, and to a rotating log file.
+"""
+
+import os
+import sys
+import queue
+import logging
+import logging.handlers
+import threading
+
+LOGGER_NAME = "gaussquality"
+LOG_FILENAME = "gaussquality.log"
+
+
+def get_logger():
+    """
+    Gets the `gaussquality` logger, logging every message.
+
+    Returns
+    -------
+    logging.Logger
+
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+class StreamToLogger(object):
+    """
+    File-like object which logs every complete line written to it, e.g. to
+    replace `sys.stdout` so that `print` output is logged.
+
+    Partial lines are buffered per thread, so lines printed at the same time
+    from different threads are not interleaved.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger to log lines to.
+    level : int, optional
+        Level to log lines at. The default is logging.INFO.
+
+    """
+
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self._local = threading.local()
+
+    def write(self, message):
+        buffer = getattr(self._local, "buffer", "") + message
+        *lines, self._local.buffer = buffer.split("\n")
+        for line in lines:
+            self.logger.log(self.level, line)
+        return len(message)
+
+    def flush(self):
+        buffer = getattr(self._local, "buffer", "")
+        if buffer != "":
+            self._local.buffer = ""
+            self.logger.log(self.level, buffer)
+
+
+def drain_queue(log_queue, max_records=1000):
+    """
+    Takes the messages of up to `max_records` log records from a queue
+    without blocking.
+
+    Parameters
+    ----------
+    log_queue : queue.Queue
+        Queue of log records, filled by a `logging.handlers.QueueHandler`.
+    max_records : int, optional
+        Maximum number of records to take. The default is 1000.
+
+    Returns
+    -------
+    lines : list
+        Messages of the records.
+
+    """
+    lines = []
+    for _ in range(max_records):
+        try:
+            record = log_queue.get_nowait()
+        except queue.Empty:
+            break
+        lines.append(record.getMessage())
+    return lines
+
+
+class TextLogSink(object):
+    """
+    Shows log records in a Tk `Text` widget.
+
+    Records are queued by a `logging.handlers.QueueHandler`, which is safe to
+    log to from any thread, and inserted into the widget in one batch every
+    `interval` ms from the Tk main loop. Only the last `max_lines` lines are
+    kept in the widget.
+
+    Parameters
+    ----------
+    text_widget : tk.Text
+        Widget to show log records in.
+    logger : logging.Logger, optional
+        Logger to show records of. The default is the `gaussquality` logger.
+    max_lines : int, optional
+        Maximum number of lines kept in the widget. The default is 5000.
+    interval : int, optional
+        Time between flushes in ms. The default is 100.
+
+    """
+
+    def __init__(self, text_widget, logger=None, max_lines=5000, interval=100):
+        self.text_widget = text_widget
+        self.logger = get_logger() if logger is None else logger
+        self.max_lines = max_lines
+        self.interval = interval
+        self.log_queue = queue.Queue()
+        self.handler = logging.handlers.QueueHandler(self.log_queue)
+        self.logger.addHandler(self.handler)
+        self.text_widget.after(self.interval, self.flush)
+
+    def flush(self):
+        """
+        Inserts queued records into the widget and schedules the next flush.
+
+        Returns
+        -------
+        None.
+
+        """
+        lines = drain_queue(self.log_queue)
+        if len(lines) > 0:
+            self.text_widget.insert("end", "\n".join(lines) + "\n")
+            # the text always ends with a newline, followed by an empty line
+            n_lines = int(self.text_widget.index("end-1c").split(".")[0]) - 1
+            if n_lines > self.max_lines:
+                self.text_widget.delete(
+                    "1.0", "{}.0".format(n_lines - self.max_lines + 1))
+            self.text_widget.see("end")
+        self.text_widget.after(self.interval, self.flush)
+
+
+def set_log_dir(log_dir, logger=None, max_bytes=5 * 2**20, backup_count=3):
+    """
+    Mirrors log records to a rotating `gaussquality.log` file in `log_dir`,
+    replacing any log file set before.
+
+    Parameters
+    ----------
+    log_dir : str, path-like
+        Directory to save the log file, e.g. the save directory.
+    logger : logging.Logger, optional
+        Logger to mirror. The default is the `gaussquality` logger.
+    max_bytes : int, optional
+        Size at which the log file is rotated. The default is 5 MB.
+    backup_count : int, optional
+        Number of rotated log files to keep. The default is 3.
+
+    Returns
+    -------
+    logging.handlers.RotatingFileHandler
+        Handler writing to the log file.
+
+    """
+    logger = get_logger() if logger is None else logger
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.RotatingFileHandler):
+            logger.removeHandler(handler)
+            handler.close()
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, LOG_FILENAME), maxBytes=max_bytes,
+        backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(file_handler)
+    return file_handler
+
+
+def redirect_output(logger=None):
+    """
+    Logs everything printed to `sys.stdout` and `sys.stderr`.
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional
+        Logger to log to. The default is the `gaussquality` logger.
+
+    Returns
+    -------
+    None.
+
+    """
+    logger = get_logger() if logger is None else logger
+    # do not pass records on to the root logger, which may print them again
+    logger.propagate = False
+    sys.stdout = StreamToLogger(logger, logging.INFO)
+    sys.stderr = StreamToLogger(logger, logging.ERROR)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Synthetic phantoms
+
+Generates synthetic image stacks with known Gaussian mixture parameters, to
+test and benchmark fitting.
+"""
+
+import os
+import numpy as np
+import tifffile
+
+BIT_DEPTHS = {8: np.uint8, 16: np.uint16, 32: np.float32}
+
+
+def make_phantom_slice(shape, mu, sigma, phi, bit_depth=16, noise=1.,
+                       random_state=None):
+    """
+    Generates a 2-D image whose grey values are drawn from a Gaussian mixture.
+
+    Each pixel is assigned to a material with probability `phi`, then its
+    grey value is drawn from the Gaussian of that material.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image, (rows, columns).
+    mu : array-like
+        Mean grey value of each material.
+    sigma : array-like
+        Standard deviation of grey values of each material.
+    phi : array-like
+        Fraction of pixels of each material, sums to 1.
+    bit_depth : int, optional
+        8 or 16 for unsigned integer images, 32 for float images. Integer
+        grey values are rounded and clipped to the range of the bit depth.
+        The default is 16.
+    noise : float, optional
+        Factor by which to multiply `sigma`. The default is 1.
+    random_state : int or np.random.Generator, optional
+        Seed or generator for reproducible images. The default is None.
+
+    Returns
+    -------
+    img : np.ndarray
+        2-D image.
+
+    """
+    if bit_depth not in BIT_DEPTHS:
+        raise ValueError("`bit_depth` must be one of {}".format(
+            list(BIT_DEPTHS)))
+    rng = np.random.default_rng(random_state)
+    mu = np.asarray(mu, dtype=float)
+    sigma = np.asarray(sigma, dtype=float) * noise
+    phi = np.asarray(phi, dtype=float)
+    labels = rng.choice(len(mu), size=shape, p=phi / np.sum(phi))
+    img = rng.normal(mu[labels], sigma[labels])
+    dtype = BIT_DEPTHS[bit_depth]
+    if np.issubdtype(dtype, np.integer):
+        img = np.clip(np.rint(img), 0, np.iinfo(dtype).max)
+    return img.astype(dtype)
+
+
+def write_phantom_stack(save_dir, n_slices, shape, mu, sigma, phi,
+                        bit_depth=16, noise=1., prefix="phantom",
+                        random_state=0):
+    """
+    Writes a 3-D image sequence of synthetic slices as one TIFF per slice,
+    see `make_phantom_slice`.
+
+    Parameters
+    ----------
+    save_dir : str, path-like
+        Directory to save the slices. Created if it does not exist.
+    n_slices : int
+        Number of slices.
+    shape : tuple
+        Shape of each slice, (rows, columns).
+    mu : array-like
+        Mean grey value of each material.
+    sigma : array-like
+        Standard deviation of grey values of each material.
+    phi : array-like
+        Fraction of pixels of each material, sums to 1.
+    bit_depth : int, optional
+        8, 16 or 32, see `make_phantom_slice`. The default is 16.
+    noise : float, optional
+        Factor by which to multiply `sigma`. The default is 1.
+    prefix : str, optional
+        Prefix to slice filenames. The default is "phantom".
+    random_state : int, optional
+        Seed for reproducible stacks. The default is 0.
+
+    Returns
+    -------
+    img_dir : str, path-like
+        `save_dir`, to pass to `gaussquality_fitting.run_GMM_fit`.
+
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    rng = np.random.default_rng(random_state)
+    for slice_number in range(n_slices):
+        img = make_phantom_slice(shape, mu, sigma, phi, bit_depth=bit_depth,
+                                 noise=noise, random_state=rng)
+        tifffile.imwrite(os.path.join(save_dir, "{}_{:04d}.tif".format(
+            prefix, slice_number)), img)
+    return save_dir
+
+
+def recovery_error(fitted, mu, sigma, phi):
+    """
+    Calculates the largest relative error of fitted Gaussian properties
+    against the known phantom parameters. Fitted components are matched to
+    materials in ascending order of `mu`.
+
+    Parameters
+    ----------
+    fitted : list
+        Fitted `mu`, `sigma` and `phi`, e.g. `fitted_results` from
+        `gaussquality_fitting.run_GMM_fit`.
+    mu : array-like
+        Mean grey value of each material.
+    sigma : array-like
+        Standard deviation of grey values of each material, including the
+        `noise` factor.
+    phi : array-like
+        Fraction of pixels of each material.
+
+    Returns
+    -------
+    errors : dict
+        Largest relative error of `mu`, `sigma` and `phi` over the materials.
+
+    """
+    # fitted components are in ascending order of mu
+    order = np.argsort(mu)
+    errors = {}
+    for name, fitted_values, true_values in zip(("mu", "sigma", "phi"),
+                                                fitted, (mu, sigma, phi)):
+        true_values = np.asarray(true_values, dtype=float)[order]
+        errors[name] = float(np.max(
+            np.abs(np.asarray(fitted_values) - true_values) / true_values))
+    return errors
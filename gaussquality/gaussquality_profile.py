@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Profiling
+
+Per-stage timing and fit diagnostics of `gaussquality_fitting.run_GMM_fit`,
+exportable as JSON or CSV, e.g.
+
+    profiler = gaussquality_profile.Profiler()
+    gaussquality_fitting.run_GMM_fit(img_dir, 3, profiler=profiler)
+    profiler.to_csv("profile.csv")
+
+Stages are timed into plain dicts with `stage`, which does nothing when no
+dict is given, so profiling costs nothing when disabled.
+"""
+
+import json
+import time
+import contextlib
+import tracemalloc
+
+STAGES = ("decode", "threshold", "em")
+_NO_STAGE = contextlib.nullcontext()
+
+
+class _Stage(object):
+    # context manager adding the elapsed time to timings[name + "_time"]
+    __slots__ = ("timings", "key", "start_time")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.key = name + "_time"
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.key] = self.timings.get(self.key, 0.) + \
+            time.perf_counter() - self.start_time
+        return False
+
+
+def stage(timings, name):
+    """
+    Times a stage of fitting a slice.
+
+    Parameters
+    ----------
+    timings : dict or None
+        Dict to add the elapsed time in s to, as `<name>_time`. If None,
+        nothing is timed.
+    name : str
+        Name of the stage, e.g. "decode", "threshold" or "em".
+
+    Returns
+    -------
+    context manager
+
+    """
+    if timings is None:
+        return _NO_STAGE
+    return _Stage(timings, name)
+
+
+@contextlib.contextmanager
+def peak_memory(timings):
+    """
+    Records the peak memory allocated while fitting a slice as
+    `peak_memory` in bytes, if `tracemalloc` is tracing.
+
+    Parameters
+    ----------
+    timings : dict or None
+        Dict to record the peak memory in. If None, nothing is recorded.
+
+    Returns
+    -------
+    context manager
+
+    """
+    if timings is None or not tracemalloc.is_tracing():
+        yield
+        return
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    yield
+    timings["peak_memory"] = tracemalloc.get_traced_memory()[1] - start_memory
+
+
+class Profiler(object):
+    """
+    Collects per-slice timings and fit diagnostics from `run_GMM_fit`.
+
+    Each record holds the `slice` number, whether it was read from the
+    cache, the time in s to `decode` (read and crop), `threshold` (threshold,
+    sample or bin) and fit by `em`, the EM `n_iter`, `converged` and
+    `lower_bound`, the number of pixels fitted `n_pixels`, and the
+    `peak_memory` in bytes if `trace_memory` is True.
+
+    Parameters
+    ----------
+    trace_memory : bool, optional
+        If True, trace memory allocations with `tracemalloc` to record the
+        peak memory of each slice fitted in this process. Tracing slows down
+        fitting. The default is False.
+
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stack = {}
+        self.records = []
+
+    def __repr__(self):
+        return "Profiler({} slices)".format(len(self.records))
+
+    @contextlib.contextmanager
+    def tracing(self):
+        """
+        Traces memory allocations while fitting, if `trace_memory` is True.
+
+        Returns
+        -------
+        context manager
+
+        """
+        start_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if start_tracing:
+                tracemalloc.stop()
+
+    def add(self, slice_number, timings, diagnostics, cached=False):
+        """
+        Adds the record of a slice.
+
+        Parameters
+        ----------
+        slice_number : int
+            Slice number.
+        timings : dict or None
+            Stage timings of the slice, see `stage`.
+        diagnostics : dict
+            Fit diagnostics returned by `fit_GMM`.
+        cached : bool, optional
+            Whether the result was read from the cache. The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        record = {"slice": int(slice_number), "cached": cached}
+        for name in STAGES:
+            record[name + "_time"] = 0.
+        record.update(timings or {})
+        for name in ("n_iter", "converged", "lower_bound", "n_pixels"):
+            value = diagnostics.get(name)
+            record[name] = value.item() if hasattr(value, "item") else value
+        self.records.append(record)
+
+    def summary(self):
+        """
+        Totals the time of each stage over every slice.
+
+        Returns
+        -------
+        dict
+            Total time in s of each stage, and of the whole run.
+
+        """
+        totals = {name + "_time": sum(record.get(name + "_time", 0.)
+                                      for record in self.records)
+                  for name in STAGES}
+        totals.update(self.stack)
+        return totals
+
+    def to_json(self, save_filepath):
+        """
+        Saves stack timings and per-slice records as JSON.
+
+        Parameters
+        ----------
+        save_filepath : str, path-like
+            Filepath to save to.
+
+        Returns
+        -------
+        str, path-like
+            `save_filepath`.
+
+        """
+        with open(save_filepath, "w") as outfile:
+            json.dump({"stack": self.summary(), "slices": self.records},
+                      outfile, indent=4)
+        return save_filepath
+
+    def to_csv(self, save_filepath):
+        """
+        Saves per-slice records as CSV, one row per slice.
+
+        Parameters
+        ----------
+        save_filepath : str, path-like
+            Filepath to save to.
+
+        Returns
+        -------
+        str, path-like
+            `save_filepath`.
+
+        """
+        import pandas as pd
+        pd.DataFrame(self.records).to_csv(save_filepath, index=False)
+        return save_filepath
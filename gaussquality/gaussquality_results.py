@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Slice results
+
+Container for the Gaussian properties fitted to each slice of a 3-D image
+sequence, stored as contiguous (slices x components) arrays.
+"""
+
+import numpy as np
+
+PARAMETERS = ("mu", "sigma", "phi")
+
+
+class SliceResults(object):
+    """
+    Fitted `mu`, `sigma` and `phi` Gaussian properties and fit diagnostics
+    for each slice considered from a 3-D image sequence.
+
+    For backward compatibility, `SliceResults` behaves like the list of dicts
+    `[mus, sigmas, phis]` keyed by slice number which `run_GMM_fit` used to
+    return, e.g. `mus, sigmas, phis = slice_results` or `slice_results[0]`.
+    The dict values are views of the rows of the arrays.
+
+    Parameters
+    ----------
+    slices : array-like
+        Slice numbers, shape (slices,).
+    mu : array-like
+        Fitted means, shape (slices, components).
+    sigma : array-like
+        Fitted standard deviations, shape (slices, components).
+    phi : array-like
+        Fitted weights, shape (slices, components).
+    diagnostics : dict, optional
+        Fit diagnostics, e.g. `n_iter` or `se_mu`, each an array with one row
+        per slice. The default is None.
+
+    """
+
+    __slots__ = ("slices", "mu", "sigma", "phi", "diagnostics")
+
+    def __init__(self, slices, mu, sigma, phi, diagnostics=None):
+        self.slices = np.asarray(slices, dtype=int).reshape(-1)
+        n_slices = len(self.slices)
+        self.mu = np.ascontiguousarray(mu, dtype=float).reshape(n_slices, -1)
+        self.sigma = np.ascontiguousarray(sigma,
+                                          dtype=float).reshape(n_slices, -1)
+        self.phi = np.ascontiguousarray(phi, dtype=float).reshape(n_slices, -1)
+        self.diagnostics = {name: np.asarray(values)
+                            for name, values in (diagnostics or {}).items()}
+
+    def __repr__(self):
+        return "SliceResults({} slices, {} components)".format(
+            self.n_slices, self.n_components)
+
+    @property
+    def n_slices(self):
+        return self.mu.shape[0]
+
+    @property
+    def n_components(self):
+        return self.mu.shape[1]
+
+    @classmethod
+    def from_fits(cls, slices, fits):
+        """
+        Stacks the results of `fit_GMM` for each slice.
+
+        Parameters
+        ----------
+        slices : list
+            Slice numbers.
+        fits : list
+            Fitted `mu`, `sigma`, `phi` and optionally a diagnostics dict for
+            each slice, as returned by `gaussquality_fitting.fit_GMM`.
+
+        Returns
+        -------
+        SliceResults
+
+        """
+        fits = list(fits)
+        n_components = len(fits[0][0]) if len(fits) > 0 else 0
+        stacked = [np.array([fit[parameter] for fit in fits],
+                            dtype=float).reshape(len(fits), n_components)
+                   for parameter in range(3)]
+        diagnostics = {}
+        if len(fits) > 0 and len(fits[0]) > 3:
+            for name in fits[0][3]:
+                diagnostics[name] = np.array([fit[3][name] for fit in fits])
+        return cls(slices, *stacked, diagnostics=diagnostics)
+
+    @classmethod
+    def from_iter_results(cls, iter_results, diagnostics=None):
+        """
+        Converts the list of dicts `[mus, sigmas, phis]` keyed by slice
+        number to `SliceResults`.
+
+        Parameters
+        ----------
+        iter_results : list or SliceResults
+            List of fitted `mu`, `sigma` and `phi` Gaussian properties.
+            Returned unchanged if already `SliceResults`.
+        diagnostics : dict, optional
+            Dict of diagnostics, each a dict keyed by slice number.
+            The default is None.
+
+        Returns
+        -------
+        SliceResults
+
+        """
+        if isinstance(iter_results, cls):
+            return iter_results
+        mus, sigmas, phis = iter_results
+        slices = list(mus.keys())
+        stacked = [[parameter[slice_number] for slice_number in slices]
+                   for parameter in (mus, sigmas, phis)]
+        diagnostics = {name: [values[slice_number] for slice_number in slices]
+                       for name, values in (diagnostics or {}).items()}
+        return cls(slices, *stacked, diagnostics=diagnostics)
+
+    def _as_dict(self, values):
+        return dict(zip(self.slices.tolist(), values))
+
+    def to_dicts(self):
+        """
+        Converts to the list of dicts `[mus, sigmas, phis]` keyed by slice
+        number.
+
+        Returns
+        -------
+        list
+            List of dicts of fitted `mu`, `sigma` and `phi` for each slice.
+
+        """
+        return [self._as_dict(getattr(self, parameter))
+                for parameter in PARAMETERS]
+
+    def diagnostics_dicts(self):
+        """
+        Converts diagnostics to dicts keyed by slice number.
+
+        Returns
+        -------
+        dict
+            Dict of diagnostics, each a dict keyed by slice number.
+
+        """
+        return {name: self._as_dict(values)
+                for name, values in self.diagnostics.items()}
+
+    def __len__(self):
+        return len(PARAMETERS)
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __getitem__(self, parameter):
+        return self._as_dict(getattr(self, PARAMETERS[parameter]))
+
+    def mean(self):
+        """
+        Averages fitted Gaussian properties across slices.
+
+        Returns
+        -------
+        list
+            Mean `mu`, `sigma` and `phi` arrays, shape (components,).
+
+        """
+        return [np.mean(getattr(self, parameter), axis=0)
+                for parameter in PARAMETERS]
+
+    def std(self):
+        """
+        Standard deviation of fitted Gaussian properties across slices.
+
+        Returns
+        -------
+        list
+            Standard deviations of `mu`, `sigma` and `phi`, each an array of
+            shape (components,).
+
+        """
+        return [np.std(getattr(self, parameter), axis=0)
+                for parameter in PARAMETERS]
+
+    def percentile(self, q):
+        """
+        Percentiles of fitted Gaussian properties across slices.
+
+        Parameters
+        ----------
+        q : float or array-like
+            Percentiles to compute, 0-100.
+
+        Returns
+        -------
+        list
+            Percentiles of `mu`, `sigma` and `phi`, each an array of shape
+            (components,) or (len(`q`), components).
+
+        """
+        return [np.percentile(getattr(self, parameter), q, axis=0)
+                for parameter in PARAMETERS]
+
+    def confidence_interval(self, confidence=0.95):
+        """
+        Half-width of the confidence interval of the mean of fitted Gaussian
+        properties across slices, from Student's t distribution.
+
+        Parameters
+        ----------
+        confidence : float, optional
+            Confidence level, 0-1. The default is 0.95.
+
+        Returns
+        -------
+        list
+            Half-widths for `mu`, `sigma` and `phi`, each an array of shape
+            (components,). NaN if fewer than 2 slices were fitted.
+
+        """
+        if self.n_slices < 2:
+            return [np.full(self.n_components, np.nan) for _ in PARAMETERS]
+        import scipy.stats
+        t = scipy.stats.t.ppf((1 + confidence) / 2, self.n_slices - 1)
+        return [t * np.std(getattr(self, parameter), axis=0, ddof=1)
+                / np.sqrt(self.n_slices) for parameter in PARAMETERS]
+
+    def to_pandas(self, parameter="mu"):
+        """
+        Exports a fitted Gaussian property without copying.
+
+        Parameters
+        ----------
+        parameter : str, optional
+            "mu", "sigma" or "phi". The default is "mu".
+
+        Returns
+        -------
+        pd.DataFrame
+            Index = slice number, columns = component number.
+
+        """
+        if parameter not in PARAMETERS:
+            raise ValueError("`parameter` must be one of {}".format(PARAMETERS))
+        import pandas as pd
+        return pd.DataFrame(getattr(self, parameter), index=self.slices,
+                            copy=False)
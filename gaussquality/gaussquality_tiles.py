@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+""" Gaussian mixture model fitting for greyscale images: Tiled quality maps
+
+Fits Gaussian mixture models to a grid of tiles of each slice, or of each
+slab of slices, to map how image quality varies across the field of view,
+e.g.
+
+    maps = gaussquality_tiles.run_tile_maps(img_dir, 3, 0, 2, save_dir,
+                                            "sample", tile_size=256)
+    gaussquality_visuals.plot_quality_map(img, maps["snr"][0],
+                                          *maps["edges"])
+
+The grey value histogram of each tile is calculated once. The whole slab is
+fitted to the merged tile histograms, and each tile is initialised from the
+whole-slab fit so that its components are in the same order.
+"""
+
+import os
+import functools
+import contextlib
+import concurrent.futures
+import numpy as np
+
+from gaussquality import gaussquality_io
+from gaussquality import gaussquality_calc
+from gaussquality import gaussquality_fitting
+
+MAP_NAMES = ("mu", "sigma", "phi", "snr", "cnr")
+
+# tiles are fitted to histograms, so pixels cannot be sampled
+SAMPLING_KWARGS = ("n_samples", "target_se", "sampling")
+
+
+def tile_edges(shape, tile_size):
+    """
+    Calculates the edges of a grid of tiles covering a 2-D image. Tiles in
+    the last row and column are smaller if `tile_size` does not divide the
+    image.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the 2-D image, (rows, columns).
+    tile_size : int or tuple
+        Size of each tile in pixels, or (rows, columns).
+
+    Returns
+    -------
+    row_edges : np.ndarray
+        Row index of the edges of the tiles, from 0 to `shape[0]`.
+    col_edges : np.ndarray
+        Column index of the edges of the tiles, from 0 to `shape[1]`.
+
+    """
+    tile_size = np.broadcast_to(tile_size, 2)
+    return tuple(np.append(np.arange(0, length, size), length)
+                 for length, size in zip(shape[:2], tile_size))
+
+
+def tile_histograms(img, row_edges, col_edges, threshold=None,
+                    precision=None):
+    """
+    Calculates the grey value histogram of every tile of an image.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D image, or 3-D slab of slices (z, x, y).
+    row_edges : array-like
+        Row index of the edges of the tiles, see `tile_edges`.
+    col_edges : array-like
+        Column index of the edges of the tiles, see `tile_edges`.
+    threshold : tuple, optional
+        (Min, Max) grey value to consider. The default is None.
+    precision : float, optional
+        Histogram bin width for float images, see
+        `gaussquality_fitting.img_histogram`. The default is None.
+
+    Returns
+    -------
+    histograms : list
+        Histogram `(grey_values, counts)` of each tile, row by row. Tiles
+        with no grey values within `threshold` have empty histograms.
+
+    """
+    img = np.asarray(img)
+    histograms = []
+    for row in range(len(row_edges) - 1):
+        for col in range(len(col_edges) - 1):
+            tile = img[..., row_edges[row]:row_edges[row + 1],
+                       col_edges[col]:col_edges[col + 1]]
+            try:
+                histograms.append(gaussquality_fitting.img_histogram(
+                    tile, threshold=threshold, precision=precision))
+            except ValueError:
+                histograms.append((np.array([]), np.array([], dtype=int)))
+    return histograms
+
+
+def _fit_tile(histogram, n_components, warm_start, **kwargs):
+    """
+    Fits a Gaussian mixture model to the histogram of a tile. Used as the
+    unit of work for parallel fitting in `fit_tiles`.
+
+    Parameters
+    ----------
+    histogram : tuple
+        Histogram `(grey_values, counts)` of the tile.
+    n_components : int
+        Number of Gaussian components to fit.
+    warm_start : tuple
+        Fitted `mu`, `sigma` and `phi` of the whole image.
+    **kwargs
+        Keyword arguments passed to `gaussquality_fitting.fit_GMM`.
+
+    Returns
+    -------
+    tuple
+        Fitted `mu`, `sigma` and `phi`.
+
+    """
+    return gaussquality_fitting.fit_GMM(None, n_components,
+                                        histogram=histogram,
+                                        warm_start=warm_start, **kwargs)
+
+
+def fit_tiles(img, n_components, tile_size=256, min_pixels=1000,
+              threshold=None, precision=None, n_jobs=1, executor=None,
+              **kwargs):
+    """
+    Fits a Gaussian mixture model to each tile of an image, or of a slab of
+    slices.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D image, or 3-D slab of slices (z, x, y).
+    n_components : int
+        Number of Gaussian components to fit.
+    tile_size : int or tuple, optional
+        Size of each tile in pixels, or (rows, columns). The default is 256.
+    min_pixels : int, optional
+        Tiles with fewer grey values within `threshold` are skipped, and
+        their fitted properties are NaN. The default is 1000.
+    threshold : tuple, optional
+        (Min, Max) grey value to consider. The default is None.
+    precision : float, optional
+        Histogram bin width for float images, see
+        `gaussquality_fitting.img_histogram`. The default is None.
+    n_jobs : int, optional
+        Number of worker processes used to fit tiles in parallel. -1 or None
+        uses all CPUs. The default is 1, which fits tiles one at a time in
+        this process.
+    executor : concurrent.futures.Executor, optional
+        Executor to distribute tiles over instead of creating a process pool,
+        `n_jobs` is ignored if given. The executor is not shut down.
+        The default is None.
+    **kwargs
+        Keyword arguments passed to `gaussquality_fitting.fit_GMM`, e.g.
+        `engine`. Tiles are fitted to their histograms, so the sampling
+        arguments `n_samples`, `target_se` and `sampling` are not allowed.
+
+    Returns
+    -------
+    fitted_tiles : list
+        Fitted `mu`, `sigma` and `phi` of each tile, each an array of shape
+        (tile rows, tile columns, components).
+    fitted_results : tuple
+        Fitted `mu`, `sigma` and `phi` of the whole image, which each tile
+        was initialised with.
+    edges : tuple
+        `row_edges` and `col_edges` of the tiles, see `tile_edges`.
+
+    """
+    sampling_kwargs = [name for name in SAMPLING_KWARGS if name in kwargs]
+    if len(sampling_kwargs) > 0:
+        raise ValueError("Tiles are fitted to histograms, {} cannot be "
+                         "used".format(", ".join(sampling_kwargs)))
+    img = np.asarray(img)
+    row_edges, col_edges = tile_edges(img.shape[-2:], tile_size)
+    grid_shape = (len(row_edges) - 1, len(col_edges) - 1)
+    histograms = tile_histograms(img, row_edges, col_edges,
+                                 threshold=threshold, precision=precision)
+
+    # the whole image is the sum of its tiles
+    fitted_results = gaussquality_fitting.fit_GMM(
+        None, n_components,
+        histogram=gaussquality_fitting.merge_histograms(histograms),
+        **kwargs)
+
+    fitted_tiles = [np.full(grid_shape + (n_components,), np.nan)
+                    for _ in range(3)]
+    fitted = [tile for tile, histogram in enumerate(histograms)
+              if np.sum(histogram[1]) >= min_pixels]
+    print("Fitting {} of {} tiles".format(len(fitted), len(histograms)))
+    fit_tile = functools.partial(_fit_tile, n_components=n_components,
+                                 warm_start=fitted_results, **kwargs)
+    with contextlib.ExitStack() as stack:
+        if executor is None and n_jobs != 1 and len(fitted) > 1:
+            max_workers = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=gaussquality_fitting._limit_worker_threads)
+            stack.callback(executor.shutdown, wait=True)
+        map_tiles = map if executor is None else executor.map
+        for tile, result in zip(fitted, map_tiles(
+                fit_tile, [histograms[tile] for tile in fitted])):
+            for parameter in range(3):
+                fitted_tiles[parameter][np.unravel_index(tile, grid_shape)] = \
+                    result[parameter]
+    return fitted_tiles, fitted_results, (row_edges, col_edges)
+
+
+def run_tile_maps(img_dir, n_components, background_number, feature_number,
+                  save_dir, prefix, tile_size=256, slab_thickness=1,
+                  z_percentage=70, n_slabs=10, min_pixels=1000, n_jobs=1,
+                  save_plots=True, **kwargs):
+    """
+    Maps fitted Gaussian properties, SNR and CNR over tiles of slabs of a 3-D
+    image sequence, saved as memory-mapped .npy files, and optionally as
+    overlays on the first slice of each slab, see
+    `gaussquality_visuals.plot_quality_map`.
+
+    Parameters
+    ----------
+    img_dir : str, path-like or VolumeSource
+        Directory to image, or a volume file or source, see
+        `gaussquality_io.open_volume`.
+    n_components : int
+        Number of Gaussian components to fit.
+    background_number : int
+        Component number of the background material, from 0.
+    feature_number : int
+        Component number of the feature material, from 0.
+    save_dir : str, path-like
+        Directory to save the maps to.
+    prefix : str
+        Prefix of the saved filenames, `<prefix>_tile_<name>.npy`.
+    tile_size : int or tuple, optional
+        Size of each tile in pixels, or (rows, columns). The default is 256.
+    slab_thickness : int, optional
+        Number of consecutive slices fitted together as one slab.
+        The default is 1.
+    z_percentage : float, optional
+        Percentage of the stack to consider, centred on the central slice.
+        The default is 70.
+    n_slabs : int, optional
+        Number of slabs, evenly spaced within `z_percentage`.
+        The default is 10.
+    min_pixels : int, optional
+        Minimum number of grey values to fit a tile, see `fit_tiles`.
+        The default is 1000.
+    n_jobs : int, optional
+        Number of worker processes used to fit tiles in parallel, shared by
+        every slab, see `fit_tiles`. The default is 1.
+    save_plots : bool, optional
+        If True, save the SNR and CNR maps of each slab overlaid on its first
+        slice, as `<prefix>_tile_<snr or cnr>_slab<slab number>.png`.
+        The default is True.
+    **kwargs
+        Keyword arguments passed to `fit_tiles`, e.g. `threshold` or
+        `engine`.
+
+    Returns
+    -------
+    maps : dict
+        Memory-mapped maps, saved as they are filled. `mu`, `sigma` and `phi`
+        have shape (slabs, tile rows, tile columns, components), `snr` and
+        `cnr` of `feature_number` against `background_number` have shape
+        (slabs, tile rows, tile columns). NaN for skipped tiles. Also the
+        first slice number of each slab `slices`, and the `edges` of the
+        tiles, see `tile_edges`.
+
+    """
+    source = gaussquality_io.open_volume(img_dir)
+    row_edges, col_edges = tile_edges(source.shape, tile_size)
+    grid_shape = (len(row_edges) - 1, len(col_edges) - 1)
+
+    # evenly spaced slabs from the centre of the stack, as `run_GMM_fit`
+    central_slice = int(source.nslices / 2)
+    z_range = int(source.nslices * z_percentage / 100)
+    min_z = max(int(central_slice - z_range / 2), 0)
+    max_z = min(int(central_slice + z_range / 2),
+                source.nslices - slab_thickness)
+    slab_starts = np.linspace(min_z, max_z, num=n_slabs, dtype=int)
+
+    maps = {}
+    for name in MAP_NAMES:
+        shape = (n_slabs,) + grid_shape
+        if name in ("mu", "sigma", "phi"):
+            shape = shape + (n_components,)
+        maps[name] = np.lib.format.open_memmap(
+            os.path.join(save_dir, "{}_tile_{}.npy".format(prefix, name)),
+            mode="w+", dtype=np.float64, shape=shape)
+        maps[name][:] = np.nan
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if n_jobs != 1:
+            max_workers = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=gaussquality_fitting._limit_worker_threads))
+        for slab, start in enumerate(slab_starts):
+            print("\nSlab {}, Slices {}-{}".format(slab + 1, start + 1,
+                                                   start + slab_thickness))
+            img = np.stack([source.read_slice(index) for index in
+                            range(start, start + slab_thickness)])
+            fitted_tiles = fit_tiles(img, n_components, tile_size=tile_size,
+                                     min_pixels=min_pixels,
+                                     executor=executor, **kwargs)[0]
+            for name, values in zip(("mu", "sigma", "phi"), fitted_tiles):
+                maps[name][slab] = values
+            maps["snr"][slab] = gaussquality_calc.calc_snr_matrix(
+                fitted_tiles[0], fitted_tiles[1])[
+                    ..., background_number, feature_number]
+            maps["cnr"][slab] = gaussquality_calc.calc_cnr_matrix(
+                fitted_tiles[0], fitted_tiles[1])[
+                    ..., background_number, feature_number]
+            for name in MAP_NAMES:
+                maps[name].flush()
+            if save_plots:
+                save_quality_maps(img[0], maps, slab, save_dir, prefix,
+                                  (row_edges, col_edges))
+
+    maps["slices"] = slab_starts + 1
+    maps["edges"] = (row_edges, col_edges)
+    return maps
+
+
+def save_quality_maps(img, maps, slab, save_dir, prefix, edges):
+    """
+    Saves the SNR and CNR maps of a slab overlaid on an image of the slab.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D image of the slab, e.g. its first slice.
+    maps : dict
+        Maps of every slab, see `run_tile_maps`.
+    slab : int
+        Index of the slab, from 0.
+    save_dir : str, path-like
+        Directory to save the plots to.
+    prefix : str
+        Prefix of the saved filenames,
+        `<prefix>_tile_<snr or cnr>_slab<slab + 1>.png`.
+    edges : tuple
+        `row_edges` and `col_edges` of the tiles, see `tile_edges`.
+
+    Returns
+    -------
+    None.
+
+    """
+    # plotting is only imported when plots are saved
+    import matplotlib.pyplot as plt
+    from gaussquality import gaussquality_visuals
+    for name in ("snr", "cnr"):
+        figure = plt.figure()
+        gaussquality_visuals.plot_quality_map(img, maps[name][slab], *edges,
+                                              label=name.upper())
+        figure.savefig(os.path.join(save_dir, "{}_tile_{}_slab{}.png".format(
+            prefix, name, slab + 1)))
+        plt.close(figure)
@@ -11,10 +11,64 @@ import numpy as np
 import scipy.stats
 
 from gaussquality import gaussquality_io
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_results
+
+
+def histogram_density(img=None, threshold=None, c_bin=0.25, histogram=None):
+    """
+    Calculates the grey value probability density of `img` for plotting.
+    Number of bins is `c_bin`*sqrt(number of pixels), from Reiter et al.
+
+    Parameters
+    ----------
+    img : array-like, optional
+        2-D array containing image grey values. Ignored if `histogram` is
+        given. The default is None.
+    threshold : tuple, optional
+        (Min, Max) grey value to consider. The default is None.
+    c_bin : float, optional, range(0,1)
+        Constant by which to multiply sqrt(number of pixels) to determine bin
+        size. Default 0.25.
+    histogram : tuple, optional
+        Precomputed (`grey_values`, `counts`) of `img`, as returned by
+        `gaussquality_fitting.img_histogram`. The default is None.
+
+    Returns
+    -------
+    density : np.ndarray
+        Probability density in each bin.
+    bin_edges : np.ndarray
+        Edges of the bins, len(`density`) + 1.
+
+    """
+    if histogram is None:
+        img = np.asarray(img).ravel()
+        if np.issubdtype(img.dtype, np.integer):
+            # far fewer grey values than pixels for integer images
+            histogram = gaussquality_fitting.img_histogram(img, threshold)
+            threshold = None
+        else:
+            grey_values, counts = img, None
+            n_pixels = img.size
+    if histogram is not None:
+        grey_values, counts = histogram
+        n_pixels = np.sum(counts)
+    if threshold is not None:
+        in_threshold = (grey_values >= threshold[0]) & \
+            (grey_values <= threshold[1])
+        grey_values = grey_values[in_threshold]
+        if counts is None:
+            n_pixels = grey_values.size
+        else:
+            counts = counts[in_threshold]
+            n_pixels = np.sum(counts)
+    return np.histogram(grey_values, bins=int(c_bin*n_pixels**0.5),
+                        weights=counts, density=True)
 
 
 def plot_GMM(img, mu_fitted, sigma_fitted, phi_fitted, plot_title=None,
-             threshold=None, material_names=None, c_bin=0.25):
+             threshold=None, material_names=None, c_bin=0.25, histogram=None):
     """
     Plots histogram of grey values with fitted Gaussians overlaid.
     Number of histogram bins depends on bit depth of image, e.g.
@@ -23,7 +77,8 @@ def plot_GMM(img, mu_fitted, sigma_fitted, phi_fitted, plot_title=None,
     Parameters
     ----------
     img : array-like
-        2-D array containing image grey values.
+        2-D array containing image grey values. Can be None if `histogram`
+        is given.
     mu_fitted : array-like, len=n_components
         Fitted mean of Gaussian components.
     sigma_fitted : array-like, len=n_components
@@ -39,6 +94,10 @@ def plot_GMM(img, mu_fitted, sigma_fitted, phi_fitted, plot_title=None,
     c_bin : float, optional, range(0,1)
         Constant by which to multiply sqrt(number of pixels) to determine bin size
         0.125-0.25 for size 512^3 - 2048^3. Default 0.25.
+    histogram : tuple, optional
+        Precomputed (`grey_values`, `counts`) of `img`, as returned by
+        `gaussquality_fitting.img_histogram`, to plot instead of binning
+        `img`. The default is None.
 
     Returns
     -------
@@ -51,34 +110,28 @@ def plot_GMM(img, mu_fitted, sigma_fitted, phi_fitted, plot_title=None,
     plt.ylabel("Probability density")
 
     # Plot image histogram
-    img = img.flatten()  # make 1-d
-
     if threshold is not None:
-        img = np.array(list(filter(lambda x: x >= threshold[0], img.flatten())))
-        img = np.array(list(filter(lambda x: x <= threshold[1], img)))
         print("Image thresholded to {}".format(threshold))
         plt.xlim(threshold)
 
     # nbins calculation from Reiter et al.
     if c_bin is None:
         c_bin = 0.45
-    hist = plt.hist(img,
-                    bins=int(c_bin*len(img)**0.5),
-                    density=True,
-                    histtype="stepfilled",
-                    label="Grey Values",
-                    alpha=0.5)
+    density, bin_edges = histogram_density(img, threshold, c_bin, histogram)
+    plt.stairs(density, bin_edges,
+               fill=True,
+               label="Grey Values",
+               alpha=0.5)
 
     # Generate and plot individual fitted Gaussian distributions
-    gaussian_xs = np.linspace(min(hist[1]), max(hist[1]))
-    gaussian_ys = np.zeros((len(gaussian_xs), len(mu_fitted)))
+    gaussian_xs = np.linspace(bin_edges[0], bin_edges[-1])
+    gaussian_ys = np.asarray(phi_fitted) * scipy.stats.norm.pdf(
+        gaussian_xs[:, np.newaxis], np.asarray(mu_fitted),
+        np.asarray(sigma_fitted))
+    if material_names is None:
+        material_names = ["Gaussian {}".format(i) for i in range(len(mu_fitted))]
     for i in range(len(mu_fitted)):
-        gaussian_y = scipy.stats.norm.pdf(gaussian_xs, mu_fitted[i], sigma_fitted[i])
-        gaussian_ys[:, i] = gaussian_y * phi_fitted[i]
-        if material_names is None:
-            plt.plot(gaussian_xs, gaussian_y * phi_fitted[i], label="Gaussian {}".format(i))
-        if material_names is not None:
-            plt.plot(gaussian_xs, gaussian_y * phi_fitted[i], label=material_names[i])
+        plt.plot(gaussian_xs, gaussian_ys[:, i], label=material_names[i])
 
     # Calculate and plot sum of fitted distributions
     sum_gaussians = np.sum(gaussian_ys, axis=1)
@@ -97,7 +150,7 @@ def plot_slice_variation(fitted_results, iter_results, material_names=None):
     fitted_results : list
         List containing fitted Gaussian properties `mu`, `sigma` and `phi`
         averaged across the stack.
-    iter_results : list
+    iter_results : list or gaussquality_results.SliceResults
         List containing fitted Gaussian properties for each 2-D image
         considered.
     material_names : list, default None.
@@ -110,7 +163,9 @@ def plot_slice_variation(fitted_results, iter_results, material_names=None):
     """
 
     mu_fitted, sigma_fitted, phi_fitted = fitted_results
-    mus, sigmas, phis = iter_results
+    iter_results = gaussquality_results.SliceResults.from_iter_results(
+        iter_results)
+    slices = iter_results.slices
 
     # Plot variation of mu across slices
     plt.figure(figsize=(6,3))
@@ -122,21 +177,20 @@ def plot_slice_variation(fitted_results, iter_results, material_names=None):
         plt.subplot(1, 3, plot_no + 1)
         ylabels = ["Mu", "Sigma", "Phi"]
         for i in range(len(material_names)):
-            slices = list(means.keys())
             plt.plot([np.min(slices), np.max(slices)],
                      [fitted[i], fitted[i]],
                      "--",
                      label=material_names[i] + " Fitted")
             plt.plot(slices,
-                     [means[run][i] for run in slices],
+                     means[:, i],
                      ".",
                      color=plt.gca().lines[-1].get_color(),
                      label=material_names[i])
         plt.xlabel("Slices")
         plt.ylabel(ylabels[plot_no])
-    subplot(0, mu_fitted, mus, material_names)
-    subplot(1, sigma_fitted, sigmas, material_names)
-    subplot(2, phi_fitted, phis, material_names)
+    subplot(0, mu_fitted, iter_results.mu, material_names)
+    subplot(1, sigma_fitted, iter_results.sigma, material_names)
+    subplot(2, phi_fitted, iter_results.phi, material_names)
 
     plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', ncol=1)
     plt.tight_layout()
@@ -144,15 +198,15 @@ def plot_slice_variation(fitted_results, iter_results, material_names=None):
 
 def plot_img_and_histo(img_filepath, mask_percentage,
                        fitted_results, threshold=None, material_names=None, c_bin=0.25,
-                       vmin=None, vmax=None):
+                       vmin=None, vmax=None, index=None):
     """
     Plots imported image and histogram with overlaid fitted Gaussian
     distributions side-by-side.
 
     Parameters
     ----------
-    img_filepath : str, path-like
-        Filepath to image
+    img_filepath : str, path-like or VolumeSource
+        Filepath to image, or a volume if `index` is given
     mask_percentage : float
         Percentage of the image to consider, as a rectangle centred on `img`.
         Ranges from 0-100.
@@ -171,6 +225,9 @@ def plot_img_and_histo(img_filepath, mask_percentage,
         Minimum grey value to plot
     v_max : float, optional, default None
         Maximum grey value to plot
+    index : int, optional
+        Index of the z-slice to plot from the volume `img_filepath`.
+        The default is None.
 
 
     Returns
@@ -185,7 +242,8 @@ def plot_img_and_histo(img_filepath, mask_percentage,
                                    mask_percentage=mask_percentage,
                                    show_image=True,
                                    vmin=vmin,
-                                   vmax=vmax)
+                                   vmax=vmax,
+                                   index=index)
     plt.subplot(122)
     mu_fitted, sigma_fitted, phi_fitted = fitted_results
     plot_GMM(img, 
@@ -207,8 +265,9 @@ def vis_slices(n_runs, z_percentage, mask_xy, img_dir):
         Percentage of stack to consider
     mask_xy : float, 0-100
         Percentage of x-y image to consider
-    img_dir : str, path-like
-        Directory where image sequence is
+    img_dir : str, path-like or VolumeSource
+        Directory where image sequence is, or a volume, see
+        `gaussquality_io.open_volume`
         
     Returns
     -------
@@ -216,15 +275,14 @@ def vis_slices(n_runs, z_percentage, mask_xy, img_dir):
     """
     
     # Get z
-    n_slices = gaussquality_io.get_nslices(img_dir)
+    source = gaussquality_io.open_volume(img_dir)
+    n_slices = source.nslices
     n_slices_cropped = int(n_slices * z_percentage/100)
     central_slice = int(n_slices/2)
     z_plot = np.linspace(int(central_slice - n_slices_cropped/2), int(central_slice + n_slices_cropped/2), n_runs)
 
     # Get xy
-    slice_filepath = gaussquality_io.get_img_filepath(img_dir, 1)
-    slice1 = gaussquality_io.load_img(slice_filepath)
-    xy_dims = slice1.shape
+    xy_dims = source.shape
 
     masked_x, masked_y = (int(xy_dims[0]*mask_xy/100), int(xy_dims[1]*mask_xy/100))
     central_x, central_y = (int(xy_dims[0]/2), int(xy_dims[1]/2))
@@ -272,3 +330,47 @@ def vis_slices(n_runs, z_percentage, mask_xy, img_dir):
 
     ax.set_box_aspect([xy_dims[0], xy_dims[1], n_slices])
     plt.legend()
+
+
+def plot_quality_map(img, quality_map, row_edges, col_edges, label="SNR",
+                     alpha=0.5, cmap="viridis", vmin=None, vmax=None):
+    """
+    Overlays a map of image quality over tiles on the image, e.g. a slab of
+    `gaussquality_tiles.run_tile_maps`.
+
+    Parameters
+    ----------
+    img : array-like
+        2-D array containing image grey values.
+    quality_map : array-like
+        2-D array of the quality of each tile, e.g. SNR, shape (tile rows,
+        tile columns). NaN tiles are not shown.
+    row_edges : array-like
+        Row index of the edges of the tiles, see
+        `gaussquality_tiles.tile_edges`.
+    col_edges : array-like
+        Column index of the edges of the tiles.
+    label : str, optional
+        Label of the colour bar. The default is "SNR".
+    alpha : float, optional
+        Opacity of the map, 0-1. The default is 0.5.
+    cmap : str, optional
+        Colour map of the map. The default is "viridis".
+    vmin : float, optional, default None
+        Minimum quality to plot
+    vmax : float, optional, default None
+        Maximum quality to plot
+
+    Returns
+    -------
+    None.
+
+    """
+    plt.imshow(img, cmap="gray")
+    # tiles may differ in size, so the map is drawn as a mesh over the edges
+    mesh = plt.pcolormesh(np.asarray(col_edges) - 0.5,
+                          np.asarray(row_edges) - 0.5,
+                          np.ma.masked_invalid(quality_map), alpha=alpha,
+                          cmap=cmap, vmin=vmin, vmax=vmax)
+    plt.colorbar(mesh, label=label)
+    plt.axis("off")
@@ -21,6 +21,7 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     packages=["gaussquality"],
+    package_data={"gaussquality": ["logo/*.pnm", "logo/*.png"]},
     install_requires=[
        "gaussquality",
        "numpy",
@@ -31,6 +32,17 @@ setuptools.setup(
        "ttkthemes",
        "scikit-image",
        "scikit-learn",
+       "tifffile",
        "pytest",
-   ]
+   ],
+    entry_points={
+        "console_scripts": [
+            "gaussquality-batch=gaussquality.gaussquality_batch:main",
+            "gaussquality-gui=gaussquality.gaussquality_gui:main",
+        ],
+    },
+    extras_require={
+        "hdf5": ["h5py"],
+        "zarr": ["zarr"],
+    },
 )
\ No newline at end of file
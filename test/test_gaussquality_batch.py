@@ -0,0 +1,72 @@
+import os
+import json
+import pytest
+import numpy as np
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+img_dir = os.path.join(test_dir, "example_images", "3D_")
+
+from gaussquality import gaussquality_batch
+
+
+def test_read_manifest_csv(tmp_path):
+    """
+    Tests that CSV manifest rows are converted to run_GMM_fit arguments
+    """
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("img_dir,n_components,n_runs,lower_threshold,upper_threshold,background,feature,histogram\n"
+                        "{},3,5,10,250,0,2,true\n".format(img_dir))
+    stacks = gaussquality_batch.read_manifest(str(manifest))
+    assert stacks == [{"img_dir": img_dir, "n_components": 3, "n_runs": 5, "threshold": (10., 250.), "snr_cnr": [[0, 2]], "histogram": True, "prefix": "3D_"}]
+
+
+def test_read_manifest_csv_types(tmp_path):
+    """
+    Tests that CSV columns are parsed by the type of their run_GMM_fit
+    argument, a missing threshold bound is open, and bad rows are named
+    """
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("img_dir,n_components,sampling,engine,warm_start,z_percentage,upper_threshold\n"
+                        "{},\"2,3\",stratified,numpy,true,62.5,250\n".format(img_dir))
+    stack = gaussquality_batch.read_manifest(str(manifest))[0]
+    assert stack["n_components"] == [2, 3]
+    assert (stack["sampling"] == "stratified") and (stack["engine"] == "numpy") and (stack["warm_start"] is True)
+    assert stack["z_percentage"] == 62.5
+    assert stack["threshold"] == (-np.inf, 250.)
+    manifest.write_text("img_dir,n_components,n_runs\n{},3,five\n".format(img_dir))
+    with pytest.raises(ValueError, match="row 2"):
+        gaussquality_batch.read_manifest(str(manifest))
+    manifest.write_text("img_dir,n_components,n_run\n{},3,5\n".format(img_dir))
+    with pytest.raises(ValueError, match="n_run"):
+        gaussquality_batch.read_manifest(str(manifest))
+
+
+def test_read_manifest_keys(tmp_path):
+    """
+    Tests that any run_GMM_fit argument can be set in a manifest, and that
+    unknown keys are rejected
+    """
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([{"img_dir": img_dir, "n_components": 3, "engine": "numpy", "tolerance": 0.01, "n_jobs": 2}]))
+    stack = gaussquality_batch.read_manifest(str(manifest))[0]
+    assert (stack["engine"] == "numpy") and (stack["tolerance"] == 0.01) and (stack["n_jobs"] == 2)
+    manifest.write_text(json.dumps([{"img_dir": img_dir, "n_components": 3, "n_run": 5}]))
+    with pytest.raises(ValueError, match="n_run"):
+        gaussquality_batch.read_manifest(str(manifest))
+
+
+def test_run_batch(tmp_path):
+    """
+    Tests that every stack in a manifest is fitted and saved, and finished
+    stacks are skipped when the batch is run again
+    """
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps({
+        "defaults": {"img_dir": img_dir, "n_components": 3, "n_runs": 2, "histogram": True},
+        "stacks": [{"prefix": "stack_a", "snr_cnr": [[0, 2]]}, {"prefix": "stack_b", "mask_percentage": 50}]}))
+    save_dir = str(tmp_path / "results")
+    assert gaussquality_batch.main([str(manifest), "--save-dir", save_dir, "--n-workers", "2"]) == 0
+    for filename in ["stack_a_GMM_results.json", "stack_a_input.json", "stack_a_mu_GMM_slice_results.csv", "stack_a_BG0-F2_snr_cnr.csv", "stack_b_GMM_results.json"]:
+        assert os.path.exists(os.path.join(save_dir, filename))
+    summary = gaussquality_batch.run_batch(gaussquality_batch.read_manifest(str(manifest)), save_dir)
+    assert (summary["skipped"] == 2) and (summary["finished"] == 0)
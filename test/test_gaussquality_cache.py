@@ -0,0 +1,81 @@
+import os
+import sys
+import pytest
+import numpy as np
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+img_dir = os.path.join(test_dir, "example_images", "3D_")
+
+from gaussquality import gaussquality_cache
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_io
+
+
+def test_cache_round_trip(tmp_path):
+    """
+    Tests that cached results are returned exactly and keys depend on the
+    fit parameters
+    """
+    cache = gaussquality_cache.ResultCache(str(tmp_path))
+    source = gaussquality_io.open_volume(img_dir)
+    key = cache.key(source, 3, {"n_components": 3, "threshold": (0, 200)})
+    assert key != cache.key(source, 3, {"n_components": 2, "threshold": (0, 200)})
+    assert key != cache.key(source, 4, {"n_components": 3, "threshold": (0, 200)})
+    assert cache.get(key) is None
+    result = (np.random.rand(3), np.random.rand(3), np.random.rand(3), {"n_iter": 5, "converged": True, "se_mu": np.random.rand(3)})
+    cache.put(key, result)
+    cached = cache.get(key)
+    for param, cached_param in zip(result[:3], cached[:3]):
+        assert np.array_equal(param, cached_param)
+    assert (cached[3]["n_iter"] == 5) and np.array_equal(cached[3]["se_mu"], result[3]["se_mu"])
+
+
+def test_cache_callable_params(tmp_path):
+    """
+    Tests that functions are keyed by name, and that fitting with parameters
+    which cannot be keyed runs without caching
+    """
+    cache = gaussquality_cache.ResultCache(str(tmp_path))
+    source = gaussquality_io.open_volume(img_dir)
+    key = cache.key(source, 3, {"criterion": gaussquality_fitting.calc_information_criterion})
+    assert key == cache.key(source, 3, {"criterion": gaussquality_fitting.calc_information_criterion})
+    assert key != cache.key(source, 3, {"criterion": np.mean})
+    with pytest.raises(TypeError):
+        cache.key(source, 3, {"criterion": lambda *args: 0.})
+    cache_dir = str(tmp_path / "cache")
+    fitted_results = gaussquality_fitting.run_GMM_fit(img_dir, [2, 3], n_runs=2, histogram=True, cache=cache_dir,
+                                                      criterion=lambda log_likelihood, n_parameters, n_pixels: -log_likelihood)[0]
+    assert len(fitted_results) == 3
+    assert os.listdir(cache_dir) == []
+
+
+def test_cache_eviction(tmp_path):
+    """
+    Tests that the least recently used results are evicted when the cache is
+    full
+    """
+    cache = gaussquality_cache.ResultCache(str(tmp_path), max_bytes=300)
+    result = (np.zeros(3), np.zeros(3), np.zeros(3), {})
+    for key in ["a", "b", "c", "d", "e", "f", "g", "h"]:
+        cache.put(key, result)
+    assert sum(entry.stat().st_size for entry in os.scandir(str(tmp_path))) <= 300
+    assert (cache.get("a") is None) and (cache.get("h") is not None)
+
+
+def test_run_GMM_fit_cache(tmp_path, monkeypatch):
+    """
+    Tests that a repeated run reads every slice from the cache and gives
+    identical results
+    """
+    cache_dir = str(tmp_path / "cache")
+    fitted_results, iter_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4, histogram=True, cache=cache_dir)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("slice was fitted again")
+    monkeypatch.setattr(gaussquality_fitting, "fit_GMM", fail)
+    cached_fitted_results, cached_iter_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4, histogram=True, cache=cache_dir)
+    assert np.array_equal(fitted_results, cached_fitted_results)
+    for param, cached_param in zip(iter_results, cached_iter_results):
+        assert list(param.keys()) == list(cached_param.keys())
+        for slice_no in param:
+            assert np.array_equal(param[slice_no], cached_param[slice_no])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from gaussquality import gaussquality_calc
+
+
+def make_iter_results():
+    mus = {1: np.array([10., 50., 90.]), 5: np.array([12., 48., 95.])}
+    sigmas = {1: np.array([2., 5., 0.]), 5: np.array([4., 8., 3.])}
+    phis = {1: np.array([0.2, 0.3, 0.5]), 5: np.array([0.2, 0.3, 0.5])}
+    return [mus, sigmas, phis]
+
+
+def test_calc_snr_cnr_matrix():
+    """
+    Tests SNR/CNR matrices match calculating each pair separately.
+    """
+    slice_numbers, mus, sigmas = gaussquality_calc.stack_iter_results(
+        make_iter_results())
+    assert slice_numbers == [1, 5]
+    snrs = gaussquality_calc.calc_snr_matrix(mus, sigmas)
+    cnrs = gaussquality_calc.calc_cnr_matrix(mus, sigmas)
+    assert snrs.shape == cnrs.shape == (2, 3, 3)
+    for s in range(2):
+        for b in range(3):
+            for f in range(3):
+                expected_snr = gaussquality_calc.calc_snr(mus[s, f],
+                                                          sigmas[s, b])
+                expected_cnr = gaussquality_calc.calc_cnr(mus[s, f], mus[s, b],
+                                                          sigmas[s, b])
+                assert snrs[s, b, f] == pytest.approx(expected_snr,
+                                                      nan_ok=True)
+                assert cnrs[s, b, f] == pytest.approx(expected_cnr,
+                                                      nan_ok=True)
+    # zero sigma of background gives NaN
+    assert np.isnan(snrs[0, 2]).all() and np.isnan(cnrs[0, 2]).all()
+
+
+def test_calc_snr_cnr_stack():
+    """
+    Tests per-pair SNR/CNR of a stack.
+    """
+    iter_results = make_iter_results()
+    snrs = gaussquality_calc.calc_snr_stack(iter_results, 0, 2)
+    cnrs = gaussquality_calc.calc_cnr_stack(iter_results, 0, 2)
+    assert snrs == {1: pytest.approx(45.), 5: pytest.approx(23.75)}
+    assert cnrs == {1: pytest.approx(40.), 5: pytest.approx(20.75)}
+    assert np.isnan(gaussquality_calc.calc_snr_stack(iter_results, 2, 0)[1])
@@ -0,0 +1,130 @@
+import sys
+import json
+import subprocess
+import pytest
+import numpy as np
+
+from gaussquality import gaussquality_em
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_phantom
+
+mu_phantom = [20000., 35000., 50000.]
+sigma_phantom = [1500., 2500., 2000.]
+phi_phantom = [0.3, 0.5, 0.2]
+
+
+@pytest.fixture(scope="module")
+def phantom():
+    return gaussquality_phantom.make_phantom_slice(
+        (200, 200), mu_phantom, sigma_phantom, phi_phantom, random_state=5)
+
+
+@pytest.mark.parametrize("engine", ["numpy", "numpy32"])
+def test_engine_matches_sklearn(phantom, engine):
+    """
+    Tests the NumPy engines agree with the sklearn engine on a phantom
+    """
+    sklearn_fit = gaussquality_fitting.fit_GMM(phantom, 3, engine="sklearn")
+    numpy_fit = gaussquality_fitting.fit_GMM(phantom, 3, engine=engine)
+    for sklearn_values, numpy_values in zip(sklearn_fit, numpy_fit):
+        assert numpy_values == pytest.approx(sklearn_values, rel=1e-3)
+
+
+def test_engine_recovers_phantom(phantom):
+    """
+    Tests the NumPy engine recovers the mixture a phantom was drawn from
+    """
+    fitted = gaussquality_fitting.fit_GMM(phantom, 3, engine="numpy")
+    errors = gaussquality_phantom.recovery_error(fitted, mu_phantom,
+                                                 sigma_phantom, phi_phantom)
+    assert errors["mu"] < 0.01 and errors["sigma"] < 0.05 \
+        and errors["phi"] < 0.05
+
+
+def test_weighted_matches_unweighted(phantom):
+    """
+    Tests fitting histogram counts as weights matches fitting every pixel
+    """
+    grey_values, counts = gaussquality_fitting.img_histogram(phantom)
+    weighted = gaussquality_em.GaussianMixture1D(3, random_state=3).fit(
+        grey_values, sample_weight=counts)
+    unweighted = gaussquality_em.GaussianMixture1D(3, random_state=3).fit(
+        phantom)
+    assert np.sort(weighted.means_.ravel()) == \
+        pytest.approx(np.sort(unweighted.means_.ravel()), rel=1e-3)
+    assert weighted.score(grey_values, sample_weight=counts) == \
+        pytest.approx(unweighted.score(phantom), rel=1e-6)
+
+
+def test_chunked_matches_unchunked(phantom):
+    """
+    Tests the fit does not depend on the E-step chunk size
+    """
+    unchunked = gaussquality_em.GaussianMixture1D(3, random_state=3).fit(
+        phantom)
+    chunked = gaussquality_em.GaussianMixture1D(
+        3, random_state=3, chunk_size=1000).fit(phantom)
+    assert chunked.n_iter_ == unchunked.n_iter_
+    assert chunked.means_ == pytest.approx(unchunked.means_, rel=1e-9)
+    assert chunked.covariances_ == \
+        pytest.approx(unchunked.covariances_, rel=1e-9)
+    assert chunked.weights_ == pytest.approx(unchunked.weights_, rel=1e-9)
+
+
+def test_float32_matches_float64(phantom):
+    """
+    Tests float32 E-steps agree with float64 E-steps
+    """
+    fit64 = gaussquality_em.GaussianMixture1D(3, random_state=3).fit(phantom)
+    fit32 = gaussquality_em.GaussianMixture1D(
+        3, random_state=3, dtype=np.float32).fit(phantom.astype(np.float32))
+    assert fit32.means_ == pytest.approx(fit64.means_, rel=1e-4)
+    assert fit32.covariances_ == pytest.approx(fit64.covariances_, rel=1e-3)
+    assert fit32.weights_ == pytest.approx(fit64.weights_, rel=1e-3)
+
+
+def test_warm_start_engine(phantom):
+    """
+    Tests warm-started fits agree between engines
+    """
+    warm_start = (np.array(mu_phantom), np.array(sigma_phantom),
+                  np.array(phi_phantom))
+    fits = [gaussquality_fitting.fit_GMM(phantom, 3, warm_start=warm_start,
+                                         engine=engine)
+            for engine in ("sklearn", "numpy")]
+    for sklearn_values, numpy_values in zip(*fits):
+        assert numpy_values == pytest.approx(sklearn_values, rel=1e-3)
+
+
+def test_unknown_engine(phantom):
+    """
+    Tests an unknown engine is rejected
+    """
+    with pytest.raises(ValueError):
+        gaussquality_fitting.fit_GMM(phantom, 3, engine="torch")
+
+
+def test_engine_without_sklearn():
+    """
+    Tests a cold-started fit with the NumPy engine does not import sklearn
+    """
+    code = ("import sys, json\n"
+            "import numpy as np\n"
+            "from gaussquality import gaussquality_fitting\n"
+            "img = np.random.default_rng(0).normal(100, 10, size=(50, 50)).astype(np.uint16)\n"
+            "gaussquality_fitting.fit_GMM(img, 2, engine='numpy')\n"
+            "print(json.dumps(sorted(sys.modules)))")
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert "sklearn" not in json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_kmeans_initialisation():
+    """
+    Tests the 1-D k-means initialisation separates well-separated clusters,
+    with or without weights
+    """
+    x = np.concatenate([np.full(30, 10.), np.full(50, 20.), np.full(20, 40.)])
+    model = gaussquality_em.GaussianMixture1D(3)
+    assert model._kmeans_boundaries(x, None) == pytest.approx([15., 30.])
+    grey_values, counts = np.unique(x, return_counts=True)
+    assert model._kmeans_boundaries(grey_values, counts.astype(np.float64)) == pytest.approx([15., 30.])
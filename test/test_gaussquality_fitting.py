@@ -81,3 +81,320 @@ def test_z_crop():
     slices = list(iter_results[0].keys())
     assert (max(slices) - min(slices) == int(50 * z_percentage/100)) and (min(slices) == int(25 - 0.5 * z_percentage/100 * 50)) and (max(slices) == int(25 + 0.5 * z_percentage/100 * 50))
 
+
+def test_img_histogram():
+    """
+    Tests that the histogram of an integer image counts every grey value
+    """
+    test_img = np.random.randint(100, 200, size=(50, 60)).astype(np.uint16)
+    grey_values, counts = gaussquality_fitting.img_histogram(test_img)
+    unique_values, unique_counts = np.unique(test_img, return_counts=True)
+    assert np.array_equal(grey_values, unique_values) and np.array_equal(counts, unique_counts)
+
+
+def test_fit_GMM_histogram():
+    """
+    Tests that fitting the histogram gives the same result as fitting every
+    pixel, for integer and float images
+    """
+    mu_phantom = [60., 150.]
+    sigma_phantom = [10., 20.]
+    phi_phantom = [0.4, 0.6]
+    test_img = np.clip(create_test_distribution(mu_phantom, sigma_phantom, phi_phantom) * 100, 0, 65535)
+    for img in [test_img.astype(np.uint16), test_img / 100]:
+        pixel_results = gaussquality_fitting.fit_GMM(img, 2)
+        histogram_results = gaussquality_fitting.fit_GMM(img, 2, histogram=True)
+        for pixel, histo in zip(pixel_results, histogram_results):
+            assert histo == pytest.approx(pixel, rel=1e-2)
+
+
+def test_fit_GMM_histogram_few_grey_values():
+    """
+    Tests that a histogram with fewer grey values than components falls back
+    to fitting every pixel, or is rejected if precalculated
+    """
+    test_img = np.repeat(np.array([10, 20, 20, 30, 30, 30], dtype=np.uint8), 50).reshape(30, 10)
+    pixel_results = gaussquality_fitting.fit_GMM(test_img, 3, threshold=(0, 25))
+    histogram_results = gaussquality_fitting.fit_GMM(test_img, 3, threshold=(0, 25), histogram=True)
+    for pixel, histo in zip(pixel_results, histogram_results):
+        assert np.array_equal(histo, pixel)
+    with pytest.raises(ValueError, match="grey values"):
+        gaussquality_fitting.fit_GMM(None, 4, histogram=gaussquality_fitting.img_histogram(test_img))
+
+
+def test_threshold_pixels():
+    """
+    Tests thresholding keeps the native dtype, and flattens to a view without
+    a threshold
+    """
+    img = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    assert np.shares_memory(gaussquality_fitting.threshold_pixels(img), img)
+    pixels = gaussquality_fitting.threshold_pixels(img, (10, 19))
+    assert pixels.dtype == np.uint16
+    assert list(pixels) == list(range(10, 20))
+    assert gaussquality_fitting.float_pixels(pixels).dtype == np.float64
+    assert gaussquality_fitting.float_pixels(pixels, allow_float32=True).dtype == np.float32
+    float_img = img.astype(np.float32)
+    assert gaussquality_fitting.float_pixels(float_img) is float_img
+    assert gaussquality_fitting.float_pixels(img.astype(np.int32), allow_float32=True).dtype == np.float64
+
+
+def test_fit_GMM_float64_results():
+    """
+    Tests that the sklearn engine fits integer images in float64, as before
+    thresholding was done in the native dtype, and returns float64
+    """
+    from sklearn.mixture import GaussianMixture
+    img = np.round(np.random.default_rng(2).normal(30000., 2000., (50, 50))).astype(np.uint16)
+    mu_fitted, sigma_fitted, phi_fitted = gaussquality_fitting.fit_GMM(img, 1, threshold=(0, 65535))
+    assert mu_fitted.dtype == sigma_fitted.dtype == phi_fitted.dtype == np.float64
+    model = GaussianMixture(1, random_state=3).fit(img.astype(np.float64).reshape(-1, 1))
+    assert mu_fitted[0] == model.means_[0, 0]
+
+
+def test_fit_GMM_peak_memory():
+    """
+    Tests the documented peak memory of fitting a uint16 slice, relative to
+    the size of the slice, and that the histogram and NumPy engine use a
+    fraction of the memory of the default sklearn engine
+    """
+    import tracemalloc
+    from gaussquality import gaussquality_phantom
+    img = gaussquality_phantom.make_phantom_slice(
+        (1000, 1000), [20000., 35000.], [1500., 2500.], [0.4, 0.6],
+        random_state=5)
+    # imports are not counted
+    gaussquality_fitting.fit_GMM(img[:50, :50], 2, histogram=True)
+    gaussquality_fitting.fit_GMM(img[:50, :50], 2)
+    peak_ratios = {}
+    for name, kwargs in [("histogram", {"histogram": True}),
+                         ("numpy", {"engine": "numpy", "threshold": (1, 65535)}),
+                         ("sklearn", {"engine": "sklearn", "threshold": (1, 65535)})]:
+        tracemalloc.start()
+        gaussquality_fitting.fit_GMM(img, 2, **kwargs)
+        peak_ratios[name] = tracemalloc.get_traced_memory()[1] / img.nbytes
+        tracemalloc.stop()
+    assert peak_ratios["histogram"] < 6
+    assert peak_ratios["numpy"] < 14
+    assert peak_ratios["sklearn"] < 75
+    assert peak_ratios["numpy"] < peak_ratios["sklearn"] / 4
+
+
+def test_run_GMM_fit_parallel():
+    """
+    Tests that fitting slices in parallel gives the same results as fitting
+    them serially
+    """
+    serial_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4)
+    parallel_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4, n_jobs=2)
+    assert list(parallel_results[1][0].keys()) == list(serial_results[1][0].keys())
+    for serial, parallel in zip(serial_results[1], parallel_results[1]):
+        for slice_no in serial:
+            assert np.array_equal(serial[slice_no], parallel[slice_no])
+    assert np.array_equal(serial_results[0], parallel_results[0])
+
+
+def test_track_components():
+    """
+    Tests that components are matched to a reference by parameter distance
+    rather than by order of means
+    """
+    reference = ([10., 50., 52.], [2., 10., 1.], [0.2, 0.4, 0.4])
+    fitted = ([51.5, 10.5, 49.], [1.1, 2.1, 9.], [0.38, 0.21, 0.41])
+    order = gaussquality_fitting.track_components(fitted, reference)
+    assert list(order) == [1, 2, 0]
+
+
+def test_run_GMM_fit_warm_start():
+    """
+    Tests that warm-started fits agree with independent fits and need fewer
+    EM iterations
+    """
+    cold_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=6, return_diagnostics=True)
+    warm_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=6, warm_start=True, return_diagnostics=True)
+    # components overlap strongly in the example images, so sigma and phi are
+    # only determined to within the EM convergence tolerance
+    assert warm_results[0][0] == pytest.approx(cold_results[0][0], rel=2e-2)
+    for cold, warm in zip(cold_results[0][1:], warm_results[0][1:]):
+        assert warm == pytest.approx(cold, rel=0.15)
+    assert sum(warm_results[2]["n_iter"].values()) < sum(cold_results[2]["n_iter"].values())
+    with pytest.raises(ValueError):
+        gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=2, warm_start=True, n_jobs=2)
+
+
+def test_sample_pixels():
+    """
+    Tests that random and stratified sampling draw the requested number of
+    pixels reproducibly
+    """
+    test_img = np.arange(400 * 500).reshape(400, 500)
+    for sampling in ["random", "stratified"]:
+        samples = gaussquality_fitting.sample_pixels(test_img, 2000, sampling=sampling)
+        assert len(samples) == pytest.approx(2000, rel=0.05)
+        assert len(np.unique(samples)) == len(samples)
+        assert np.array_equal(samples, gaussquality_fitting.sample_pixels(test_img, 2000, sampling=sampling))
+    assert len(gaussquality_fitting.sample_pixels(test_img, 10**6)) == test_img.size
+
+
+def test_sample_pixels_1d():
+    """
+    Tests that stratified sampling of 1-D grey values, e.g. after
+    thresholding, draws the requested number of pixels, one from each
+    contiguous block
+    """
+    pixels = np.arange(200000)
+    samples = gaussquality_fitting.sample_pixels(pixels, 2000, sampling="stratified")
+    assert len(samples) == 2000
+    assert np.array_equal(samples // 100, np.arange(2000))
+
+
+def test_fit_GMM_target_se():
+    """
+    Tests that fitting a sample sized for a target standard error recovers
+    the mixture and reports standard errors close to the target
+    """
+    rng = np.random.default_rng(0)
+    test_img = np.concatenate([rng.normal(1000, 50, 300000), rng.normal(2000, 100, 700000)]).reshape(1000, 1000)
+    mu, sigma, phi, diagnostics = gaussquality_fitting.fit_GMM(test_img, 2, target_se=0.01, return_diagnostics=True)
+    assert diagnostics["n_pixels"] < test_img.size
+    assert (mu == pytest.approx([1000, 2000], rel=0.01)) and (sigma == pytest.approx([50, 100], rel=0.05)) and (phi == pytest.approx([0.3, 0.7], rel=0.05))
+    assert np.all(diagnostics["se_sigma"] / sigma < 0.011) and np.all(diagnostics["se_phi"] / phi < 0.011)
+
+
+def test_calc_required_samples_zero_mean():
+    """
+    Tests that components with zero mean or zero weight are skipped when
+    calculating the sample size, and the sample size is capped
+    """
+    n_required = gaussquality_fitting.calc_required_samples([0., 100.], [5., 5.], [0.5, 0.5], 0.01)
+    assert n_required == gaussquality_fitting.calc_required_samples([100.], [5.], [0.5], 0.01)
+    assert gaussquality_fitting.calc_required_samples([0., 100.], [5., 5.], [0., 1.], 0.01, max_samples=1000) == 1000
+    assert gaussquality_fitting.calc_required_samples([0.], [5.], [0.], 0.01, max_samples=1000) == 1000
+    rng = np.random.default_rng(0)
+    test_img = np.concatenate([np.zeros(300000), rng.normal(2000, 100, 700000)]).reshape(1000, 1000)
+    mu = gaussquality_fitting.fit_GMM(test_img, 2, target_se=0.01)[0]
+    assert mu == pytest.approx([0, 2000], abs=5)
+
+
+def test_run_GMM_fit_prefetch():
+    """
+    Tests that reading slices ahead in a background thread gives the same
+    results as reading them in turn
+    """
+    serial_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4, histogram=True)
+    prefetch_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=4, histogram=True, prefetch=2)
+    assert np.array_equal(serial_results[0], prefetch_results[0])
+
+
+def test_run_GMM_fit_callback():
+    """
+    Tests that progress is reported for each slice and fitting stops early
+    with partial results when the callback returns True
+    """
+    progress = []
+
+    def callback(run, n_runs, slice_number):
+        progress.append((run, n_runs, slice_number))
+        return run == 2
+    fitted_results, iter_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=5, histogram=True, callback=callback)
+    assert [run for run, n_runs, slice_number in progress] == [1, 2]
+    assert list(iter_results[0].keys()) == [slice_number for run, n_runs, slice_number in progress]
+    assert fitted_results[0] == pytest.approx(np.mean(list(iter_results[0].values()), axis=0))
+
+
+def test_run_GMM_fit_profiler(tmp_path):
+    """
+    Tests per-slice timings and diagnostics are recorded and exported
+    """
+    from gaussquality import gaussquality_profile
+    profiler = gaussquality_profile.Profiler(trace_memory=True)
+    fitted_results, iter_results = gaussquality_fitting.run_GMM_fit(img_dir, 3, n_runs=3, histogram=True, profiler=profiler)
+    assert [record["slice"] for record in profiler.records] == list(iter_results[0].keys())
+    for record in profiler.records:
+        assert record["decode_time"] > 0 and record["em_time"] > 0 and record["peak_memory"] > 0
+        assert record["converged"] is True and record["n_pixels"] > 0
+    assert profiler.summary()["total_time"] >= profiler.summary()["em_time"]
+    profiler.to_csv(str(tmp_path / "profile.csv"))
+    profiler.to_json(str(tmp_path / "profile.json"))
+    assert (tmp_path / "profile.csv").exists() and (tmp_path / "profile.json").exists()
+
+
+def test_select_n_components(tmp_path):
+    """
+    Tests the number of components of a phantom stack is chosen by BIC, per
+    slice and overall
+    """
+    from gaussquality import gaussquality_io
+    from gaussquality import gaussquality_phantom
+    mu, sigma, phi = [1000., 3000., 6000.], [100., 200., 300.], [0.5, 0.3, 0.2]
+    stack_dir = gaussquality_phantom.write_phantom_stack(str(tmp_path / "phantom"), 3, (120, 120), mu, sigma, phi)
+    img = gaussquality_io.load_img(gaussquality_io.get_img_list(stack_dir)[0])
+    mu_fitted, sigma_fitted, phi_fitted, diagnostics = gaussquality_fitting.fit_GMM(img, range(1, 6), histogram=True, return_diagnostics=True)
+    assert diagnostics["n_components"] == 3 and len(mu_fitted) == 3 and diagnostics["scores"].shape == (5,)
+    assert diagnostics["candidate_mu"][2, :3] == pytest.approx(mu_fitted)
+    # AIC chooses the same on well-separated components
+    assert gaussquality_fitting.fit_GMM(img, [2, 3, 4], histogram=True, criterion="aic", return_diagnostics=True)[3]["n_components"] == 3
+    fitted_results, iter_results, diagnostics = gaussquality_fitting.run_GMM_fit(stack_dir, [2, 3, 4], n_runs=3, histogram=True, cache=str(tmp_path / "cache"), return_diagnostics=True)
+    assert iter_results.n_components == 3 and set(diagnostics["n_components"].values()) == {3}
+    assert fitted_results[0] == pytest.approx(mu, rel=0.01)
+
+
+def test_run_GMM_fit_adaptive(tmp_path):
+    """
+    Tests adaptive fitting visits slices coarse to fine and stops once the
+    stack means are known to within the tolerance
+    """
+    from gaussquality import gaussquality_phantom
+    assert gaussquality_fitting.coarse_to_fine_order(9) == [4, 0, 8, 2, 6, 1, 3, 5, 7]
+    assert sorted(gaussquality_fitting.coarse_to_fine_order(30)) == list(range(30))
+    stack_dir = gaussquality_phantom.write_phantom_stack(str(tmp_path), 20, (60, 60), [1000., 3000.], [100., 200.], [0.5, 0.5])
+    fitted_results, iter_results, diagnostics = gaussquality_fitting.run_GMM_fit(stack_dir, 2, n_runs=20, histogram=True, tolerance=0.02, return_diagnostics=True)
+    assert diagnostics["stopping_reason"] == "converged"
+    assert 3 <= iter_results.n_slices < 20
+    assert np.nanmax(list(diagnostics["ci_width"].values())) > 0.02 > list(diagnostics["ci_width"].values())[-1]
+    assert fitted_results[0] == pytest.approx([1000., 3000.], rel=0.01)
+    # an unreachable tolerance fits every slice
+    diagnostics = gaussquality_fitting.run_GMM_fit(stack_dir, 2, n_runs=5, histogram=True, tolerance=1e-9, return_diagnostics=True)[2]
+    assert diagnostics["stopping_reason"] == "budget" and len(diagnostics["ci_width"]) == 5
+
+
+def test_run_full_stack_fit(tmp_path):
+    """
+    Tests every slice is fitted and saved, that an interrupted run is
+    resumed, and that fitting in parallel gives the same results
+    """
+    from gaussquality import gaussquality_io
+    from gaussquality import gaussquality_phantom
+    stack_dir = gaussquality_phantom.write_phantom_stack(str(tmp_path), 5, (60, 60), [20000., 40000.], [1000., 2000.], [0.4, 0.6])
+    save_filepath = os.path.join(str(tmp_path), "full_stack.npy")
+    stopped = gaussquality_fitting.run_full_stack_fit(stack_dir, 2, save_filepath, histogram=True,
+                                                      callback=lambda n_fitted, nslices, slice_number: n_fitted == 3)
+    assert np.sum(~np.isnan(stopped[:, 0, 0])) == 3
+    del stopped
+    results = gaussquality_fitting.run_full_stack_fit(stack_dir, 2, save_filepath, histogram=True)
+    source = gaussquality_io.open_volume(stack_dir)
+    for index in range(5):
+        expected = gaussquality_fitting.fit_GMM(source.read_slice(index, 70), 2, histogram=True)
+        assert results[index] == pytest.approx(np.array(expected))
+    parallel_results = gaussquality_fitting.run_full_stack_fit(stack_dir, 2, os.path.join(str(tmp_path), "parallel.npy"),
+                                                               histogram=True, n_jobs=2, max_in_flight=2)
+    assert np.asarray(parallel_results) == pytest.approx(np.asarray(results))
+
+
+def test_run_full_stack_fit_mismatch(tmp_path):
+    """
+    Tests results of a different stack or different fit arguments are not
+    resumed but fitted again
+    """
+    from gaussquality import gaussquality_io
+    from gaussquality import gaussquality_phantom
+    stack_a = gaussquality_phantom.write_phantom_stack(str(tmp_path / "a"), 3, (60, 60), [20000., 40000.], [1000., 2000.], [0.4, 0.6])
+    stack_b = gaussquality_phantom.write_phantom_stack(str(tmp_path / "b"), 3, (60, 60), [10000., 30000.], [1000., 2000.], [0.4, 0.6])
+    save_filepath = os.path.join(str(tmp_path), "full_stack.npy")
+    results = gaussquality_fitting.run_full_stack_fit(stack_a, 2, save_filepath, histogram=True)
+    del results
+    for stack_dir, mask_percentage in [(stack_b, 70), (stack_b, 50)]:
+        results = gaussquality_fitting.run_full_stack_fit(stack_dir, 2, save_filepath, mask_percentage=mask_percentage, histogram=True)
+        expected = gaussquality_fitting.fit_GMM(gaussquality_io.open_volume(stack_dir).read_slice(1, mask_percentage), 2, histogram=True)
+        assert results[1] == pytest.approx(np.array(expected))
+        del results
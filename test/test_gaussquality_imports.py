@@ -0,0 +1,65 @@
+import sys
+import json
+import subprocess
+
+HEAVY_MODULES = ["matplotlib", "pandas", "scipy", "skimage", "sklearn", "tifffile"]
+
+
+def run_python(code):
+    """
+    Runs `code` in a fresh interpreter and returns what it prints as JSON
+    """
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def test_import_numeric_core():
+    """
+    Tests the numeric core imports quickly, without plotting, pandas or
+    fitting engines. The time limit is loose so that only importing a heavy
+    dependency, not a slow machine, fails it
+    """
+    result = run_python(
+        "import sys, json, time\n"
+        "import numpy\n"
+        "start_time = time.perf_counter()\n"
+        "from gaussquality import gaussquality_io, gaussquality_fitting, gaussquality_calc\n"
+        "import_time = time.perf_counter() - start_time\n"
+        "print(json.dumps({'import_time': import_time, 'modules': sorted(sys.modules)}))")
+    assert result["import_time"] < 5
+    for module in HEAVY_MODULES:
+        assert module not in result["modules"]
+
+
+def test_fit_imports_only_engine():
+    """
+    Tests fitting with the NumPy engine, from a cold start as by default,
+    imports no other engine, plotting or pandas
+    """
+    result = run_python(
+        "import sys, json\n"
+        "import numpy as np\n"
+        "from gaussquality import gaussquality_fitting\n"
+        "img = np.random.default_rng(0).normal(100, 10, size=(50, 50)).astype(np.uint16)\n"
+        "gaussquality_fitting.fit_GMM(img, 2, engine='numpy')\n"
+        "gaussquality_fitting.fit_GMM(img, 2, histogram=True)\n"
+        "print(json.dumps(sorted(sys.modules)))")
+    for module in HEAVY_MODULES:
+        assert module not in result
+
+
+def test_import_gui():
+    """
+    Tests importing the GUI does not create a window or import plotting,
+    and finds its logo inside the package
+    """
+    result = run_python(
+        "import sys, json\n"
+        "from gaussquality import gaussquality_gui\n"
+        "import tkinter\n"
+        "import os\n"
+        "logo_filepath = os.path.join(gaussquality_gui.LOGO_DIR, 'gaussquality_logo_greybg_50x50.pnm')\n"
+        "print(json.dumps({'root': tkinter._default_root is not None, 'logo': os.path.isfile(logo_filepath), 'modules': sorted(sys.modules)}))")
+    assert result["root"] is False
+    assert result["logo"] is True
+    assert "matplotlib" not in result["modules"]
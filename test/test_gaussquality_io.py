@@ -1,8 +1,10 @@
 import os
+import time
 import sys
 import numpy as np
 import pytest
 import skimage.io
+import tifffile
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
 base_dir = os.path.dirname(test_dir)
@@ -68,4 +70,126 @@ def test_load_img():
     patch_img_load = img_load[40:60, 200:220]
     patch_img_test = img_test[40:60, 200:220]
 
-    assert (masked_size == masked_img.shape) and (patch_img_load == pytest.approx(patch_img_test, rel=1e-1))
\ No newline at end of file
+    assert (masked_size == masked_img.shape) and (patch_img_load == pytest.approx(patch_img_test, rel=1e-1))
+
+def test_stack_index():
+    """
+    Tests that the stack index matches a fresh listing and reads the image
+    shape and dtype from the header
+    """
+    stack_index = gaussquality_io.get_stack_index(img_dir)
+    img = skimage.io.imread(stack_index.img_list[0])
+    assert (stack_index.img_list == gaussquality_io.get_img_list(img_dir)) and (stack_index.nslices == 50) and (stack_index.shape == img.shape) and (stack_index.dtype == img.dtype)
+    assert gaussquality_io.get_stack_index(img_dir) is stack_index
+    assert gaussquality_io.get_img_filepath(stack_index, 10).endswith("10.tif")
+
+
+def test_stack_index_invalidated(tmp_path):
+    """
+    Tests that a cached stack index is rebuilt when the folder changes
+    """
+    for i in range(3):
+        skimage.io.imsave(str(tmp_path / "{:02d}.tif".format(i)), np.random.randint(0, 255, (8, 10), dtype=np.uint8))
+    stack_index = gaussquality_io.get_stack_index(str(tmp_path))
+    assert gaussquality_io.get_nslices(str(tmp_path)) == 3
+    skimage.io.imsave(str(tmp_path / "03.tif"), np.random.randint(0, 255, (8, 10), dtype=np.uint8))
+    os.utime(str(tmp_path), ns=(stack_index.dir_mtime + 10**9, stack_index.dir_mtime + 10**9))
+    assert stack_index.is_stale() and (gaussquality_io.get_nslices(stack_index) == 4)
+
+
+@pytest.mark.parametrize("tiff_kwargs", [{}, {"byteorder": ">"}, {"compression": "zlib", "rowsperstrip": 7}, {"compression": "zlib", "tile": (32, 48)}])
+def test_read_img_roi(tmp_path, tiff_kwargs):
+    """
+    Tests that reading only the masked region of uncompressed, stripped and
+    tiled images gives the same array as masking the whole image
+    """
+    img_filepath = str(tmp_path / "roi.tif")
+    tifffile.imwrite(img_filepath, np.random.randint(0, 65535, (101, 133), dtype=np.uint16), **tiff_kwargs)
+    img = skimage.io.imread(img_filepath)
+    for mask_pct in [0, 33.3, 50, 70, 100]:
+        masked_img = gaussquality_io.read_img_roi(img_filepath, mask_pct)
+        assert (masked_img.dtype == img.dtype) and np.array_equal(masked_img, gaussquality_io.mask_img(img, mask_pct))
+
+
+def create_test_volume():
+    return np.stack([skimage.io.imread(gaussquality_io.get_img_filepath(img_dir, i)) for i in range(5)])
+
+
+@pytest.mark.parametrize("volume_format", ["tiff", "bigtiff", "hdf5", "zarr"])
+def test_open_volume(tmp_path, volume_format):
+    """
+    Tests that slices read from volume files match the image sequence
+    """
+    volume = create_test_volume()
+    if volume_format in ("tiff", "bigtiff"):
+        volume_path = str(tmp_path / "volume.tif")
+        tifffile.imwrite(volume_path, volume, bigtiff=(volume_format == "bigtiff"), compression="zlib", tile=(128, 128))
+    elif volume_format == "hdf5":
+        h5py = pytest.importorskip("h5py")
+        volume_path = str(tmp_path / "volume.h5")
+        with h5py.File(volume_path, "w") as f:
+            f.create_dataset("recon/volume", data=volume, chunks=(1, 64, 64))
+    else:
+        zarr = pytest.importorskip("zarr")
+        volume_path = str(tmp_path / "volume.zarr")
+        zarr_array = zarr.open(volume_path, mode="w", shape=volume.shape, chunks=(1, 64, 64), dtype=volume.dtype)
+        zarr_array[:] = volume
+    source = gaussquality_io.open_volume(volume_path)
+    assert (gaussquality_io.get_nslices(volume_path) == 5) and (source.shape == volume.shape[1:]) and (source.dtype == volume.dtype)
+    for index in range(5):
+        masked_img = gaussquality_io.load_img(source, mask_percentage=50, index=index)
+        assert np.array_equal(masked_img, gaussquality_io.mask_img(volume[index], 50))
+
+
+class CountingVolume(gaussquality_io.VolumeSource):
+    """Volume which records how many slices have been read"""
+    def __init__(self, nslices, fail_at=None):
+        self.path = "counting"
+        self.nslices = nslices
+        self.shape = (4, 4)
+        self.dtype = np.dtype(np.uint8)
+        self.n_read = 0
+        self.fail_at = fail_at
+
+    def read_slice(self, index, mask_percentage=100.):
+        if index == self.fail_at:
+            raise IOError("failed to read slice {}".format(index))
+        self.n_read += 1
+        return np.full(self.shape, index, dtype=self.dtype)
+
+
+def test_iter_slices_prefetch():
+    """
+    Tests that prefetched slices arrive in order and the reader stays at most
+    `prefetch` slices ahead
+    """
+    source = CountingVolume(20)
+    for i, img in enumerate(gaussquality_io.iter_slices(source, list(range(20)), prefetch=3)):
+        time.sleep(0.01)
+        assert np.all(img == i) and (source.n_read <= i + 1 + 3)
+    with pytest.raises(IOError):
+        list(gaussquality_io.iter_slices(CountingVolume(20, fail_at=5), list(range(20)), prefetch=2))
+
+
+def test_save_load_GMM_results_npz(tmp_path):
+    """
+    Tests saving results to a single .npz, appending slices and loading
+    memory-mapped arrays
+    """
+    from gaussquality import gaussquality_results
+    npz_filepath = str(tmp_path / "results.npz")
+    first = gaussquality_results.SliceResults([1, 2], [[10., 50.], [12., 52.]], [[2., 4.], [0., 4.]], [[0.4, 0.6], [0.5, 0.5]], diagnostics={"n_iter": [3, 4]})
+    gaussquality_io.save_GMM_results_npz(first, npz_filepath, input_args={"n_components": 2})
+    iter_results, fitted_results, (snrs, cnrs), input_args = gaussquality_io.load_GMM_results_npz(npz_filepath)
+    assert not iter_results.mu.flags.owndata and not iter_results.mu.flags.writeable
+    assert np.array_equal(iter_results.mu, first.mu) and np.array_equal(iter_results.diagnostics["n_iter"], [3, 4])
+    assert fitted_results[0] == pytest.approx([11., 51.])
+    assert snrs.shape == (2, 2, 2) and snrs[0, 0, 1] == pytest.approx(25.) and np.isnan(cnrs[1, 0, 1])
+    assert input_args == {"n_components": 2}
+    # appended slices are added to the existing ones
+    second = gaussquality_results.SliceResults([3], [[14., 54.]], [[2., 4.]], [[0.4, 0.6]], diagnostics={"n_iter": [5]})
+    gaussquality_io.save_GMM_results_npz(second, npz_filepath, append=True)
+    iter_results, fitted_results, (snrs, cnrs), input_args = gaussquality_io.load_GMM_results_npz(npz_filepath, mmap_mode=None)
+    assert list(iter_results.slices) == [1, 2, 3] and snrs.shape == (3, 2, 2)
+    assert fitted_results[0] == pytest.approx([12., 52.])
+    assert input_args == {"n_components": 2}
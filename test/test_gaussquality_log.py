@@ -0,0 +1,62 @@
+import os
+import logging
+import threading
+
+from gaussquality import gaussquality_log
+
+
+class FakeText(object):
+    """
+    Records calls like a Tk Text widget, without a display.
+    """
+    def __init__(self):
+        self.lines = [""]
+        self.scheduled = []
+
+    def insert(self, index, text):
+        self.lines[-1:] = (self.lines[-1] + text).split("\n")
+
+    def index(self, index):
+        return "{}.0".format(len(self.lines))
+
+    def delete(self, start, end):
+        del self.lines[:int(end.split(".")[0]) - 1]
+
+    def see(self, index):
+        pass
+
+    def after(self, interval, callback):
+        self.scheduled.append(callback)
+
+
+def test_text_log_sink(tmp_path):
+    """
+    Tests printed lines from several threads are flushed to the widget in
+    batches, capped at `max_lines`, and mirrored to the log file
+    """
+    logger = logging.getLogger("gaussquality.test_log")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    text = FakeText()
+    sink = gaussquality_log.TextLogSink(text, logger=logger, max_lines=50)
+    gaussquality_log.set_log_dir(str(tmp_path), logger=logger)
+    stream = gaussquality_log.StreamToLogger(logger)
+
+    def print_lines(thread_number):
+        for i in range(40):
+            print("thread {}".format(thread_number), "line {}".format(i), file=stream)
+    threads = [threading.Thread(target=print_lines, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # nothing is shown until the timer flushes the queue
+    assert text.lines == [""]
+    sink.flush()
+    assert len(text.lines) - 1 == 50
+    assert all(line.startswith("thread ") and " line " in line for line in text.lines[:-1])
+    with open(os.path.join(str(tmp_path), gaussquality_log.LOG_FILENAME)) as log_file:
+        assert len(log_file.readlines()) == 120
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from gaussquality import gaussquality_io
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_phantom
+
+
+def test_write_phantom_stack(tmp_path):
+    """
+    Tests known mixture parameters are recovered from a phantom stack
+    """
+    mu, sigma, phi = [200., 60.], [10., 5.], [0.4, 0.6]
+    img_dir = gaussquality_phantom.write_phantom_stack(str(tmp_path), 4, (100, 100), mu, sigma, phi, bit_depth=8)
+    assert gaussquality_io.get_nslices(img_dir) == 4
+    img = gaussquality_io.load_img(gaussquality_io.get_img_list(img_dir)[0])
+    assert img.dtype == np.uint8 and img.shape == (100, 100)
+    fitted_results, iter_results = gaussquality_fitting.run_GMM_fit(img_dir, 2, n_runs=2, histogram=True)
+    errors = gaussquality_phantom.recovery_error(fitted_results, mu, sigma, phi)
+    assert errors["mu"] < 0.01 and errors["sigma"] < 0.05 and errors["phi"] < 0.05
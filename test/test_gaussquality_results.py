@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from gaussquality import gaussquality_results
+
+
+def test_slice_results():
+    """
+    Tests SliceResults reductions, export and backward-compatible unpacking.
+    """
+    mus = {10: np.array([1., 5.]), 20: np.array([3., 7.])}
+    sigmas = {10: np.array([0.5, 1.]), 20: np.array([1.5, 2.])}
+    phis = {10: np.array([0.4, 0.6]), 20: np.array([0.2, 0.8])}
+    results = gaussquality_results.SliceResults.from_iter_results(
+        [mus, sigmas, phis], diagnostics={"n_iter": {10: 3, 20: 5}})
+    assert results.n_slices == 2 and results.n_components == 2
+    mu_mean, sigma_mean, phi_mean = results.mean()
+    assert (mu_mean == pytest.approx([2., 6.])) and (sigma_mean == pytest.approx([1., 1.5])) and (phi_mean == pytest.approx([0.3, 0.7]))
+    assert results.std()[0] == pytest.approx([1., 1.])
+    assert results.percentile(50)[0] == pytest.approx([2., 6.])
+    # unpacks like the previous list of dicts
+    unpacked_mus, unpacked_sigmas, unpacked_phis = results
+    assert list(unpacked_mus.keys()) == [10, 20]
+    assert results[1][20] == pytest.approx([1.5, 2.])
+    assert results.diagnostics_dicts() == {"n_iter": {10: 3, 20: 5}}
+    # export shares memory with the arrays
+    df = results.to_pandas("phi")
+    assert list(df.index) == [10, 20]
+    assert np.shares_memory(df.to_numpy(), results.phi)
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pytest
+
+from gaussquality import gaussquality_tiles
+from gaussquality import gaussquality_fitting
+from gaussquality import gaussquality_phantom
+
+mu_phantom = [20000., 40000.]
+phi_phantom = [0.4, 0.6]
+
+
+def test_tile_edges():
+    """
+    Tests tiles cover the image, with smaller tiles at the edges
+    """
+    row_edges, col_edges = gaussquality_tiles.tile_edges((250, 200), 100)
+    assert list(row_edges) == [0, 100, 200, 250]
+    assert list(col_edges) == [0, 100, 200]
+
+
+def test_merge_histograms():
+    """
+    Tests merging the histograms of every tile gives the histogram of the
+    whole image
+    """
+    img = gaussquality_phantom.make_phantom_slice((150, 130), mu_phantom, [1000., 2000.], phi_phantom, random_state=0)
+    histograms = gaussquality_tiles.tile_histograms(img, *gaussquality_tiles.tile_edges(img.shape, 64))
+    merged = gaussquality_fitting.merge_histograms(histograms)
+    expected = gaussquality_fitting.img_histogram(img)
+    assert np.array_equal(merged[0], expected[0])
+    assert np.array_equal(merged[1], expected[1])
+
+
+def test_fit_tiles():
+    """
+    Tests the noise of each tile is recovered from an image whose noise
+    doubles from left to right, and that small tiles are skipped
+    """
+    left = gaussquality_phantom.make_phantom_slice((200, 100), mu_phantom, [1000., 1000.], phi_phantom, random_state=1)
+    right = gaussquality_phantom.make_phantom_slice((200, 100), mu_phantom, [2000., 2000.], phi_phantom, random_state=2)
+    img = np.hstack([left, right, right[:, :10]])
+    fitted_tiles, fitted_results, edges = gaussquality_tiles.fit_tiles(img, 2, tile_size=100, min_pixels=5000)
+    sigma = fitted_tiles[1]
+    assert sigma.shape == (2, 3, 2)
+    assert sigma[:, 0] == pytest.approx(1000., rel=0.05)
+    assert sigma[:, 1] == pytest.approx(2000., rel=0.05)
+    assert np.all(np.isnan(sigma[:, 2]))
+    assert fitted_results[0] == pytest.approx(mu_phantom, rel=0.01)
+
+
+def test_run_tile_maps(tmp_path):
+    """
+    Tests SNR and CNR maps are saved as .npy files, and fitting tiles in
+    parallel gives the same maps
+    """
+    img_dir = gaussquality_phantom.write_phantom_stack(str(tmp_path), 6, (120, 120), mu_phantom, [1000., 2000.], phi_phantom)
+    maps = gaussquality_tiles.run_tile_maps(img_dir, 2, 0, 1, str(tmp_path), "serial", tile_size=60, slab_thickness=2, n_slabs=2)
+    parallel_maps = gaussquality_tiles.run_tile_maps(img_dir, 2, 0, 1, str(tmp_path), "parallel", tile_size=60, slab_thickness=2, n_slabs=2, n_jobs=2)
+    snr = np.load(os.path.join(str(tmp_path), "serial_tile_snr.npy"), mmap_mode="r")
+    assert snr.shape == (2, 2, 2)
+    assert np.asarray(snr) == pytest.approx(40000. / 1000., rel=0.05)
+    assert maps["cnr"] == pytest.approx(20000. / 1000., rel=0.05)
+    assert maps["mu"].shape == (2, 2, 2, 2)
+    for name in gaussquality_tiles.MAP_NAMES:
+        assert np.asarray(parallel_maps[name]) == pytest.approx(np.asarray(maps[name]))
+    for name in ["snr", "cnr"]:
+        assert os.path.exists(os.path.join(str(tmp_path), "serial_tile_{}_slab2.png".format(name)))
+
+
+def test_fit_tiles_sampling():
+    """
+    Tests sampling arguments, which cannot apply to tile histograms, are
+    rejected
+    """
+    img = gaussquality_phantom.make_phantom_slice((100, 100), mu_phantom, [1000., 2000.], phi_phantom, random_state=0)
+    with pytest.raises(ValueError, match="n_samples"):
+        gaussquality_tiles.fit_tiles(img, 2, tile_size=50, n_samples=1000)
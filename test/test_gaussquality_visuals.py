@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import pytest
+import matplotlib
+matplotlib.use("Agg")
+
+from gaussquality import gaussquality_visuals
+from gaussquality import gaussquality_fitting
+
+
+def test_histogram_density():
+    """
+    Tests histogram of thresholded grey values matches binning every pixel,
+    with and without a precomputed histogram
+    """
+    img = np.random.default_rng(0).integers(0, 1000, size=(100, 120)).astype(np.uint16)
+    threshold = (100, 800)
+    pixels = img[(img >= threshold[0]) & (img <= threshold[1])]
+    expected_density, expected_edges = np.histogram(pixels, bins=int(0.25*pixels.size**0.5), density=True)
+    for density, edges in [gaussquality_visuals.histogram_density(img, threshold),
+                           gaussquality_visuals.histogram_density(img.astype(float), threshold),
+                           gaussquality_visuals.histogram_density(None, threshold, histogram=gaussquality_fitting.img_histogram(img))]:
+        assert density == pytest.approx(expected_density)
+        assert edges == pytest.approx(expected_edges)
+
+
+def test_plot_quality_map():
+    """
+    Tests a tile map with uneven edges and skipped tiles can be overlaid
+    """
+    import matplotlib.pyplot as plt
+    img = np.zeros((250, 200))
+    quality_map = np.array([[1., 2.], [3., np.nan], [4., 5.]])
+    gaussquality_visuals.plot_quality_map(img, quality_map, [0, 100, 200, 250], [0, 100, 200])
+    assert len(plt.gca().collections) == 1
+    plt.close("all")